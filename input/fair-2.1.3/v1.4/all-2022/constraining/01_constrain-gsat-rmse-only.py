@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 # coding: utf-8
 
-"""First constraint: RMSE < 0.17 K"""
+"""First constraint: RMSE < RMSE_CEILING (0.17 K by default)"""
 
 import os
 
@@ -10,7 +10,7 @@ import numpy as np
 import pandas as pd
 from dotenv import load_dotenv
 from fair import __version__
-from tqdm.auto import tqdm
+from utils import _fan_trajectories, _load_members, _load_trajectories
 
 pl.switch_backend("agg")
 
@@ -24,66 +24,75 @@ fair_v = os.getenv("FAIR_VERSION")
 constraint_set = os.getenv("CONSTRAINT_SET")
 samples = int(os.getenv("PRIOR_SAMPLES"))
 plots = os.getenv("PLOTS", "False").lower() in ("true", "1", "t")
-progress = os.getenv("PROGRESS", "False").lower() in ("true", "1", "t")
+rmse_ceiling = float(os.getenv("RMSE_CEILING", 0.17))
+trajectory_stride = int(os.getenv("TRAJECTORY_STRIDE", 100))
 
 assert fair_v == __version__
 
 
-temp_in = np.load(
+# temperature is on timebounds, and observations are midyears
+# but, this is OK, since we are subtracting a consistent baseline (1850-1900, weighting
+# the bounding timebounds as 0.5)
+# e.g. 1993.0 timebound has big pinatubo hit, timebound 143
+# in obs this is 1992.5, timepoint 142
+# compare the timebound after the obs, since the forcing has had chance to affect both
+# the obs timepoint and the later timebound.
+# the goal of RMSE is as much to match the shape of warming as the magnitude; we do not
+# want to average out internal variability in the model or the obs.
+# The RMSE of each ensemble member is calculated when the prior is run.
+rmse_temp = _load_members(
     f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/prior_runs/"
-    "temperature_1850-2101.npy"
+    "temperature_rmse_1850-2022.npy"
 )
 
 df_gmst = pd.read_csv("../../../../../data/forcing/IGCC_GMST_1850-2022.csv")
 gmst = df_gmst["gmst"].values
 
-
-def rmse(obs, mod):
-    return np.sqrt(np.sum((obs - mod) ** 2) / len(obs))
-
-
 weights = np.ones(52)
 weights[0] = 0.5
 weights[-1] = 0.5
 
-rmse_temp = np.zeros((samples))
-
+# the full temperature time series is kept for a sample of the prior, every
+# TRAJECTORY_STRIDE-th ensemble member, and the members that pass the RMSE constraint.
+# Summaries of them for fan plots are cached for the other plotting scripts.
+trajectory_dir = (
+    f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/prior_runs/"
+    "temperature_1850-2101"
+)
+fan_dir = (
+    f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/prior_runs/fans"
+)
 if plots:
+    fan = _fan_trajectories(
+        trajectory_dir,
+        np.arange(0, samples, trajectory_stride),
+        cache=f"{fan_dir}/prior.npz",
+    )
     fig, ax = pl.subplots(figsize=(5, 5))
     ax.fill_between(
         np.arange(1850, 2102),
-        np.min(temp_in - np.average(temp_in[:52, :], weights=weights, axis=0), axis=1),
-        np.max(temp_in - np.average(temp_in[:52, :], weights=weights, axis=0), axis=1),
+        fan["min"],
+        fan["max"],
         color="#000000",
         alpha=0.2,
     )
     ax.fill_between(
         np.arange(1850, 2102),
-        np.percentile(
-            temp_in - np.average(temp_in[:52, :], weights=weights, axis=0), 5, axis=1
-        ),
-        np.percentile(
-            temp_in - np.average(temp_in[:52, :], weights=weights, axis=0), 95, axis=1
-        ),
+        fan["p5"],
+        fan["p95"],
         color="#000000",
         alpha=0.2,
     )
     ax.fill_between(
         np.arange(1850, 2102),
-        np.percentile(
-            temp_in - np.average(temp_in[:52, :], weights=weights, axis=0), 16, axis=1
-        ),
-        np.percentile(
-            temp_in - np.average(temp_in[:52, :], weights=weights, axis=0), 84, axis=1
-        ),
+        fan["p16"],
+        fan["p84"],
         color="#000000",
         alpha=0.2,
     )
     ax.plot(
         np.arange(1850, 2102),
-        np.median(
-            temp_in - np.average(temp_in[:52, :], weights=weights, axis=0), axis=1
-        ),
+        fan["p50"],
         color="#000000",
     )
     ax.plot(np.arange(1850.5, 2023), gmst, color="b")
@@ -105,22 +114,7 @@ if plots:
     )
     pl.close()
 
-# temperature is on timebounds, and observations are midyears
-# but, this is OK, since we are subtracting a consistent baseline (1850-1900, weighting
-# the bounding timebounds as 0.5)
-# e.g. 1993.0 timebound has big pinatubo hit, timebound 143
-# in obs this is 1992.5, timepoint 142
-# compare the timebound after the obs, since the forcing has had chance to affect both
-# the obs timepoint and the later timebound.
-# the goal of RMSE is as much to match the shape of warming as the magnitude; we do not
-# want to average out internal variability in the model or the obs.
-for i in tqdm(range(samples), disable=1 - progress):
-    rmse_temp[i] = rmse(
-        gmst[:173],
-        temp_in[1:174, i] - np.average(temp_in[:52, i], weights=weights, axis=0),
-    )
-
-accept_temp = rmse_temp < 0.17
+accept_temp = rmse_temp < rmse_ceiling
 print("Passing RMSE constraint:", np.sum(accept_temp))
 valid_temp = np.arange(samples, dtype=int)[accept_temp]
 
@@ -134,25 +128,24 @@ print(rmse_temp_accept[smashing_it])
 
 
 if plots:
+    # only the members plotted individually are loaded
+    _, temp_in = _load_trajectories(
+        trajectory_dir,
+        np.concatenate((valid_temp[just_passing], valid_temp[smashing_it])),
+    )
+    temp_in = temp_in - np.average(temp_in[:52], weights=weights, axis=0)
+
     # plot top 10 and "just squeaking in 10"
     fig, ax = pl.subplots(figsize=(5, 5))
     ax.plot(
         np.arange(1850.5, 2102),
-        (
-            temp_in[:, valid_temp[just_passing]]
-            - np.average(
-                temp_in[:52, valid_temp[just_passing]], weights=weights, axis=0
-            )
-        ),
+        temp_in[:, :10],
         color="#ff0000",
-        label=[r"RMSE $\approx$ 0.17°C"] + [""] * 9,
+        label=[rf"RMSE $\approx$ {rmse_ceiling}°C"] + [""] * 9,
     )
     ax.plot(
         np.arange(1850.5, 2102),
-        (
-            temp_in[:, valid_temp[smashing_it]]
-            - np.average(temp_in[:52, valid_temp[smashing_it]], weights=weights, axis=0)
-        ),
+        temp_in[:, 10:],
         color="#0000ff",
         label=[r"RMSE $\approx$ 0.10°C"] + [""] * 9,
     )
@@ -178,63 +171,34 @@ if plots:
     pl.close()
 
     # ensemble wide
+    fan = _fan_trajectories(
+        trajectory_dir, valid_temp, cache=f"{fan_dir}/rmse_pass.npz"
+    )
     fig, ax = pl.subplots(figsize=(5, 5))
     ax.fill_between(
         np.arange(1850, 2102),
-        np.min(
-            temp_in[:, accept_temp]
-            - np.average(temp_in[:52, accept_temp], weights=weights, axis=0),
-            axis=1,
-        ),
-        np.max(
-            temp_in[:, accept_temp]
-            - np.average(temp_in[:52, accept_temp], weights=weights, axis=0),
-            axis=1,
-        ),
+        fan["min"],
+        fan["max"],
         color="#000000",
         alpha=0.2,
     )
     ax.fill_between(
         np.arange(1850.5, 2102),
-        np.percentile(
-            temp_in[:, accept_temp]
-            - np.average(temp_in[:52, accept_temp], weights=weights, axis=0),
-            5,
-            axis=1,
-        ),
-        np.percentile(
-            temp_in[:, accept_temp]
-            - np.average(temp_in[:52, accept_temp], weights=weights, axis=0),
-            95,
-            axis=1,
-        ),
+        fan["p5"],
+        fan["p95"],
         color="#000000",
         alpha=0.2,
     )
     ax.fill_between(
         np.arange(1850.5, 2102),
-        np.percentile(
-            temp_in[:, accept_temp]
-            - np.average(temp_in[:52, accept_temp], weights=weights, axis=0),
-            16,
-            axis=1,
-        ),
-        np.percentile(
-            temp_in[:, accept_temp]
-            - np.average(temp_in[:52, accept_temp], weights=weights, axis=0),
-            84,
-            axis=1,
-        ),
+        fan["p16"],
+        fan["p84"],
         color="#000000",
         alpha=0.2,
     )
     ax.plot(
         np.arange(1850.5, 2102),
-        np.median(
-            temp_in[:, accept_temp]
-            - np.average(temp_in[:52, accept_temp], weights=weights, axis=0),
-            axis=1,
-        ),
+        fan["p50"],
         color="#000000",
     )
 
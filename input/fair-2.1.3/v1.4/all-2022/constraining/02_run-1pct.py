@@ -3,16 +3,48 @@
 
 """Run 1pct CO2 concentration driven runs where RMSE passes"""
 
+# Completed batches are recorded in a manifest alongside the output. If the run is
+# interrupted, running this script again only runs the batches that are not complete,
+# provided the priors, RMSE-passing ensemble members, settings and, if they are used,
+# the 1pctCO2 results of the prior ensemble have not changed.
+#
+# If IDEALISED_EXPERIMENTS includes 1pctCO2, sampling/09 has already run it for every
+# member of the prior, and the results are taken from there instead.
+
 import multiprocessing
 import os
+import tempfile
+import time
 from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
-import pandas as pd
 from dotenv import load_dotenv
 from fair import __version__
-from parallel_1pct import run_fair
-from utils import _parallel_process
+from parallel_1pct import (
+    allocate_outputs,
+    init_worker,
+    manifest_file,
+    output_dir,
+    output_files,
+    outputs,
+    publish_inputs,
+    run_fair,
+    timing_file,
+    write_outputs,
+)
+from utils import (
+    _fingerprint,
+    _is_complete,
+    _load_manifest,
+    _load_members,
+    _parallel_process,
+    _PhaseTimer,
+    _save_manifest,
+    _save_timing_report,
+    _split_batch,
+    idealised_experiments,
+    timing,
+)
 
 if __name__ == "__main__":
     print("Running 1pctCO2 scenarios...")
@@ -30,21 +62,36 @@ if __name__ == "__main__":
 
     assert fair_v == __version__
 
-    df_cc = pd.read_csv(
+    input_files = [
         f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/priors/"
-        "carbon_cycle.csv"
-    )
-    df_cr = pd.read_csv(
+        "carbon_cycle/schema.json",
         f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/priors/"
-        "climate_response_ebm3.csv"
-    )
-    df_scaling = pd.read_csv(
+        "climate_response_ebm3/schema.json",
         f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/priors/"
-        "forcing_scaling.csv"
-    )
+        "forcing_scaling/schema.json",
+        f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/posteriors/"
+        "runids_rmse_pass.csv",
+        f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/"
+        "concentration/1pctCO2_concentration_1850-1990.nc",
+    ]
+    # results taken from the prior ensemble depend on the run of sampling/09 they are
+    # from
+    if "1pctCO2" in idealised_experiments:
+        input_files.extend(
+            os.path.join(output_dir, "idealised", filename)
+            for filename, _ in outputs.values()
+        )
 
-    seedgen = 1355763
-    seedstep = 399
+    # results do not depend on BATCH_SIZE or WORKERS, so these can change on resume
+    fingerprint = _fingerprint(
+        input_files,
+        {
+            "FAIR_VERSION": fair_v,
+            "CALIBRATION_VERSION": cal_v,
+            "CONSTRAINT_SET": constraint_set,
+            "IDEALISED_EXPERIMENTS": idealised_experiments,
+        },
+    )
 
     # we also only want to run ensembles that passed RMSE test
     rmse_pass = np.loadtxt(
@@ -52,97 +99,92 @@ if __name__ == "__main__":
         "runids_rmse_pass.csv"
     ).astype(int)
 
-    # we only care about temperature and airborne fraction in years 70 and 140
-    temp_2x4x_out = np.ones((2, len(rmse_pass))) * np.nan
-    af_out = np.ones((2, len(rmse_pass))) * np.nan
-    temp_1000_out = np.ones(len(rmse_pass)) * np.nan
-
-    config = []
-    for ibatch, batch_start in enumerate(range(0, len(rmse_pass), batch_size)):
-        config.append({})
-        batch_end = min(batch_start + batch_size, len(rmse_pass))
-        config[ibatch]["batch_start"] = batch_start
-        config[ibatch]["batch_end"] = batch_end
-        config[ibatch]["c1"] = df_cr.loc[rmse_pass[batch_start:batch_end], "c1"].values
-        config[ibatch]["c2"] = df_cr.loc[rmse_pass[batch_start:batch_end], "c2"].values
-        config[ibatch]["c3"] = df_cr.loc[rmse_pass[batch_start:batch_end], "c3"].values
-        config[ibatch]["kappa1"] = df_cr.loc[
-            rmse_pass[batch_start:batch_end], "kappa1"
-        ].values
-        config[ibatch]["kappa2"] = df_cr.loc[
-            rmse_pass[batch_start:batch_end], "kappa2"
-        ].values
-        config[ibatch]["kappa3"] = df_cr.loc[
-            rmse_pass[batch_start:batch_end], "kappa3"
-        ].values
-        config[ibatch]["epsilon"] = df_cr.loc[
-            rmse_pass[batch_start:batch_end], "epsilon"
-        ].values
-        config[ibatch]["gamma"] = df_cr.loc[
-            rmse_pass[batch_start:batch_end], "gamma"
-        ].values
-        config[ibatch]["forcing_4co2"] = df_cr.loc[
-            rmse_pass[batch_start:batch_end], "F_4xCO2"
-        ]
-        config[ibatch]["iirf_0"] = df_cc.loc[
-            rmse_pass[batch_start:batch_end], "r0"
-        ].values.squeeze()
-        config[ibatch]["iirf_airborne"] = df_cc.loc[
-            rmse_pass[batch_start:batch_end], "rA"
-        ].values.squeeze()
-        config[ibatch]["iirf_uptake"] = df_cc.loc[
-            rmse_pass[batch_start:batch_end], "rU"
-        ].values.squeeze()
-        config[ibatch]["iirf_temperature"] = df_cc.loc[
-            rmse_pass[batch_start:batch_end], "rT"
-        ].values.squeeze()
-        config[ibatch]["scaling_CO2"] = df_scaling.loc[
-            rmse_pass[batch_start:batch_end], "CO2"
-        ].values.squeeze()
-        config[ibatch]["scaling_CH4"] = df_scaling.loc[
-            rmse_pass[batch_start:batch_end], "CH4"
-        ].values.squeeze()
-        config[ibatch]["scaling_N2O"] = df_scaling.loc[
-            rmse_pass[batch_start:batch_end], "N2O"
-        ].values.squeeze()
-
+    # we only care about temperature and airborne fraction in years 70 and 140; each
+    # batch writes its own slice of the output files
+    complete = _load_manifest(manifest_file, fingerprint, output_files())
+    if complete is None:
+        allocate_outputs(len(rmse_pass))
+        complete = []
+        _save_manifest(manifest_file, fingerprint, complete)
+
+    # each batch only needs to know which positions in rmse_pass to run: workers read
+    # the prior parameters for these straight from the parameter store
+    config = [
+        {
+            "batch_start": batch_start,
+            "batch_end": min(batch_start + batch_size, len(rmse_pass)),
+        }
+        for batch_start in range(0, len(rmse_pass), batch_size)
+    ]
+
+    n_batches = len(config)
+    config = [cfg for cfg in config if not _is_complete(cfg, complete)]
+    if len(config) < n_batches:
+        print(f"Resuming: {n_batches - len(config)} of {n_batches} batches done")
+
+    # if the prior ensemble also ran 1pctCO2 (IDEALISED_EXPERIMENTS), the results of
+    # the members that pass the RMSE constraint are taken from there, and nothing needs
+    # to be run
+    if "1pctCO2" in idealised_experiments and config:
+        print("Taking 1pctCO2 results from the prior ensemble...")
+        write_outputs(
+            0,
+            len(rmse_pass),
+            **{
+                name: _load_members(
+                    os.path.join(output_dir, "idealised", filename), rmse_pass
+                )
+                for name, (filename, _) in outputs.items()
+            },
+        )
+        complete = [[0, len(rmse_pass)]]
+        _save_manifest(manifest_file, fingerprint, complete)
+        config = []
+
+    # if TIMING is set, each batch returns how long its phases took
+    timings = []
+
+    def record_batch(cfg, result):
+        complete.append([cfg["batch_start"], cfg["batch_end"]])
+        _save_manifest(manifest_file, fingerprint, complete)
+        if result is not None:
+            timings.append(result)
+
+    # batches are submitted to the pool a few at a time, and their results are only
+    # recorded in the manifest. Batches that are left at the end are split between
+    # any idle workers.
     parallel_process_kwargs = dict(
         func=run_fair,
         configuration=config,
         config_are_kwargs=False,
+        callback=record_batch,
+        split=_split_batch,
+        keep_results=False,
     )
 
-    with ProcessPoolExecutor(WORKERS) as pool:
-        res = _parallel_process(
-            **parallel_process_kwargs,
-            pool=pool,
-        )
-
-    for ibatch, batch_start in enumerate(range(0, len(rmse_pass), batch_size)):
-        batch_end = min(batch_start + batch_size, len(rmse_pass))
-        temp_2x4x_out[:, batch_start:batch_end] = res[ibatch][0]
-        af_out[:, batch_start:batch_end] = res[ibatch][1]
-        temp_1000_out[batch_start:batch_end] = res[ibatch][2]
-
-    os.makedirs(
-        f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/prior_runs/",
-        exist_ok=True,
-    )
-    np.save(
-        f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/prior_runs/"
-        "temperature_1pctCO2_y70_y140.npy",
-        temp_2x4x_out,
-        allow_pickle=True,
-    )
-    np.save(
-        f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/prior_runs/"
-        "airborne_fraction_1pctCO2_y70_y140.npy",
-        af_out,
-        allow_pickle=True,
-    )
-    np.save(
-        f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/prior_runs/"
-        "temperature_1pctCO2_1000GtC.npy",
-        temp_1000_out,
-        allow_pickle=True,
-    )
+    if config:
+        # the prior parameters and concentration time series are published once for
+        # workers to share rather than being loaded or pickled for each batch
+        timer = _PhaseTimer()
+        with tempfile.TemporaryDirectory() as shared_dir:
+            publish_inputs(shared_dir, rmse_pass)
+            timer.lap("publish_inputs")
+            start = time.perf_counter()
+            with ProcessPoolExecutor(
+                WORKERS, initializer=init_worker, initargs=(shared_dir,)
+            ) as pool:
+                _parallel_process(
+                    **parallel_process_kwargs,
+                    pool=pool,
+                )
+                timer.lap("ensemble")
+                elapsed = time.perf_counter() - start
+
+        if timing:
+            report = _save_timing_report(
+                timing_file, timings, WORKERS, elapsed, parent=timer.phases
+            )
+            print(
+                f"{report['members_per_second']:.1f} members/s with {WORKERS} workers, "
+                f"{report['utilisation']:.0%} utilised; see {timing_file}"
+            )
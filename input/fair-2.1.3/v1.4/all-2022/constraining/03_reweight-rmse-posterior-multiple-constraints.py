@@ -18,6 +18,15 @@ from fair import __version__
 from fair.earth_params import mass_atmosphere, molecular_weight_air
 from matplotlib.lines import Line2D
 from tqdm.auto import tqdm
+from utils import (
+    _assessed_samples,
+    _binned_kde,
+    _draw_posterior,
+    _fan_trajectories,
+    _load_members,
+    _save_posterior_weights,
+    abc_smc,
+)
 
 pl.switch_backend("agg")
 
@@ -31,14 +40,13 @@ output_ensemble_size = int(os.getenv("POSTERIOR_SAMPLES"))
 plots = os.getenv("PLOTS", "False").lower() in ("true", "1", "t")
 pl.style.use("../../../../../defaults.mplstyle")
 progress = os.getenv("PROGRESS", "False").lower() in ("true", "1", "t")
+reweighting = os.getenv("REWEIGHTING", "histogram")
 
 assert fair_v == __version__
 
 print("Doing reweighting...")
 
 
-NINETY_TO_ONESIGMA = scipy.stats.norm.ppf(0.95)
-
 valid_temp = np.loadtxt(
     f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/posteriors/"
     "runids_rmse_pass.csv"
@@ -48,92 +56,54 @@ input_ensemble_size = len(valid_temp)
 
 assert input_ensemble_size > output_ensemble_size
 
-temp_in = np.load(
+# these are memory-mapped: the reweighting only reads the members that pass the RMSE
+# constraint from disk, and the whole prior is read for its distributions below
+warming_in = _load_members(
     f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/prior_runs/"
-    "temperature_1850-2101.npy"
+    "temperature_2003-2022_rel_1850-1900.npy"
 )
-ohc_in = np.load(
+ohc_in = _load_members(
     f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/prior_runs/"
     "ocean_heat_content_2020_minus_1971.npy"
 )
-fari_in = np.load(
+fari_in = _load_members(
     f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/prior_runs/"
     "forcing_ari_2005-2014_mean.npy"
 )
-faci_in = np.load(
+faci_in = _load_members(
     f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/prior_runs/"
     "forcing_aci_2005-2014_mean.npy"
 )
-co2_in = np.load(
+co2_in = _load_members(
     f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/prior_runs/"
     "concentration_co2_2022.npy"
 )
-ecs_in = np.load(
+ecs_in = _load_members(
     f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/prior_runs/ecs.npy"
 )
-tcr_in = np.load(
+tcr_in = _load_members(
     f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/prior_runs/tcr.npy"
 )
-af_in = np.load(
+af_in = _load_members(
     f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/prior_runs/"
     "airborne_fraction_1pctCO2_y70_y140.npy"
 )
 faer_in = fari_in + faci_in
 
-
-def opt(x, q05_desired, q50_desired, q95_desired):
-    "x is (a, loc, scale) in that order."
-    q05, q50, q95 = scipy.stats.skewnorm.ppf(
-        (0.05, 0.50, 0.95), x[0], loc=x[1], scale=x[2]
+# with ABC_SMC, sampling/09 only runs the members of the prior that sampling/abc_smc.py
+# chooses, and each member that is run stands for a share of the prior given by its
+# importance weight. The reweighting starts from these weights.
+if abc_smc:
+    prior_weights = np.load(
+        f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/prior_runs/"
+        "importance_weights.npy"
     )
-    return (q05 - q05_desired, q50 - q50_desired, q95 - q95_desired)
-
+else:
+    prior_weights = np.ones(len(ecs_in))
+prior_members = prior_weights > 0
 
-ecs_params = scipy.optimize.root(opt, [1, 1, 1], args=(2, 3, 5)).x
-gsat_params = scipy.optimize.root(opt, [1, 1, 1], args=(0.87, 1.03, 1.13)).x
 
-samples = {}
-samples["ECS"] = scipy.stats.skewnorm.rvs(
-    ecs_params[0],
-    loc=ecs_params[1],
-    scale=ecs_params[2],
-    size=10**5,
-    random_state=91603,
-)
-samples["TCR"] = scipy.stats.norm.rvs(
-    loc=1.8, scale=0.6 / NINETY_TO_ONESIGMA, size=10**5, random_state=18196
-)
-# note fair produces, and we here report, total earth energy uptake, not just ocean
-# this value from IGCC 2023. Use new uncertainties for ocean, assume same uncertainties
-# for land, atmosphere and cryopshere.
-samples["OHC"] = scipy.stats.norm.rvs(
-    loc=465.3, scale=108.5 / NINETY_TO_ONESIGMA, size=10**5, random_state=43178
-)
-samples["temperature 2003-2022"] = scipy.stats.skewnorm.rvs(
-    gsat_params[0],
-    loc=gsat_params[1],
-    scale=gsat_params[2],
-    size=10**5,
-    random_state=19387,
-)
-samples["ERFari"] = scipy.stats.norm.rvs(
-    loc=-0.3, scale=0.3 / NINETY_TO_ONESIGMA, size=10**5, random_state=70173
-)
-samples["ERFaci"] = scipy.stats.norm.rvs(
-    loc=-1.0, scale=0.7 / NINETY_TO_ONESIGMA, size=10**5, random_state=91123
-)
-samples["ERFaer"] = scipy.stats.norm.rvs(
-    loc=-1.3,
-    scale=np.sqrt(0.7**2 + 0.3**2) / NINETY_TO_ONESIGMA,
-    size=10**5,
-    random_state=3916153,
-)
-# IGCC paper: 417.1 +/- 0.4
-# IGCC dataset: 416.9
-# my assessment 417.0 +/- 0.5
-samples["CO2 concentration"] = scipy.stats.norm.rvs(
-    loc=417.0, scale=0.5, size=10**5, random_state=81693
-)
+samples = _assessed_samples()
 
 ar_distributions = {}
 for constraint in [
@@ -152,13 +122,6 @@ for constraint in [
     )[1]
     ar_distributions[constraint]["values"] = samples[constraint]
 
-weights_20yr = np.ones(21)
-weights_20yr[0] = 0.5
-weights_20yr[-1] = 0.5
-weights_51yr = np.ones(52)
-weights_51yr[0] = 0.5
-weights_51yr[-1] = 0.5
-
 co2_1850 = 284.3169988
 co2_1920 = co2_1850 * 1.01**70  # NOT 2x (69.66 yr), per definition of TCRE
 mass_factor = 12.011 / molecular_weight_air * mass_atmosphere / 1e21
@@ -168,10 +131,7 @@ accepted = pd.DataFrame(
         "ECS": ecs_in[valid_temp],
         "TCR": tcr_in[valid_temp],
         "OHC": ohc_in[valid_temp] / 1e21,
-        "temperature 2003-2022": np.average(
-            temp_in[153:174, valid_temp], weights=weights_20yr, axis=0
-        )
-        - np.average(temp_in[:52, valid_temp], weights=weights_51yr, axis=0),
+        "temperature 2003-2022": warming_in[valid_temp],
         "ERFari": fari_in[valid_temp],
         "ERFaci": faci_in[valid_temp],
         "ERFaer": faer_in[valid_temp],
@@ -181,26 +141,86 @@ accepted = pd.DataFrame(
 )
 
 
-def calculate_sample_weights(distributions, samples, niterations=50):
-    weights = np.ones(samples.shape[0])
+def bin_samples(distributions, samples):
+    """Bin each constraint's samples and assessed distribution once.
+
+    Neither changes as the weights are updated. Samples are also sorted by bin, so that
+    the weight in each bin is a sum over a contiguous slice, in the same order as
+    summing the weights of the samples in the bin picked out with a mask.
+    """
+    binned = {}
+    for unique_code in distributions:
+        bin_edges = distributions[unique_code]["bins"]
+        our_values = samples[unique_code].values
+
+        our_values_bin_counts, bin_edges_np = np.histogram(our_values, bins=bin_edges)
+        np.testing.assert_allclose(bin_edges, bin_edges_np)
+        assessed_ranges_bin_counts, _ = np.histogram(
+            distributions[unique_code]["values"], bins=bin_edges
+        )
+
+        # digitize gives values in the range bin_edges[0] <= x < bin_edges[1] a
+        # digitized index of 1, so samples in bin i of the histogram are between
+        # bounds[i] and bounds[i + 1] in the sorted order
+        our_values_bin_idx = np.digitize(our_values, bins=bin_edges)
+        order = np.argsort(our_values_bin_idx, kind="stable")
+        bounds = np.searchsorted(
+            our_values_bin_idx[order], np.arange(1, bin_edges.shape[0] + 1)
+        )
+        np.testing.assert_equal(bounds[-1] - bounds[0], our_values_bin_counts.sum())
+
+        binned[unique_code] = {
+            "assessed_ranges_bin_counts": assessed_ranges_bin_counts,
+            "our_values_bin_idx": our_values_bin_idx,
+            "order": order,
+            "bounds": bounds,
+        }
+    return binned
+
+
+def calculate_sample_weights(
+    distributions,
+    samples,
+    niterations=50,
+    tolerance=None,
+    full_diagnostics=True,
+    prior_weights=None,
+):
+    """Weight samples so that their marginal distributions match the assessed ones.
+
+    If ``prior_weights`` is given, the samples start from these weights rather than
+    being weighted equally.
+
+    If ``tolerance`` is given, the iterations stop early, once the goodness of fit of
+    each constraint changes by less than this from one iteration to the next. The
+    constraints can conflict, so it does not necessarily go to zero. The goodness of
+    fit of every constraint after each update is only calculated with
+    ``full_diagnostics``; it is always calculated for the final weights.
+    """
+    binned = bin_samples(distributions, samples)
+    if prior_weights is None:
+        weights = np.ones(samples.shape[0])
+    else:
+        weights = np.array(prior_weights, dtype=float)
     gofs = []
     gofs_full = []
 
     unique_codes = list(distributions.keys())  # [::-1]
 
+    last_iteration = False
     for k in tqdm(
         range(niterations), desc="Iterations", leave=False, disable=1 - progress
     ):
         gofs.append([])
-        if k == (niterations - 1):
+        last_iteration = last_iteration or k == (niterations - 1)
+        if last_iteration:
             weights_second_last_iteration = weights.copy()
             weights_to_average = []
 
-        for j, unique_code in enumerate(unique_codes):
-            unique_code_weights, our_values_bin_idx = get_unique_code_weights(
-                unique_code, distributions, samples, weights, j, k
-            )
-            if k == (niterations - 1):
+        for unique_code in unique_codes:
+            our_values_bin_idx = binned[unique_code]["our_values_bin_idx"]
+            unique_code_weights = get_unique_code_weights(binned[unique_code], weights)
+            if last_iteration:
                 weights_to_average.append(unique_code_weights[our_values_bin_idx])
 
             weights *= unique_code_weights[our_values_bin_idx]
@@ -208,21 +228,31 @@ def calculate_sample_weights(distributions, samples, niterations=50):
             gof = ((unique_code_weights[1:-1] - 1) ** 2).sum()
             gofs[-1].append(gof)
 
-            gofs_full.append([unique_code])
-            for unique_code_check in unique_codes:
-                unique_code_check_weights, _ = get_unique_code_weights(
-                    unique_code_check, distributions, samples, weights, 1, 1
-                )
-                gof = ((unique_code_check_weights[1:-1] - 1) ** 2).sum()
-                gofs_full[-1].append(gof)
+            if full_diagnostics:
+                gofs_full.append([unique_code])
+                for unique_code_check in unique_codes:
+                    unique_code_check_weights = get_unique_code_weights(
+                        binned[unique_code_check], weights
+                    )
+                    gof = ((unique_code_check_weights[1:-1] - 1) ** 2).sum()
+                    gofs_full[-1].append(gof)
+
+        if last_iteration:
+            break
+        if (
+            tolerance is not None
+            and k > 0
+            and np.max(np.abs(np.subtract(gofs[-1], gofs[-2]))) < tolerance
+        ):
+            last_iteration = True
 
     weights_stacked = np.vstack(weights_to_average).mean(axis=0)
     weights_final = weights_stacked * weights_second_last_iteration
 
     gofs_full.append(["Final iteration"])
     for unique_code_check in unique_codes:
-        unique_code_check_weights, _ = get_unique_code_weights(
-            unique_code_check, distributions, samples, weights_final, 1, 1
+        unique_code_check_weights = get_unique_code_weights(
+            binned[unique_code_check], weights_final
         )
         gof = ((unique_code_check_weights[1:-1] - 1) ** 2).sum()
         gofs_full[-1].append(gof)
@@ -234,117 +264,225 @@ def calculate_sample_weights(distributions, samples, niterations=50):
     )
 
 
-def get_unique_code_weights(unique_code, distributions, samples, weights, j, k):
-    bin_edges = distributions[unique_code]["bins"]
-    our_values = samples[unique_code].copy()
+def get_unique_code_weights(binned, weights):
+    assessed_ranges_bin_counts = binned["assessed_ranges_bin_counts"]
+    bounds = binned["bounds"]
 
-    our_values_bin_counts, bin_edges_np = np.histogram(our_values, bins=bin_edges)
-    np.testing.assert_allclose(bin_edges, bin_edges_np)
-    assessed_ranges_bin_counts, _ = np.histogram(
-        distributions[unique_code]["values"], bins=bin_edges
+    sorted_weights = weights[binned["order"]]
+    existing_weighted_bin_counts = np.array(
+        [sorted_weights[start:end].sum() for start, end in zip(bounds[:-1], bounds[1:])]
     )
 
-    our_values_bin_idx = np.digitize(our_values, bins=bin_edges)
-
-    existing_weighted_bin_counts = np.nan * np.zeros(our_values_bin_counts.shape[0])
-    for i in range(existing_weighted_bin_counts.shape[0]):
-        existing_weighted_bin_counts[i] = weights[(our_values_bin_idx == i + 1)].sum()
+    unique_code_weights = np.zeros(bounds.shape[0] + 1)
 
-    if np.equal(j, 0) and np.equal(k, 0):
-        np.testing.assert_equal(
-            existing_weighted_bin_counts.sum(), our_values_bin_counts.sum()
+    # unique_code_weights[0] refers to samples outside the assessed range's lower
+    # bound. Accordingly, if `our_values` was digitized into a bin idx of zero, it
+    # should get a weight of zero. Similarly, if `our_values` was digitized into a bin
+    # idx greater than the number of bins then it was outside the assessed range so
+    # gets a weight of zero. Within the range, bins with no assessed samples get a
+    # weight of zero, and if other variables force a bin to be empty it is just filled
+    # with one.
+    with np.errstate(divide="ignore", invalid="ignore"):
+        unique_code_weights[1:-1] = np.where(
+            assessed_ranges_bin_counts == 0,
+            0,
+            np.where(
+                existing_weighted_bin_counts == 0,
+                1,
+                assessed_ranges_bin_counts / existing_weighted_bin_counts,
+            ),
         )
 
-    unique_code_weights = np.nan * np.zeros(bin_edges.shape[0] + 1)
-
-    # existing_weighted_bin_counts[0] refers to samples outside the
-    # assessed range's lower bound. Accordingly, if `our_values` was
-    # digitized into a bin idx of zero, it should get a weight of zero.
-    unique_code_weights[0] = 0
-    # Similarly, if `our_values` was digitized into a bin idx greater
-    # than the number of bins then it was outside the assessed range
-    # so get a weight of zero.
-    unique_code_weights[-1] = 0
-
-    for i in range(1, our_values_bin_counts.shape[0] + 1):
-        # the histogram idx is one less because digitize gives values in the
-        # range bin_edges[0] <= x < bin_edges[1] a digitized index of 1
-        histogram_idx = i - 1
-        if np.equal(assessed_ranges_bin_counts[histogram_idx], 0):
-            unique_code_weights[i] = 0
-        elif np.equal(existing_weighted_bin_counts[histogram_idx], 0):
-            # other variables force this box to be zero so just fill it with
-            # one
-            unique_code_weights[i] = 1
-        else:
-            unique_code_weights[i] = (
-                assessed_ranges_bin_counts[histogram_idx]
-                / existing_weighted_bin_counts[histogram_idx]
+    return unique_code_weights
+
+
+def calculate_sample_weights_entropy(
+    distributions, samples, regularisation=1e-7, maxiter=5000, prior_weights=None
+):
+    """Maximum-entropy sample weights that match the assessed distributions.
+
+    Instead of cycling through the constraints as ``calculate_sample_weights`` does,
+    this solves for the weights closest to uniform, in relative entropy, whose
+    histograms match those of all of the assessed distributions at once. Samples
+    outside the assessed range of any constraint, or in a bin with no assessed
+    samples, get a weight of zero as before. The optimisation is over the dual
+    problem, which has one variable for each bin of each constraint, so adding
+    constraints is cheap. If the histograms cannot all be matched exactly, the dual
+    problem is unbounded; ``regularisation`` keeps it bounded, at the expense of
+    matching them less closely. If ``prior_weights`` is given, the weights are the
+    closest to these instead of to uniform.
+
+    Returns are as for ``calculate_sample_weights``, with the goodness of fit after
+    each iteration of the optimiser in place of each iteration of reweighting. Weights
+    are scaled to sum to the mean number of assessed samples that are matched.
+    """
+    binned = bin_samples(distributions, samples)
+    unique_codes = list(distributions.keys())
+
+    # assessed counts in each digitized bin idx, including those outside the range
+    assessed = [
+        np.concatenate([[0], binned[unique_code]["assessed_ranges_bin_counts"], [0]])
+        for unique_code in unique_codes
+    ]
+    valid = np.ones(samples.shape[0], dtype=bool)
+    for unique_code, assessed_counts in zip(unique_codes, assessed):
+        valid &= assessed_counts[binned[unique_code]["our_values_bin_idx"]] > 0
+    log_prior = 0
+    if prior_weights is not None:
+        valid &= np.asarray(prior_weights) > 0
+        log_prior = np.log(np.asarray(prior_weights)[valid])
+
+    # the dual variables of all constraints are in one vector, and each valid sample
+    # has one of them per constraint. Only bins that contain samples can be matched.
+    offsets = np.cumsum([0] + [len(assessed_counts) for assessed_counts in assessed])
+    dual_idx = np.array(
+        [
+            binned[unique_code]["our_values_bin_idx"][valid] + offset
+            for unique_code, offset in zip(unique_codes, offsets)
+        ]
+    )
+    matched = np.bincount(dual_idx.ravel(), minlength=offsets[-1]) > 0
+    targets = np.where(matched, np.concatenate(assessed), 0.0)
+    scale = targets.sum() / len(unique_codes)
+    for start, end in zip(offsets[:-1], offsets[1:]):
+        targets[start:end] = targets[start:end] / targets[start:end].sum()
+
+    def shares(dual):
+        """Share of the total weight of each valid sample, and log of the total."""
+        log_weights = dual[dual_idx].sum(axis=0) + log_prior
+        shift = log_weights.max()
+        weights = np.exp(log_weights - shift)
+        return weights / weights.sum(), shift + np.log(weights.sum())
+
+    def objective(dual):
+        share, log_total = shares(dual)
+        value = log_total - dual @ targets + 0.5 * regularisation * dual @ dual
+        gradient = (
+            np.bincount(
+                dual_idx.ravel(),
+                weights=np.tile(share, len(unique_codes)),
+                minlength=offsets[-1],
             )
+            - targets
+            + regularisation * dual
+        )
+        return value, gradient
 
-    return unique_code_weights, our_values_bin_idx
+    def sample_weights(dual):
+        weights = np.zeros(samples.shape[0])
+        weights[valid] = shares(dual)[0] * scale
+        return weights
 
+    def goodness_of_fit(weights):
+        gof = []
+        for unique_code in unique_codes:
+            unique_code_weights = get_unique_code_weights(binned[unique_code], weights)
+            gof.append(((unique_code_weights[1:-1] - 1) ** 2).sum())
+        return gof
 
-weights, gofs, gofs_full = calculate_sample_weights(
-    ar_distributions, accepted, niterations=30
-)
+    gofs = []
+    result = scipy.optimize.minimize(
+        objective,
+        np.zeros(offsets[-1]),
+        jac=True,
+        method="L-BFGS-B",
+        callback=lambda dual: gofs.append(goodness_of_fit(sample_weights(dual))),
+        options={"maxiter": maxiter, "ftol": 1e-12, "gtol": 1e-9},
+    )
+    if not result.success:
+        print("Maximum-entropy reweighting did not converge:", result.message)
+
+    weights_final = sample_weights(result.x)
+    gofs_full = [["Final iteration"] + goodness_of_fit(weights_final)]
+    return (
+        weights_final,
+        pd.DataFrame(
+            np.array(gofs).reshape(-1, len(unique_codes)), columns=unique_codes
+        ),
+        pd.DataFrame(np.array(gofs_full), columns=["Target marginal"] + unique_codes),
+    )
+
+
+# REWEIGHTING chooses the method; the goodness of fit after each update of the
+# histogram method is not used, so is not calculated
+if reweighting == "histogram":
+    weights, gofs, gofs_full = calculate_sample_weights(
+        ar_distributions,
+        accepted,
+        niterations=30,
+        full_diagnostics=False,
+        prior_weights=prior_weights[valid_temp],
+    )
+elif reweighting == "entropy":
+    weights, gofs, gofs_full = calculate_sample_weights_entropy(
+        ar_distributions, accepted, prior_weights=prior_weights[valid_temp]
+    )
+else:
+    raise ValueError(f"REWEIGHTING should be histogram or entropy, not {reweighting}")
 
 effective_samples = int(np.floor(np.sum(np.minimum(weights, 1))))
 print("Number of effective samples:", effective_samples)
 
 assert effective_samples >= output_ensemble_size
 
-draws = []
-drawn_samples = accepted.sample(
-    n=output_ensemble_size, replace=False, weights=weights, random_state=10099
-)
-draws.append((drawn_samples))
-
-target_ecs = scipy.stats.gaussian_kde(samples["ECS"])
-prior_ecs = scipy.stats.gaussian_kde(ecs_in)
-post1_ecs = scipy.stats.gaussian_kde(ecs_in[valid_temp])
-post2_ecs = scipy.stats.gaussian_kde(draws[0]["ECS"])
-
-target_tcr = scipy.stats.gaussian_kde(samples["TCR"])
-prior_tcr = scipy.stats.gaussian_kde(tcr_in)
-post1_tcr = scipy.stats.gaussian_kde(tcr_in[valid_temp])
-post2_tcr = scipy.stats.gaussian_kde(draws[0]["TCR"])
-
-target_temp = scipy.stats.gaussian_kde(samples["temperature 2003-2022"])
-prior_temp = scipy.stats.gaussian_kde(
-    np.average(temp_in[153:174, :], weights=weights_20yr, axis=0)
-    - np.average(temp_in[:52, :], weights=weights_51yr, axis=0)
+# the weights are saved, so that posteriors of other sizes, or more of them, can be
+# drawn without reweighting again (see draw_posterior.py)
+os.makedirs(
+    f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/posteriors",
+    exist_ok=True,
 )
-post1_temp = scipy.stats.gaussian_kde(
-    np.average(temp_in[153:174, valid_temp], weights=weights_20yr, axis=0)
-    - np.average(temp_in[:52, valid_temp], weights=weights_51yr, axis=0)
+_save_posterior_weights(
+    f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/posteriors/"
+    "runids_rmse_pass_weights.csv",
+    accepted.index,
+    weights,
 )
-post2_temp = scipy.stats.gaussian_kde(draws[0]["temperature 2003-2022"])
-
-target_ohc = scipy.stats.gaussian_kde(samples["OHC"])
-prior_ohc = scipy.stats.gaussian_kde(ohc_in / 1e21)
-post1_ohc = scipy.stats.gaussian_kde(ohc_in[valid_temp] / 1e21)
-post2_ohc = scipy.stats.gaussian_kde(draws[0]["OHC"])
 
-target_aer = scipy.stats.gaussian_kde(samples["ERFaer"])
-prior_aer = scipy.stats.gaussian_kde(faer_in)
-post1_aer = scipy.stats.gaussian_kde(faer_in[valid_temp])
-post2_aer = scipy.stats.gaussian_kde(draws[0]["ERFaer"])
-
-target_aci = scipy.stats.gaussian_kde(samples["ERFaci"])
-prior_aci = scipy.stats.gaussian_kde(faci_in)
-post1_aci = scipy.stats.gaussian_kde(faci_in[valid_temp])
-post2_aci = scipy.stats.gaussian_kde(draws[0]["ERFaci"])
-
-target_ari = scipy.stats.gaussian_kde(samples["ERFari"])
-prior_ari = scipy.stats.gaussian_kde(fari_in)
-post1_ari = scipy.stats.gaussian_kde(fari_in[valid_temp])
-post2_ari = scipy.stats.gaussian_kde(draws[0]["ERFari"])
+draws = []
+drawn_samples = accepted.loc[
+    _draw_posterior(accepted.index, weights, output_ensemble_size)[0]
+]
+draws.append((drawn_samples))
 
-target_co2 = scipy.stats.gaussian_kde(samples["CO2 concentration"])
-prior_co2 = scipy.stats.gaussian_kde(co2_in)
-post1_co2 = scipy.stats.gaussian_kde(co2_in[valid_temp])
-post2_co2 = scipy.stats.gaussian_kde(draws[0]["CO2 concentration"])
+target_ecs = _binned_kde(samples["ECS"])
+prior_ecs = _binned_kde(ecs_in[prior_members], prior_weights[prior_members])
+post1_ecs = _binned_kde(ecs_in[valid_temp], prior_weights[valid_temp])
+post2_ecs = _binned_kde(draws[0]["ECS"])
+
+target_tcr = _binned_kde(samples["TCR"])
+prior_tcr = _binned_kde(tcr_in[prior_members], prior_weights[prior_members])
+post1_tcr = _binned_kde(tcr_in[valid_temp], prior_weights[valid_temp])
+post2_tcr = _binned_kde(draws[0]["TCR"])
+
+target_temp = _binned_kde(samples["temperature 2003-2022"])
+prior_temp = _binned_kde(warming_in[prior_members], prior_weights[prior_members])
+post1_temp = _binned_kde(warming_in[valid_temp], prior_weights[valid_temp])
+post2_temp = _binned_kde(draws[0]["temperature 2003-2022"])
+
+target_ohc = _binned_kde(samples["OHC"])
+prior_ohc = _binned_kde(ohc_in[prior_members] / 1e21, prior_weights[prior_members])
+post1_ohc = _binned_kde(ohc_in[valid_temp] / 1e21, prior_weights[valid_temp])
+post2_ohc = _binned_kde(draws[0]["OHC"])
+
+target_aer = _binned_kde(samples["ERFaer"])
+prior_aer = _binned_kde(faer_in[prior_members], prior_weights[prior_members])
+post1_aer = _binned_kde(faer_in[valid_temp], prior_weights[valid_temp])
+post2_aer = _binned_kde(draws[0]["ERFaer"])
+
+target_aci = _binned_kde(samples["ERFaci"])
+prior_aci = _binned_kde(faci_in[prior_members], prior_weights[prior_members])
+post1_aci = _binned_kde(faci_in[valid_temp], prior_weights[valid_temp])
+post2_aci = _binned_kde(draws[0]["ERFaci"])
+
+target_ari = _binned_kde(samples["ERFari"])
+prior_ari = _binned_kde(fari_in[prior_members], prior_weights[prior_members])
+post1_ari = _binned_kde(fari_in[valid_temp], prior_weights[valid_temp])
+post2_ari = _binned_kde(draws[0]["ERFari"])
+
+target_co2 = _binned_kde(samples["CO2 concentration"])
+prior_co2 = _binned_kde(co2_in[prior_members], prior_weights[prior_members])
+post1_co2 = _binned_kde(co2_in[valid_temp], prior_weights[valid_temp])
+post2_co2 = _binned_kde(draws[0]["CO2 concentration"])
 
 colors = {"prior": "#207F6E", "post1": "#684C94", "post2": "#EE696B", "target": "black"}
 
@@ -721,63 +859,40 @@ if plots:
     df_gmst = pd.read_csv("../../../../../data/forcing/IGCC_GMST_1850-2022.csv")
     gmst = df_gmst["gmst"].values
 
+    # the full temperature time series of the members that pass the RMSE constraint
+    fan = _fan_trajectories(
+        f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/prior_runs/"
+        "temperature_1850-2101",
+        draws[0].index,
+        cache=f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/"
+        "prior_runs/fans/posterior.npz",
+    )
+
     fig, ax = pl.subplots(figsize=(5, 5))
     ax.fill_between(
         np.arange(1850, 2102),
-        np.min(
-            temp_in[:, draws[0].index]
-            - np.average(temp_in[:52, draws[0].index], weights=weights_51yr, axis=0),
-            axis=1,
-        ),
-        np.max(
-            temp_in[:, draws[0].index]
-            - np.average(temp_in[:52, draws[0].index], weights=weights_51yr, axis=0),
-            axis=1,
-        ),
+        fan["min"],
+        fan["max"],
         color="#000000",
         alpha=0.2,
     )
     ax.fill_between(
         np.arange(1850, 2102),
-        np.percentile(
-            temp_in[:, draws[0].index]
-            - np.average(temp_in[:52, draws[0].index], weights=weights_51yr, axis=0),
-            5,
-            axis=1,
-        ),
-        np.percentile(
-            temp_in[:, draws[0].index]
-            - np.average(temp_in[:52, draws[0].index], weights=weights_51yr, axis=0),
-            95,
-            axis=1,
-        ),
+        fan["p5"],
+        fan["p95"],
         color="#000000",
         alpha=0.2,
     )
     ax.fill_between(
         np.arange(1850, 2102),
-        np.percentile(
-            temp_in[:, draws[0].index]
-            - np.average(temp_in[:52, draws[0].index], weights=weights_51yr, axis=0),
-            16,
-            axis=1,
-        ),
-        np.percentile(
-            temp_in[:, draws[0].index]
-            - np.average(temp_in[:52, draws[0].index], weights=weights_51yr, axis=0),
-            84,
-            axis=1,
-        ),
+        fan["p16"],
+        fan["p84"],
         color="#000000",
         alpha=0.2,
     )
     ax.plot(
         np.arange(1850, 2102),
-        np.median(
-            temp_in[:, draws[0].index]
-            - np.average(temp_in[:52, draws[0].index], weights=weights_51yr, axis=0),
-            axis=1,
-        ),
+        fan["p50"],
         color="#000000",
     )
 
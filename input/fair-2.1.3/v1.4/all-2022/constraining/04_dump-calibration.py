@@ -9,6 +9,7 @@ import numpy as np
 import pandas as pd
 from dotenv import load_dotenv
 from fair import __version__
+from utils import _load_prior
 
 load_dotenv()
 
@@ -22,42 +23,50 @@ output_ensemble_size = int(os.getenv("POSTERIOR_SAMPLES"))
 
 assert fair_v == __version__
 
-df_cc = pd.read_csv(
+valid_all = np.loadtxt(
+    f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/posteriors/"
+    "runids_rmse_reweighted_pass.csv"
+).astype(
+    np.int64
+)  # [:1000]
+valid_all
+
+# only the constrained ensemble members are read from the prior parameter store
+df_cc = _load_prior(
     f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/priors/"
-    "carbon_cycle.csv"
+    "carbon_cycle",
+    valid_all,
 )
-df_cr = pd.read_csv(
+df_cr = _load_prior(
     f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/priors/"
-    "climate_response_ebm3.csv"
+    "climate_response_ebm3",
+    valid_all,
 )
-df_aci = pd.read_csv(
+df_aci = _load_prior(
     f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/priors/"
-    "aerosol_cloud.csv"
+    "aerosol_cloud",
+    valid_all,
 )
-df_ari = pd.read_csv(
+df_ari = _load_prior(
     f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/priors/"
-    "aerosol_radiation.csv"
+    "aerosol_radiation",
+    valid_all,
 )
-df_ozone = pd.read_csv(
-    f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/priors/ozone.csv"
+df_ozone = _load_prior(
+    f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/priors/ozone",
+    valid_all,
 )
-df_scaling = pd.read_csv(
+df_scaling = _load_prior(
     f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/priors/"
-    "forcing_scaling.csv"
+    "forcing_scaling",
+    valid_all,
 )
-df_1750co2 = pd.read_csv(
+df_1750co2 = _load_prior(
     f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/priors/"
-    "co2_concentration_1750.csv"
+    "co2_concentration_1750",
+    valid_all,
 )
 
-valid_all = np.loadtxt(
-    f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/posteriors/"
-    "runids_rmse_reweighted_pass.csv"
-).astype(
-    np.int64
-)  # [:1000]
-valid_all
-
 seed = 1355763 + 399 * valid_all
 seed
 
@@ -14,6 +14,7 @@ from dotenv import load_dotenv
 from fair import FAIR
 from fair.interface import fill, initialise
 from fair.io import read_properties
+from utils import _fan
 
 pl.switch_backend("agg")
 
@@ -388,65 +389,36 @@ gmst = df_gmst["gmst"].values
 if plots:
     fig, ax = pl.subplots(2, 4, figsize=(18 / 2.54, 8 / 2.54))
     for i in range(8):
+        fan = _fan(
+            f.temperature[:, i, :, 0], f.temperature[100:151, i, :, 0].mean(axis=0)
+        )
         ax[i // 4, i % 4].fill_between(
             np.arange(1750.5, 2301),
-            np.min(
-                f.temperature[:, i, :, 0]
-                - f.temperature[100:151, i, :, 0].mean(axis=0),
-                axis=1,
-            ),
-            np.max(
-                f.temperature[:, i, :, 0]
-                - f.temperature[100:151, i, :, 0].mean(axis=0),
-                axis=1,
-            ),
+            fan["min"],
+            fan["max"],
             color=ar6_colors[scenarios[i]],
             alpha=0.2,
             lw=0,
         )
         ax[i // 4, i % 4].fill_between(
             np.arange(1750.5, 2301),
-            np.percentile(
-                f.temperature[:, i, :, 0]
-                - f.temperature[100:151, i, :, 0].mean(axis=0),
-                5,
-                axis=1,
-            ),
-            np.percentile(
-                f.temperature[:, i, :, 0]
-                - f.temperature[100:151, i, :, 0].mean(axis=0),
-                95,
-                axis=1,
-            ),
+            fan["p5"],
+            fan["p95"],
             color=ar6_colors[scenarios[i]],
             alpha=0.2,
             lw=0,
         )
         ax[i // 4, i % 4].fill_between(
             np.arange(1750.5, 2301),
-            np.percentile(
-                f.temperature[:, i, :, 0]
-                - f.temperature[100:151, i, :, 0].mean(axis=0),
-                16,
-                axis=1,
-            ),
-            np.percentile(
-                f.temperature[:, i, :, 0]
-                - f.temperature[100:151, i, :, 0].mean(axis=0),
-                84,
-                axis=1,
-            ),
+            fan["p16"],
+            fan["p84"],
             color=ar6_colors[scenarios[i]],
             alpha=0.2,
             lw=0,
         )
         ax[i // 4, i % 4].plot(
             np.arange(1750.5, 2301),
-            np.median(
-                f.temperature[:, i, :, 0]
-                - f.temperature[100:151, i, :, 0].mean(axis=0),
-                axis=1,
-            ),
+            fan["p50"],
             color=ar6_colors[scenarios[i]],
             lw=1,
         )
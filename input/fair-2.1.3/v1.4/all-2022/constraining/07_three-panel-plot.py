@@ -13,6 +13,7 @@ from dotenv import load_dotenv
 from fair import __version__
 from matplotlib.lines import Line2D
 from matplotlib.patches import Patch
+from utils import _fan_trajectories
 
 # if we're not plotting, don't even start
 load_dotenv()
@@ -32,6 +33,7 @@ fair_v = os.getenv("FAIR_VERSION")
 constraint_set = os.getenv("CONSTRAINT_SET")
 samples = int(os.getenv("PRIOR_SAMPLES"))
 progress = os.getenv("PROGRESS", "False").lower() in ("true", "1", "t")
+trajectory_stride = int(os.getenv("TRAJECTORY_STRIDE", 100))
 
 assert fair_v == __version__
 
@@ -41,65 +43,62 @@ step1 = np.loadtxt(
     "runids_rmse_pass.csv",
     dtype="int",
 )
-accept_step1 = np.zeros(samples, dtype=bool)
-accept_step1[step1] = True
 
 step2 = np.loadtxt(
     f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/posteriors/"
     "runids_rmse_reweighted_pass.csv",
     dtype="int",
 )
-accept_step2 = np.zeros(samples, dtype=bool)
-accept_step2[step2] = True
 
-temp_in = np.load(
+# the full temperature time series is kept for a sample of the prior, every
+# TRAJECTORY_STRIDE-th ensemble member, and the members that pass the RMSE constraint.
+# Summaries of them for fan plots are shared with constraining/01 and 03.
+trajectory_dir = (
     f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/prior_runs/"
-    "temperature_1850-2101.npy"
+    "temperature_1850-2101"
 )
+fan_dir = (
+    f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/prior_runs/fans"
+)
+fan_prior = _fan_trajectories(
+    trajectory_dir,
+    np.arange(0, samples, trajectory_stride),
+    cache=f"{fan_dir}/prior.npz",
+)
+fan_step1 = _fan_trajectories(trajectory_dir, step1, cache=f"{fan_dir}/rmse_pass.npz")
+fan_step2 = _fan_trajectories(trajectory_dir, step2, cache=f"{fan_dir}/posterior.npz")
 
 df_gmst = pd.read_csv("../../../../../data/forcing/IGCC_GMST_1850-2022.csv")
 gmst = df_gmst["gmst"].values
 
-weights = np.ones(52)
-weights[0] = 0.5
-weights[-1] = 0.5
-
 fig, ax = pl.subplots(1, 3, figsize=(18 / 2.54, 6 / 2.54))
 ax[0].fill_between(
     np.arange(1850, 2102),
-    np.min(temp_in - np.average(temp_in[:52, :], weights=weights, axis=0), axis=1),
-    np.max(temp_in - np.average(temp_in[:52, :], weights=weights, axis=0), axis=1),
+    fan_prior["min"],
+    fan_prior["max"],
     color="#000000",
     alpha=0.2,
     lw=0,
 )
 ax[0].fill_between(
     np.arange(1850, 2102),
-    np.percentile(
-        temp_in - np.average(temp_in[:52, :], weights=weights, axis=0), 5, axis=1
-    ),
-    np.percentile(
-        temp_in - np.average(temp_in[:52, :], weights=weights, axis=0), 95, axis=1
-    ),
+    fan_prior["p5"],
+    fan_prior["p95"],
     color="#000000",
     alpha=0.2,
     lw=0,
 )
 ax[0].fill_between(
     np.arange(1850, 2102),
-    np.percentile(
-        temp_in - np.average(temp_in[:52, :], weights=weights, axis=0), 16, axis=1
-    ),
-    np.percentile(
-        temp_in - np.average(temp_in[:52, :], weights=weights, axis=0), 84, axis=1
-    ),
+    fan_prior["p16"],
+    fan_prior["p84"],
     color="#000000",
     alpha=0.2,
     lw=0,
 )
 ax[0].plot(
     np.arange(1850, 2102),
-    np.median(temp_in - np.average(temp_in[:52, :], weights=weights, axis=0), axis=1),
+    fan_prior["p50"],
     color="#000000",
     lw=1,
 )
@@ -113,63 +112,31 @@ ax[0].set_title("(a) Prior")
 
 ax[1].fill_between(
     np.arange(1850, 2102),
-    np.min(
-        temp_in[:, accept_step1]
-        - np.average(temp_in[:52, accept_step1], weights=weights, axis=0),
-        axis=1,
-    ),
-    np.max(
-        temp_in[:, accept_step1]
-        - np.average(temp_in[:52, accept_step1], weights=weights, axis=0),
-        axis=1,
-    ),
+    fan_step1["min"],
+    fan_step1["max"],
     color="#000000",
     alpha=0.2,
     lw=0,
 )
 ax[1].fill_between(
     np.arange(1850.5, 2102),
-    np.percentile(
-        temp_in[:, accept_step1]
-        - np.average(temp_in[:52, accept_step1], weights=weights, axis=0),
-        5,
-        axis=1,
-    ),
-    np.percentile(
-        temp_in[:, accept_step1]
-        - np.average(temp_in[:52, accept_step1], weights=weights, axis=0),
-        95,
-        axis=1,
-    ),
+    fan_step1["p5"],
+    fan_step1["p95"],
     color="#000000",
     alpha=0.2,
     lw=0,
 )
 ax[1].fill_between(
     np.arange(1850.5, 2102),
-    np.percentile(
-        temp_in[:, accept_step1]
-        - np.average(temp_in[:52, accept_step1], weights=weights, axis=0),
-        16,
-        axis=1,
-    ),
-    np.percentile(
-        temp_in[:, accept_step1]
-        - np.average(temp_in[:52, accept_step1], weights=weights, axis=0),
-        84,
-        axis=1,
-    ),
+    fan_step1["p16"],
+    fan_step1["p84"],
     color="#000000",
     alpha=0.2,
     lw=0,
 )
 ax[1].plot(
     np.arange(1850.5, 2102),
-    np.median(
-        temp_in[:, accept_step1]
-        - np.average(temp_in[:52, accept_step1], weights=weights, axis=0),
-        axis=1,
-    ),
+    fan_step1["p50"],
     color="#000000",
     lw=1,
 )
@@ -182,63 +149,31 @@ ax[1].set_title("(b) After RMSE constraint")
 
 ax[2].fill_between(
     np.arange(1850, 2102),
-    np.min(
-        temp_in[:, accept_step2]
-        - np.average(temp_in[:52, accept_step2], weights=weights, axis=0),
-        axis=1,
-    ),
-    np.max(
-        temp_in[:, accept_step2]
-        - np.average(temp_in[:52, accept_step2], weights=weights, axis=0),
-        axis=1,
-    ),
+    fan_step2["min"],
+    fan_step2["max"],
     color="#000000",
     alpha=0.2,
     lw=0,
 )
 ax[2].fill_between(
     np.arange(1850, 2102),
-    np.percentile(
-        temp_in[:, accept_step2]
-        - np.average(temp_in[:52, accept_step2], weights=weights, axis=0),
-        5,
-        axis=1,
-    ),
-    np.percentile(
-        temp_in[:, accept_step2]
-        - np.average(temp_in[:52, accept_step2], weights=weights, axis=0),
-        95,
-        axis=1,
-    ),
+    fan_step2["p5"],
+    fan_step2["p95"],
     color="#000000",
     alpha=0.2,
     lw=0,
 )
 ax[2].fill_between(
     np.arange(1850, 2102),
-    np.percentile(
-        temp_in[:, accept_step2]
-        - np.average(temp_in[:52, accept_step2], weights=weights, axis=0),
-        16,
-        axis=1,
-    ),
-    np.percentile(
-        temp_in[:, accept_step2]
-        - np.average(temp_in[:52, accept_step2], weights=weights, axis=0),
-        84,
-        axis=1,
-    ),
+    fan_step2["p16"],
+    fan_step2["p84"],
     color="#000000",
     alpha=0.2,
     lw=0,
 )
 ax[2].plot(
     np.arange(1850, 2102),
-    np.median(
-        temp_in[:, accept_step2]
-        - np.average(temp_in[:52, accept_step2], weights=weights, axis=0),
-        axis=1,
-    ),
+    fan_step2["p50"],
     color="#000000",
     lw=1,
 )
@@ -8,9 +8,9 @@ import sys
 
 import matplotlib.pyplot as pl
 import numpy as np
-import pandas as pd
 from dotenv import load_dotenv
 from fair import __version__
+from utils import _load_prior
 
 # if we're not plotting, don't even start
 load_dotenv()
@@ -55,32 +55,32 @@ accept_step2[step2] = True
 
 colors = {"prior": "#207F6E", "post1": "#684C94", "post2": "#EE696B", "target": "black"}
 
-df_cc = pd.read_csv(
+df_cc = _load_prior(
     f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/priors/"
-    "carbon_cycle.csv"
+    "carbon_cycle"
 )
-df_cr = pd.read_csv(
+df_cr = _load_prior(
     f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/priors/"
-    "climate_response_ebm3.csv"
+    "climate_response_ebm3"
 )
-df_aci = pd.read_csv(
+df_aci = _load_prior(
     f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/priors/"
-    "aerosol_cloud.csv"
+    "aerosol_cloud"
 )
-df_ari = pd.read_csv(
+df_ari = _load_prior(
     f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/priors/"
-    "aerosol_radiation.csv"
+    "aerosol_radiation"
 )
-df_ozone = pd.read_csv(
-    f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/priors/" "ozone.csv"
+df_ozone = _load_prior(
+    f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/priors/" "ozone"
 )
-df_scaling = pd.read_csv(
+df_scaling = _load_prior(
     f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/priors/"
-    "forcing_scaling.csv"
+    "forcing_scaling"
 )
-df_1750co2 = pd.read_csv(
+df_1750co2 = _load_prior(
     f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/priors/"
-    "co2_concentration_1750.csv"
+    "co2_concentration_1750"
 )
 
 negative_only_beta = df_aci.loc[:, "beta"].values
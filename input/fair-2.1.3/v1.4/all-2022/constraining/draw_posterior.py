@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Draw posterior ensembles from the saved weights"""
+
+# constraining/03 saves the weight of every ensemble member that passes the RMSE
+# constraint, and draws one posterior of POSTERIOR_SAMPLES members from them. This
+# draws POSTERIOR_DRAWS independent posteriors of POSTERIOR_SAMPLES members from the
+# same weights without reweighting again, e.g.
+#
+#     POSTERIOR_SAMPLES=2000 POSTERIOR_DRAWS=10 ./draw_posterior.py
+#
+# The first draw of POSTERIOR_SAMPLES members is the one that 03 makes.
+#
+# This is not part of the workflow. Run it from this directory after constraining/03.
+
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from dotenv import load_dotenv
+from utils import _draw_posterior, _load_posterior_weights
+
+if __name__ == "__main__":
+    load_dotenv()
+
+    cal_v = os.getenv("CALIBRATION_VERSION")
+    fair_v = os.getenv("FAIR_VERSION")
+    constraint_set = os.getenv("CONSTRAINT_SET")
+    output_ensemble_size = int(os.getenv("POSTERIOR_SAMPLES"))
+    posterior_draws = int(os.getenv("POSTERIOR_DRAWS", 1))
+    WORKERS = min(multiprocessing.cpu_count(), int(os.getenv("WORKERS")))
+
+    print(f"Drawing {posterior_draws} posteriors of {output_ensemble_size}...")
+
+    runids, weights = _load_posterior_weights(
+        f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/posteriors/"
+        "runids_rmse_pass_weights.csv"
+    )
+
+    effective_samples = int(np.floor(np.sum(np.minimum(weights, 1))))
+    print("Number of effective samples:", effective_samples)
+
+    assert effective_samples >= output_ensemble_size
+
+    if posterior_draws > 1 and WORKERS > 1:
+        with ProcessPoolExecutor(min(WORKERS, posterior_draws)) as pool:
+            draws = _draw_posterior(
+                runids, weights, output_ensemble_size, posterior_draws, pool=pool
+            )
+    else:
+        draws = _draw_posterior(runids, weights, output_ensemble_size, posterior_draws)
+
+    os.makedirs(
+        f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/posteriors/"
+        "draws",
+        exist_ok=True,
+    )
+    for i, draw in enumerate(draws):
+        np.savetxt(
+            f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/posteriors/"
+            f"draws/runids_rmse_reweighted_pass_{output_ensemble_size}_{i}.csv",
+            sorted(draw),
+            fmt="%d",
+        )
@@ -1,14 +1,17 @@
 # put imports outside: we don't have a lot of overhead here, and it looks nicer.
 import os
-import warnings
 
 import numpy as np
 import xarray as xr
 from dotenv import load_dotenv
-from fair import FAIR
-from fair.interface import fill, initialise
-from fair.io import read_properties
-from scipy.interpolate import interp1d
+from utils import (
+    _attach_arrays,
+    _open_prior_columns,
+    _PhaseTimer,
+    _run_idealised,
+    _share_arrays,
+    idealised_outputs,
+)
 
 load_dotenv()
 
@@ -16,118 +19,139 @@ cal_v = os.getenv("CALIBRATION_VERSION")
 fair_v = os.getenv("FAIR_VERSION")
 constraint_set = os.getenv("CONSTRAINT_SET")
 
+output_dir = (
+    f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/prior_runs/"
+)
 
-def run_fair(cfg):
-    scenarios = ["1pctCO2"]
-    batch_start = cfg["batch_start"]
-    batch_end = cfg["batch_end"]
-    batch_size = batch_end - batch_start
+# each batch writes its slice of these straight to disk. Values are (filename, shape of
+# the output for one ensemble member); ensemble member is the last dimension of each
+# file, in the order of runids_rmse_pass.csv.
+outputs = idealised_outputs["1pctCO2"]
+
+manifest_file = os.path.join(output_dir, "1pctCO2_manifest.json")
+# if TIMING is set, how long each batch took, and a summary
+timing_file = os.path.join(output_dir, "1pctCO2_timing.json")
+
+
+def output_files():
+    return [os.path.join(output_dir, filename) for filename, _ in outputs.values()]
 
-    species, properties = read_properties()
 
+def allocate_outputs(samples):
+    """Create the NaN-filled, memory-mapped output files for the 1pctCO2 runs."""
+    os.makedirs(output_dir, exist_ok=True)
+    for filename, member_shape in outputs.values():
+        shape = member_shape + (samples,)
+        out = np.lib.format.open_memmap(
+            os.path.join(output_dir, filename), mode="w+", dtype=np.float64, shape=shape
+        )
+        out[:] = np.nan
+        out.flush()
+        del out
+
+
+def write_outputs(batch_start, batch_end, **results):
+    """Write one batch's results into its slice of each output file."""
+    for name, data in results.items():
+        out = np.load(os.path.join(output_dir, outputs[name][0]), mmap_mode="r+")
+        out[..., batch_start:batch_end] = data
+        out.flush()
+        del out
+
+
+# read-only inputs and prior parameters, memory-mapped by each worker in
+# ``init_worker``.
+_inputs = {}
+
+# where ``publish_inputs`` last published the inputs, for batches run in the process
+# that published them, such as the FRONT_SERIAL ones, to attach to
+_published = {}
+
+# if TIMING is set, how long this worker took to start, which is reported with the
+# first batch that it runs
+_init_timings = {}
+
+
+# columns of the prior parameter store: the name used for each parameter in a batch,
+# and the prior and column in its store that it is read from.
+prior_columns = {
+    "c1": ("climate_response_ebm3", "c1"),
+    "c2": ("climate_response_ebm3", "c2"),
+    "c3": ("climate_response_ebm3", "c3"),
+    "kappa1": ("climate_response_ebm3", "kappa1"),
+    "kappa2": ("climate_response_ebm3", "kappa2"),
+    "kappa3": ("climate_response_ebm3", "kappa3"),
+    "epsilon": ("climate_response_ebm3", "epsilon"),
+    "gamma": ("climate_response_ebm3", "gamma"),
+    "forcing_4co2": ("climate_response_ebm3", "F_4xCO2"),
+    "iirf_0": ("carbon_cycle", "r0"),
+    "iirf_airborne": ("carbon_cycle", "rA"),
+    "iirf_uptake": ("carbon_cycle", "rU"),
+    "iirf_temperature": ("carbon_cycle", "rT"),
+    "scaling_CO2": ("forcing_scaling", "CO2"),
+    "scaling_CH4": ("forcing_scaling", "CH4"),
+    "scaling_N2O": ("forcing_scaling", "N2O"),
+}
+
+
+def publish_inputs(directory, runids):
+    """Publish the ensemble members to run and the inputs common to all batches.
+
+    Batches are ranges of positions in ``runids``. Workers index the prior parameter
+    store with the ensemble members of their batch.
+    """
+    _published["directory"] = directory
     da_concentration = xr.load_dataarray(
         f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/"
         "concentration/1pctCO2_concentration_1850-1990.nc"
     )
+    da = da_concentration.loc[dict(config="unspecified", scenario="1pctCO2")]
+    _share_arrays(directory, concentration=da.values, runids=runids)
 
-    f = FAIR()
-    f.define_time(1850, 1990, 1)
-    f.define_scenarios(scenarios)
-    species = ["CO2", "CH4", "N2O"]
-    properties = {
-        "CO2": {
-            "type": "co2",
-            "input_mode": "concentration",
-            "greenhouse_gas": True,
-            "aerosol_chemistry_from_emissions": False,
-            "aerosol_chemistry_from_concentration": False,
-        },
-        "CH4": {
-            "type": "ch4",
-            "input_mode": "concentration",
-            "greenhouse_gas": True,
-            "aerosol_chemistry_from_emissions": False,
-            "aerosol_chemistry_from_concentration": False,
-        },
-        "N2O": {
-            "type": "n2o",
-            "input_mode": "concentration",
-            "greenhouse_gas": True,
-            "aerosol_chemistry_from_emissions": False,
-            "aerosol_chemistry_from_concentration": False,
-        },
-    }
-    f.define_configs(list(range(batch_start, batch_end)))
-    f.define_species(species, properties)
-    f.allocate()
 
-    da = da_concentration.loc[dict(config="unspecified", scenario="1pctCO2")]
-    fe = da.expand_dims(dim=["scenario", "config"], axis=(1, 2))
-    f.concentration = fe.drop("config") * np.ones((1, 1, batch_size, 1))
+def init_worker(shared_dir):
+    """Attach a worker process to its inputs and the prior parameter store.
 
-    # climate response
-    fill(
-        f.climate_configs["ocean_heat_capacity"],
-        np.array([cfg["c1"], cfg["c2"], cfg["c3"]]).T,
-    )
-    fill(
-        f.climate_configs["ocean_heat_transfer"],
-        np.array([cfg["kappa1"], cfg["kappa2"], cfg["kappa3"]]).T,
-    )
-    fill(f.climate_configs["deep_ocean_efficacy"], cfg["epsilon"])
-    fill(f.climate_configs["gamma_autocorrelation"], cfg["gamma"])
-    fill(f.climate_configs["stochastic_run"], False)
-    fill(f.climate_configs["forcing_4co2"], cfg["forcing_4co2"])
-
-    # species level
-    f.fill_species_configs()
-
-    # carbon cycle
-    fill(f.species_configs["iirf_0"], cfg["iirf_0"], specie="CO2")
-    fill(f.species_configs["iirf_airborne"], cfg["iirf_airborne"], specie="CO2")
-    fill(f.species_configs["iirf_uptake"], cfg["iirf_uptake"], specie="CO2")
-    fill(f.species_configs["iirf_temperature"], cfg["iirf_temperature"], specie="CO2")
-
-    # forcing scaling
-    fill(f.species_configs["forcing_scale"], cfg["scaling_CO2"], specie="CO2")
-    fill(f.species_configs["forcing_scale"], cfg["scaling_CH4"], specie="CH4")
-    fill(f.species_configs["forcing_scale"], cfg["scaling_N2O"], specie="N2O")
-
-    # initial condition of CO2 concentration (but not baseline for forcing calculations)
-    fill(f.species_configs["baseline_concentration"], 284.3169988, specie="CO2")
-    fill(f.species_configs["baseline_concentration"], 808.2490285, specie="CH4")
-    fill(f.species_configs["baseline_concentration"], 273.021047, specie="N2O")
-
-    fill(
-        f.species_configs["forcing_reference_concentration"], 284.3169988, specie="CO2"
-    )
-    fill(
-        f.species_configs["forcing_reference_concentration"], 808.2490285, specie="CH4"
-    )
-    fill(f.species_configs["forcing_reference_concentration"], 273.021047, specie="N2O")
-
-    # initial conditions
-    initialise(f.concentration, f.species_configs["baseline_concentration"])
-    initialise(f.forcing, 0)
-    initialise(f.temperature, 0)
-    initialise(f.cumulative_emissions, 0)
-    initialise(f.airborne_emissions, 0)
-
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        f.run(progress=False)
-
-    # interpolate warming at 1000 GtC
-    t1000 = np.ones(batch_size) * np.nan
-    ttco2 = 1000 * 44.009 / 12.011
-    for ibatch in range(batch_size):
-        interpolator = interp1d(
-            f.cumulative_emissions[:, 0, ibatch, 0], f.temperature[:, 0, ibatch, 0]
+    Batches run outside a worker call it themselves, with the inputs last published
+    in that process.
+    """
+    timer = _PhaseTimer()
+    _inputs.update(_attach_arrays(shared_dir))
+    _inputs.update(
+        _open_prior_columns(
+            f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/priors/",
+            prior_columns,
         )
-        t1000[ibatch] = interpolator(ttco2)
-
-    return (
-        np.array((f.temperature[70, 0, :, 0], f.temperature[140, 0, :, 0])),
-        np.array((f.airborne_fraction[70, 0, :, 0], f.airborne_fraction[140, 0, :, 0])),
-        np.array(t1000),
     )
+    timer.lap("init")
+    _init_timings.update(timer.phases)
+
+
+def run_fair(cfg):
+    """Run a batch of the 1pctCO2 ensemble and write its outputs.
+
+    If ``TIMING`` is set, this returns the time taken by each phase of the batch, to
+    be collected by ``utils._save_timing_report``.
+    """
+    if not _inputs:
+        init_worker(_published["directory"])
+    timer = _PhaseTimer()
+    timer.phases.update(_init_timings)
+    _init_timings.clear()
+
+    batch_start = cfg["batch_start"]
+    batch_end = cfg["batch_end"]
+    batch_size = batch_end - batch_start
+
+    # this batch's ensemble members from the prior parameter store
+    runids = _inputs["runids"][batch_start:batch_end]
+    prior = {name: _inputs[name][runids] for name in prior_columns}
+    timer.lap("prior")
+
+    results = _run_idealised("1pctCO2", prior, _inputs["concentration"])
+    timer.lap("run")
+
+    write_outputs(batch_start, batch_end, **results)
+    timer.lap("outputs")
+
+    return timer.result(batch_size)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Sensitivity of the RMSE constraint to its threshold, period and observations"""
+
+# The first constraint (01) accepts ensemble members whose RMSE of temperature
+# relative to 1850-1900 against IGCC observations over 1850-2022 is below RMSE_CEILING.
+# This reads the prior temperature saved by sampling/09 once and, for every
+# combination of the thresholds, baselines, periods and observational datasets below,
+# reports how many members of the prior pass, the effective sample size and
+# percentiles of the constrained ensemble.
+#
+# Only some time series are kept from the prior: every TRAJECTORY_STRIDE-th member,
+# and those with an RMSE below TRAJECTORY_RMSE_CEILING under the default settings. To
+# sweep thresholds above RMSE_CEILING, raise TRAJECTORY_RMSE_CEILING and rerun
+# sampling/09; this leaves the constraint in constraining/01 as it is. Each member
+# kept because it passes stands for itself, and each other member stands for
+# TRAJECTORY_STRIDE members of the prior, so the counts and percentiles are estimates
+# for the whole prior. They are exact for the default baseline, period and
+# observations with thresholds up to TRAJECTORY_RMSE_CEILING, where every passing
+# member is kept.
+#
+# This is not part of the workflow. Run it from this directory after sampling/09,
+# and edit the settings below.
+
+import os
+
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+from fair import __version__
+from utils import (
+    _load_members,
+    _period_weights,
+    _screen_trajectories,
+    _temperature_rmse,
+    _weighted_percentile,
+)
+
+load_dotenv()
+
+print("Sweeping RMSE constraint...")
+
+cal_v = os.getenv("CALIBRATION_VERSION")
+fair_v = os.getenv("FAIR_VERSION")
+constraint_set = os.getenv("CONSTRAINT_SET")
+rmse_ceiling = float(os.getenv("RMSE_CEILING", 0.17))
+trajectory_rmse_ceiling = float(os.getenv("TRAJECTORY_RMSE_CEILING", rmse_ceiling))
+trajectory_stride = int(os.getenv("TRAJECTORY_STRIDE", 100))
+
+assert fair_v == __version__
+
+thresholds = np.round(np.arange(0.10, 0.2501, 0.01), 2)
+baselines = [(1850, 1900)]
+periods = [(1850, 2022), (1850, 2014), (1900, 2022), (1970, 2022)]
+
+# annual mean observed temperature at mid-years, the baseline it is relative to, and
+# the file and column it is in. Other datasets are added here.
+observations = {
+    "IGCC": (
+        (1850, 1900),
+        "../../../../../data/forcing/IGCC_GMST_1850-2022.csv",
+        "gmst",
+    ),
+}
+
+# mean warming of the constrained ensemble over these periods is reported, relative to
+# the baseline
+warming_periods = [(2003, 2022), (2081, 2100)]
+percentiles = [5, 50, 95]
+
+prior_runs = f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/prior_runs"
+
+
+def period_mean(temperature, period):
+    timebounds, weights = _period_weights(period)
+    return np.average(temperature[timebounds], weights=weights, axis=0)
+
+
+# observations on years from 1850, relative to each baseline
+obs = {}
+for name, (obs_baseline, filename, column) in observations.items():
+    df_obs = pd.read_csv(filename)
+    series = (
+        df_obs.set_index(np.floor(df_obs["time"]).astype(int))[column]
+        .reindex(np.arange(1850, int(df_obs["time"].max()) + 1))
+        .values
+    )
+    for baseline in baselines:
+        if baseline == obs_baseline:
+            obs[name, baseline] = series
+        else:
+            obs[name, baseline] = series - np.mean(
+                series[baseline[0] - 1850 : baseline[1] - 1850 + 1]
+            )
+
+# combinations of observations, baseline and period that the observations cover
+combinations = [
+    (name, baseline, period)
+    for name in observations
+    for baseline in baselines
+    for period in periods
+    if period[1] - 1850 < len(obs[name, baseline])
+    and not np.any(
+        np.isnan(obs[name, baseline][period[0] - 1850 : period[1] - 1850 + 1])
+    )
+]
+
+
+def statistics(temperature):
+    rows = [
+        _temperature_rmse(temperature, obs[name, baseline], baseline, period)
+        for name, baseline, period in combinations
+    ]
+    for baseline in baselines:
+        offset = period_mean(temperature, baseline)
+        rows.extend(
+            period_mean(temperature, period) - offset for period in warming_periods
+        )
+    return np.array(rows)
+
+
+# one pass through the saved time series
+runids, values = _screen_trajectories(f"{prior_runs}/temperature_1850-2101", statistics)
+rmse = dict(zip(combinations, values[: len(combinations)]))
+warming = dict(
+    zip(
+        [(baseline, period) for baseline in baselines for period in warming_periods],
+        values[len(combinations) :],
+    )
+)
+print(f"{len(runids)} members read")
+
+# weight of each member kept in the estimates for the whole prior
+default_rmse = _load_members(f"{prior_runs}/temperature_rmse_1850-2022.npy", runids)
+weights = np.where(default_rmse < trajectory_rmse_ceiling, 1, trajectory_stride)
+quantities = {
+    "ECS": _load_members(f"{prior_runs}/ecs.npy", runids),
+    "TCR": _load_members(f"{prior_runs}/tcr.npy", runids),
+}
+
+results = []
+for name, baseline, period in combinations:
+    constrained = {
+        **quantities,
+        **{
+            f"warming {warming_period[0]}-{warming_period[1]}": warming[
+                baseline, warming_period
+            ]
+            for warming_period in warming_periods
+        },
+    }
+    for threshold in thresholds:
+        accept = rmse[name, baseline, period] < threshold
+        result = {
+            "observations": name,
+            "baseline": f"{baseline[0]}-{baseline[1]}",
+            "period": f"{period[0]}-{period[1]}",
+            "threshold": threshold,
+            "passing": np.sum(weights[accept]),
+            "passing_kept": np.sum(accept),
+            "effective_samples": 0,
+        }
+        if np.any(accept):
+            result["effective_samples"] = np.sum(weights[accept]) ** 2 / np.sum(
+                weights[accept] ** 2
+            )
+            for quantity, quantity_values in constrained.items():
+                result.update(
+                    zip(
+                        [f"{quantity} p{percentile}" for percentile in percentiles],
+                        _weighted_percentile(
+                            quantity_values[accept], weights[accept], percentiles
+                        ),
+                    )
+                )
+        results.append(result)
+
+df_results = pd.DataFrame(results)
+print(
+    df_results[
+        ["observations", "baseline", "period", "threshold", "passing"]
+        + ["effective_samples"]
+    ].to_string(index=False)
+)
+
+os.makedirs(
+    f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/posteriors",
+    exist_ok=True,
+)
+df_results.to_csv(
+    f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/posteriors/"
+    "rmse_constraint_sweep.csv",
+    index=False,
+)
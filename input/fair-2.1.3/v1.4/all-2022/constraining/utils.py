@@ -1,9 +1,23 @@
+import functools
+import glob
+import hashlib
+import json
 import logging
 import os
+import resource
+import sys
 import time
-from concurrent.futures import as_completed
+import warnings
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
 
+import numpy as np
+import pandas as pd
+import scipy.optimize
+import scipy.stats
 from dotenv import load_dotenv
+from fair import FAIR
+from fair.interface import fill, initialise
 from tqdm.auto import tqdm
 
 load_dotenv()
@@ -11,6 +25,15 @@ load_dotenv()
 front_serial = int(os.getenv("FRONT_SERIAL"))
 front_parallel = int(os.getenv("FRONT_PARALLEL"))
 progress = os.getenv("PROGRESS", "False").lower() in ("true", "1", "t")
+prior_csv = os.getenv("PRIOR_CSV", "False").lower() in ("true", "1", "t")
+timing = os.getenv("TIMING", "False").lower() in ("true", "1", "t")
+prior_sampling = os.getenv("PRIOR_SAMPLING", "random").lower()
+abc_smc = os.getenv("ABC_SMC", "False").lower() in ("true", "1", "t")
+idealised_experiments = [
+    experiment
+    for experiment in os.getenv("IDEALISED_EXPERIMENTS", "").split(",")
+    if experiment
+]
 
 LOGGER = logging.getLogger(__name__)
 
@@ -28,59 +51,115 @@ def progress(*args, **kwargs):
     return tqdm(*args, **kwargs)
 
 
-def _run_serial(func, configs, config_are_kwargs, desc):
+def _run_serial(
+    func, configs, config_are_kwargs, desc, callback=None, keep_results=True
+):
     LOGGER.debug("Entering _run_serial")
 
-    if config_are_kwargs:
-        LOGGER.debug("Treating config as kwargs")
-        res = [func(**a) for a in progress(configs, desc=desc)]
-    else:
-        LOGGER.debug("Treating config as args")
-        res = [func(a) for a in progress(configs, desc=desc)]
+    res = []
+    for a in progress(configs, desc=desc):
+        if config_are_kwargs:
+            result = func(**a)
+        else:
+            result = func(a)
+        if callback is not None:
+            callback(a, result)
+        if keep_results:
+            res.append(result)
 
     LOGGER.debug("Exiting _run_serial")
     return res
 
 
-def _run_parallel(  # pylint:disable=too-many-arguments
-    pool, timeout, func, configs, config_are_kwargs, desc, bar_start
+def _run_parallel(  # pylint:disable=too-many-arguments,too-many-locals
+    pool,
+    timeout,
+    func,
+    configs,
+    config_are_kwargs,
+    desc,
+    bar_start,
+    callback=None,
+    max_in_flight=None,
+    split=None,
+    keep_results=True,
 ):
     LOGGER.debug("Entering _run_parallel")
 
-    if config_are_kwargs:
-        LOGGER.debug("Treating config as kwargs")
-        futures = [pool.submit(func, **a) for a in configs]
-    else:
-        LOGGER.debug("Treating config as args")
-        futures = [pool.submit(func, a) for a in configs]
-
-    LOGGER.debug("Waiting for jobs to complete")
-    for i, future in progress(
-        enumerate(as_completed(futures, timeout=timeout)), total=len(futures), desc=desc
-    ):
-        if future.exception() is not None:
-            time.sleep(2)  # let buffer flush out
-            print(
-                "One of the processes failed, see error below (was something "
-                "unable to be pickled?)"
-            )
-            raise future.exception()
+    n_workers = pool._max_workers  # pylint:disable=protected-access
+    if max_in_flight is None:
+        max_in_flight = 2 * n_workers
+    deadline = None if timeout is None else time.monotonic() + timeout
 
-        LOGGER.debug("Job %s completed", i + bar_start)
+    # jobs waiting to be submitted, keyed by their position in ``configs``. The parts
+    # of a job that is split are keyed by the job's key plus their position in it, so
+    # that sorting the keys puts results back in order.
+    queue = deque(((i,), a) for i, a in enumerate(configs))
+    in_flight = {}
+    results = {}
+    n_completed = 0
 
-    res = []
+    LOGGER.debug("Treating config as %s", "kwargs" if config_are_kwargs else "args")
+    with progress(total=len(configs), desc=desc) as bar:
+        while queue or in_flight:
+            while queue and len(in_flight) < max_in_flight:
+                # towards the end of the run, only submit jobs to idle workers, so
+                # that the jobs left can be split between them rather than queueing
+                # behind busy ones
+                n_idle = n_workers - len(in_flight)
+                if split is not None and len(queue) < n_workers and n_idle <= 0:
+                    break
 
-    LOGGER.debug("Collecting results")
-    for i, future in enumerate(futures):
-        try:
-            res.append(future.result())
-            LOGGER.debug("Retrived result %s", i + bar_start)
-        except Exception as exc:  # pylint:disable=broad-except
-            LOGGER.debug("Retrieving result %s failed", i + bar_start)
-            res.append(exc)
+                key, a = queue.popleft()
+                n_parts = n_idle // (len(queue) + 1)
+                if split is not None and n_parts > 1:
+                    parts = split(a, n_parts)
+                    if len(parts) > 1:
+                        LOGGER.debug("Splitting job %s into %s", key, len(parts))
+                        keys = [key + (j,) for j in range(len(parts))]
+                        queue.extendleft(reversed(list(zip(keys, parts))))
+                        bar.total += len(parts) - 1
+                        bar.refresh()
+                        continue
+
+                if config_are_kwargs:
+                    future = pool.submit(func, **a)
+                else:
+                    future = pool.submit(func, a)
+                in_flight[future] = (key, a)
+
+            remaining = None if deadline is None else deadline - time.monotonic()
+            done, _ = wait(in_flight, timeout=remaining, return_when=FIRST_COMPLETED)
+            if not done:
+                for pending in in_flight:
+                    pending.cancel()
+                raise TimeoutError(f"Jobs not complete after {timeout} seconds")
+
+            for future in done:
+                key, a = in_flight.pop(future)
+                if future.exception() is not None:
+                    # don't start anything new; whatever has finished has been
+                    # recorded
+                    for pending in in_flight:
+                        pending.cancel()
+                    time.sleep(2)  # let buffer flush out
+                    print(
+                        "One of the processes failed, see error below (was something "
+                        "unable to be pickled?)"
+                    )
+                    raise future.exception()
+
+                if callback is not None:
+                    callback(a, future.result())
+                if keep_results:
+                    results[key] = future.result()
+
+                LOGGER.debug("Job %s completed", n_completed + bar_start)
+                n_completed += 1
+                bar.update()
 
     LOGGER.debug("Exiting _run_parallel")
-    return res
+    return [results[key] for key in sorted(results)]
 
 
 def _parallel_process(  # pylint:disable=too-many-arguments
@@ -91,6 +170,10 @@ def _parallel_process(  # pylint:disable=too-many-arguments
     front_serial=front_serial,
     front_parallel=front_parallel,
     timeout=None,
+    callback=None,
+    max_in_flight=None,
+    split=None,
+    keep_results=True,
 ):
     """
     Run a process in parallel with a progress bar.
@@ -117,10 +200,30 @@ def _parallel_process(  # pylint:disable=too-many-arguments
     timeout : float
         How long to wait for processes to complete before timing out. If
         ``None``, there is no timeout limit.
+    callback : function
+        If given, called as ``callback(config, result)`` in the parent process as
+        soon as each job completes, in order of completion. Useful for recording
+        progress so that an interrupted run can be resumed.
+    max_in_flight : int
+        The most jobs to have submitted to the pool at any one time; more are
+        submitted as these complete. If ``None``, twice the number of workers in
+        ``pool``.
+    split : function
+        If given, called as ``split(config, n)`` to split a job that has not yet
+        started into up to ``n`` smaller jobs, returned as a list of configurations.
+        This is done towards the end of a run, when there are fewer jobs left than
+        workers, so that idle workers can share them. The smaller jobs must give the
+        same results as the job they were split from, and each is passed to
+        ``callback`` in its place.
+    keep_results : bool
+        Keep the results to return them. If ``False``, results are only passed to
+        ``callback``, and are released as soon as they are.
     Returns
     -------
     sequence
-        Results of calling ``func`` with each configuration in ``configuration``
+        Results of calling ``func`` with each configuration in ``configuration``, in
+        that order, with a result for each part of any job that was split. Empty if
+        ``keep_results`` is ``False``.
     """
     front_serial_res = []
     if front_serial > 0:
@@ -130,6 +233,8 @@ def _parallel_process(  # pylint:disable=too-many-arguments
             configs=configuration[:front_serial],
             config_are_kwargs=config_are_kwargs,
             desc="Front serial",
+            callback=callback,
+            keep_results=keep_results,
         )
 
     if pool is None:
@@ -139,6 +244,8 @@ def _parallel_process(  # pylint:disable=too-many-arguments
             configs=configuration[front_serial:],
             config_are_kwargs=config_are_kwargs,
             desc="Serial runs",
+            callback=callback,
+            keep_results=keep_results,
         )
 
         return rest + front_serial_res
@@ -154,6 +261,9 @@ def _parallel_process(  # pylint:disable=too-many-arguments
             config_are_kwargs=config_are_kwargs,
             desc="Front parallel",
             bar_start=front_serial,
+            callback=callback,
+            max_in_flight=max_in_flight,
+            keep_results=keep_results,
         )
 
     LOGGER.debug("Running rest of parallel jobs")
@@ -165,6 +275,1414 @@ def _parallel_process(  # pylint:disable=too-many-arguments
         config_are_kwargs=config_are_kwargs,
         desc="Parallel runs",
         bar_start=front_serial + front_parallel,
+        callback=callback,
+        max_in_flight=max_in_flight,
+        split=split,
+        keep_results=keep_results,
     )
 
     return front_serial_res + front_parallel_res + rest
+
+
+def _split_batch(cfg, n):
+    """Split a batch of ensemble members into up to ``n`` smaller batches.
+
+    For use as ``split`` in ``_parallel_process``.
+
+    Parameters
+    ----------
+    cfg : dict
+        Batch configuration, containing ``batch_start`` and ``batch_end`` and
+        optionally ``runids``, the run IDs that these are positions in.
+    n : int
+        The most batches to split into.
+
+    Returns
+    -------
+    list of dict
+        Configurations of the smaller batches, in order, each a copy of ``cfg`` with
+        its own ``batch_start``, ``batch_end`` and ``runids``.
+    """
+    parts = []
+    bounds = np.linspace(cfg["batch_start"], cfg["batch_end"], n + 1).round()
+    for batch_start, batch_end in zip(bounds[:-1].astype(int), bounds[1:].astype(int)):
+        if batch_end == batch_start:
+            continue
+        part = {**cfg, "batch_start": int(batch_start), "batch_end": int(batch_end)}
+        if "runids" in cfg:
+            offset = cfg["batch_start"]
+            part["runids"] = cfg["runids"][batch_start - offset : batch_end - offset]
+        parts.append(part)
+    return parts
+
+
+def _fingerprint(files, settings):
+    """Identify the inputs and settings that a set of batch results depends on.
+
+    Parameters
+    ----------
+    files : sequence of str
+        Input files whose contents the results depend on.
+    settings : dict
+        Settings (e.g. from the environment) that the results depend on.
+
+    Returns
+    -------
+    dict
+        SHA-256 hash of each file, keyed by its path, and the settings.
+    """
+    hashes = {file: _sha256(file) for file in files}
+    return {"inputs": hashes, "settings": settings}
+
+
+def _sha256(file):
+    sha = hashlib.sha256()
+    with open(file, "rb") as f:
+        for chunk in iter(lambda: f.read(2**20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _merge_ranges(ranges):
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def _load_manifest(filename, fingerprint, outputs=()):
+    """Load the completed batch ranges of an earlier run, if they can be reused.
+
+    Parameters
+    ----------
+    filename : str
+        Location of the batch manifest.
+    fingerprint : dict
+        Output of ``_fingerprint`` for the current run.
+    outputs : sequence of str
+        Output files that the completed batches were written to.
+
+    Returns
+    -------
+    list or None
+        ``[batch_start, batch_end]`` ranges already complete, or ``None`` if there is
+        no manifest, it was made from different inputs or settings, or any of the
+        output files are missing. In that case the run must start from scratch.
+    """
+    if not os.path.isfile(filename):
+        return None
+    with open(filename) as f:
+        manifest = json.load(f)
+    if manifest["fingerprint"] != fingerprint:
+        LOGGER.info("Inputs or settings have changed since %s was written", filename)
+        return None
+    if not all(os.path.isfile(output) for output in outputs):
+        return None
+    return manifest["complete"]
+
+
+def _save_manifest(filename, fingerprint, complete):
+    """Atomically write the fingerprint and completed batch ranges of a run."""
+    manifest = {"fingerprint": fingerprint, "complete": _merge_ranges(complete)}
+    with open(f"{filename}.tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(f"{filename}.tmp", filename)
+
+
+def _is_complete(cfg, complete):
+    """Is the batch ``cfg`` covered by the completed ranges of a manifest?"""
+    return any(
+        start <= cfg["batch_start"] and cfg["batch_end"] <= end
+        for start, end in _merge_ranges(complete)
+    )
+
+
+def _share_arrays(directory, **arrays):
+    """Publish read-only inputs once, for pool workers to memory-map.
+
+    Workers that attach to these share the same pages of memory, rather than each
+    reading its own copy from disk or having it pickled into every job.
+
+    Parameters
+    ----------
+    directory : str
+        Where to write the arrays. This should be removed when the pool is done, e.g.
+        by using a ``tempfile.TemporaryDirectory``.
+    **arrays : dict of array_like
+        Arrays to publish, keyed by name.
+    """
+    for name, array in arrays.items():
+        np.save(os.path.join(directory, f"{name}.npy"), np.asarray(array))
+
+
+def _attach_arrays(directory):
+    """Memory-map the inputs published by ``_share_arrays``.
+
+    Parameters
+    ----------
+    directory : str
+        Directory that the arrays were published to.
+
+    Returns
+    -------
+    dict of :obj:`numpy.memmap`
+        Read-only view of each array, keyed by name.
+    """
+    return {
+        os.path.splitext(os.path.basename(file))[0]: np.load(file, mmap_mode="r")
+        for file in glob.glob(os.path.join(directory, "*.npy"))
+    }
+
+
+# columns of the joint low-discrepancy design that each prior is drawn from, when
+# PRIOR_SAMPLING is "sobol" or "lhs". A KDE of n parameters takes n + 1 columns: one to
+# choose a data point and one for each parameter.
+prior_design = {
+    "climate_response_ebm3": 12,
+    "aerosol_cloud": 5,
+    "aerosol_radiation": 9,
+    "carbon_cycle": 5,
+    "ozone": 6,
+    "forcing_scaling": 9,
+    "co2_concentration_1750": 1,
+}
+prior_design_seed = 6019286
+
+
+def _prior_uniforms(prior, n, start=0, chunk_size=2**17):
+    """Uniform samples of a prior from the joint low-discrepancy design.
+
+    With ``PRIOR_SAMPLING=sobol``, the design is one scrambled Sobol' sequence over the
+    columns of all priors in ``prior_design``, so that row ``i`` is ensemble member
+    ``i`` of every prior that is drawn without rejection. Its balance properties need
+    ``n`` to be a power of 2 and ``start`` a multiple of ``n``, and this warns if they
+    are not. With ``PRIOR_SAMPLING=lhs``, each column of the rows from ``start`` is an
+    independently stratified Latin hypercube of ``n`` samples. Both are the same for
+    the same seed.
+
+    Parameters
+    ----------
+    prior : str
+        Name of the prior in ``prior_design``.
+    n : int
+        Number of samples.
+    start : int
+        First row of the design, e.g. for a prior drawn in chunks.
+    chunk_size : int
+        Number of rows of the Sobol' sequence generated at a time.
+
+    Returns
+    -------
+    :obj:`numpy.ndarray`
+        Samples on [0, 1), one row per sample and one column per dimension of the
+        prior.
+    """
+    names = list(prior_design)
+    first = sum(prior_design[name] for name in names[: names.index(prior)])
+    columns = slice(first, first + prior_design[prior])
+    if prior_sampling == "sobol":
+        if n & (n - 1) or start % n:
+            warnings.warn(
+                f"The Sobol' design of {prior} is only balanced for a power of 2 "
+                f"samples from a multiple of that row, not {n} from row {start}",
+                stacklevel=2,
+            )
+        sampler = scipy.stats.qmc.Sobol(
+            d=sum(prior_design.values()), seed=prior_design_seed
+        )
+        if start > 0:
+            sampler.fast_forward(start)
+        with warnings.catch_warnings():
+            # scipy warns about the balance properties for each chunk, rather than
+            # once for the whole design as above
+            warnings.simplefilter("ignore", UserWarning)
+            return np.concatenate(
+                [
+                    sampler.random(min(chunk_size, n - row))[:, columns]
+                    for row in range(0, n, chunk_size)
+                ]
+            )
+    if prior_sampling == "lhs":
+        seeds = np.random.SeedSequence(prior_design_seed, spawn_key=(start,)).spawn(
+            sum(prior_design.values())
+        )[columns]
+        return np.stack(
+            [
+                scipy.stats.qmc.LatinHypercube(
+                    d=1, seed=np.random.default_rng(seed)
+                ).random(n)[:, 0]
+                for seed in seeds
+            ],
+            axis=1,
+        )
+    raise ValueError(
+        f"PRIOR_SAMPLING should be random, sobol or lhs, not {prior_sampling}"
+    )
+
+
+def _kde_ppf(kde, uniforms):
+    """Samples of a Gaussian KDE from uniform samples, e.g. of ``_prior_uniforms``.
+
+    This is the transformation that ``scipy.stats.gaussian_kde.resample`` makes of
+    random numbers: the first column chooses a data point by its weight, and the
+    others are mapped through the normal inverse CDF to the kernel around it.
+
+    Parameters
+    ----------
+    kde : :obj:`scipy.stats.gaussian_kde`
+        Distribution to sample.
+    uniforms : array_like
+        Samples on [0, 1), one row per sample and ``kde.d + 1`` columns.
+
+    Returns
+    -------
+    :obj:`numpy.ndarray`
+        Samples with dimension first, like those of ``resample``.
+    """
+    uniforms = np.asarray(uniforms)
+    cumulative = np.cumsum(kde.weights)
+    points = np.searchsorted(
+        cumulative, uniforms[:, 0] * cumulative[-1], side="right"
+    ).clip(max=kde.n - 1)
+    kernel = (
+        scipy.stats.norm.ppf(uniforms[:, 1:]) @ np.linalg.cholesky(kde.covariance).T
+    )
+    return kde.dataset[:, points] + kernel.T
+
+
+def _save_prior(directory, df):
+    """Write the samples of a prior as a binary store of one ``.npy`` per column.
+
+    The store is a directory containing the column files and a ``schema.json``
+    listing the columns in order, with the file, dtype and SHA-256 hash of each. The
+    schema is written last, so a store without one is incomplete. If ``PRIOR_CSV`` is
+    set, the prior is also written as ``<directory>.csv``, e.g. for Zenodo.
+
+    Parameters
+    ----------
+    directory : str
+        Location of the store.
+    df : :obj:`pandas.DataFrame`
+        Prior samples, one row per ensemble member and one column per parameter.
+    """
+    os.makedirs(directory, exist_ok=True)
+    columns = []
+    for column in df.columns:
+        filename = f"{column.replace(' ', '_')}.npy"
+        np.save(os.path.join(directory, filename), df[column].values)
+        columns.append(
+            {
+                "name": column,
+                "file": filename,
+                "dtype": str(df[column].dtype),
+                "sha256": _sha256(os.path.join(directory, filename)),
+            }
+        )
+    with open(os.path.join(directory, "schema.json"), "w") as f:
+        json.dump({"samples": len(df), "columns": columns}, f, indent=2)
+
+    if prior_csv:
+        df.to_csv(f"{directory.rstrip(os.sep)}.csv", index=False)
+
+
+def _open_prior(directory):
+    """Memory-map the columns of a prior written by ``_save_prior``.
+
+    Parameters
+    ----------
+    directory : str
+        Location of the store.
+
+    Returns
+    -------
+    dict of :obj:`numpy.memmap`
+        Read-only view of each column, keyed by name in the order of the schema.
+        Only the elements that are indexed are read from disk, so these can be
+        indexed with the run IDs of a (small) subset of the ensemble cheaply.
+    """
+    with open(os.path.join(directory, "schema.json")) as f:
+        schema = json.load(f)
+    return {
+        column["name"]: np.load(os.path.join(directory, column["file"]), mmap_mode="r")
+        for column in schema["columns"]
+    }
+
+
+def _open_prior_columns(directory, columns):
+    """Memory-map selected columns from several priors written by ``_save_prior``.
+
+    Parameters
+    ----------
+    directory : str
+        Directory containing the store of each prior.
+    columns : dict
+        Columns to open. Keys are the names to give them, and values are
+        ``(prior, column)``, the name of the prior store and column within it.
+
+    Returns
+    -------
+    dict of :obj:`numpy.memmap`
+        Read-only view of each column, keyed by the names in ``columns``.
+    """
+    priors = {}
+    for prior, _ in columns.values():
+        if prior not in priors:
+            priors[prior] = _open_prior(os.path.join(directory, prior))
+    return {name: priors[prior][column] for name, (prior, column) in columns.items()}
+
+
+def _load_prior(directory, runids=None):
+    """Load the samples of a prior written by ``_save_prior`` into memory.
+
+    Parameters
+    ----------
+    directory : str
+        Location of the store.
+    runids : array_like of int
+        Ensemble members to load. If ``None``, load all of them.
+
+    Returns
+    -------
+    :obj:`pandas.DataFrame`
+        Prior samples, indexed by run ID.
+    """
+    columns = _open_prior(directory)
+    if runids is None:
+        runids = np.arange(len(next(iter(columns.values()))))
+    return pd.DataFrame(
+        {name: column[runids] for name, column in columns.items()}, index=runids
+    )
+
+
+def _save_trajectories(directory, runids, data):
+    """Save the full time series of some ensemble members from one batch.
+
+    Each batch writes its own file, named by its first run ID, so that batches run
+    in parallel never write to the same file and a batch that is rerun replaces its
+    earlier output. Files are written atomically.
+
+    Parameters
+    ----------
+    directory : str
+        Location of the store.
+    runids : array_like of int
+        Ensemble members to save, in increasing order.
+    data : array_like
+        Time series of these members, with ensemble member as the last dimension.
+    """
+    if len(runids) == 0:
+        return
+    os.makedirs(directory, exist_ok=True)
+    filename = os.path.join(directory, f"{runids[0]:09d}.npz")
+    with open(f"{filename}.tmp", "wb") as f:
+        np.savez(f, runids=np.asarray(runids), data=np.asarray(data))
+    os.replace(f"{filename}.tmp", filename)
+
+
+def _load_members(filename, members=None, rows=None, member_major=False):
+    """Load some ensemble members of an array saved with member as its last dimension.
+
+    The file is memory-mapped, so only the parts of it that are requested are read
+    from disk.
+
+    Parameters
+    ----------
+    filename : str
+        ``.npy`` file to load.
+    members : array_like of int
+        Positions along the last dimension to load, in any order. If ``None``, load
+        all of them.
+    rows : int, slice or array_like of int
+        Positions along the first dimension to load, if the array has more than one
+        dimension. If ``None``, load all of them.
+    member_major : bool
+        If True, return ensemble member as the first dimension, in a C-contiguous
+        array, so that the values of each member are next to each other.
+
+    Returns
+    -------
+    :obj:`numpy.ndarray` or :obj:`numpy.memmap`
+        The values requested. If no members or rows are requested, and
+        ``member_major`` is False, this is the read-only memory map of the whole
+        array.
+    """
+    data = np.load(filename, mmap_mode="r")
+    if rows is not None:
+        data = data[rows]
+    if members is not None:
+        # reading the members in the order that they are stored reads each page of
+        # the file at most once
+        members, inverse = np.unique(members, return_inverse=True)
+        data = data[..., members][..., inverse]
+    if member_major:
+        data = np.ascontiguousarray(np.moveaxis(data, -1, 0))
+    return data
+
+
+def _take_rows(data, rows=None):
+    return np.asarray(data) if rows is None else data[rows]
+
+
+def _load_trajectories(directory, runids=None, rows=None, member_major=False):
+    """Load time series saved by ``_save_trajectories`` into memory.
+
+    The store is read one batch file at a time, and only the members and time steps
+    requested are kept from each file.
+
+    Parameters
+    ----------
+    directory : str
+        Location of the store.
+    runids : array_like of int
+        Ensemble members to load. If ``None``, load all of them.
+    rows : int, slice or array_like of int
+        Time steps to load. If ``None``, load all of them.
+    member_major : bool
+        If True, return ensemble member as the first dimension, in a C-contiguous
+        array, so that the time series of each member are next to each other.
+
+    Returns
+    -------
+    runids : :obj:`numpy.ndarray`
+        Run IDs of the members loaded, in increasing order if ``runids`` is ``None``.
+    data : :obj:`numpy.ndarray`
+        Time series of these members, with ensemble member as the last dimension,
+        or the first if ``member_major`` is True.
+
+    Raises
+    ------
+    FileNotFoundError
+        If the store is empty.
+    KeyError
+        If any of ``runids`` are not in the store.
+    """
+    stored_runids, data = _screen_trajectories(
+        directory, functools.partial(_take_rows, rows=rows), runids=runids
+    )
+    if runids is not None:
+        runids = np.asarray(runids)
+        missing = ~np.isin(runids, stored_runids)
+        if np.any(missing):
+            raise KeyError(
+                f"Time series of {np.sum(missing)} run IDs, e.g. "
+                f"{runids[missing][0]}, are not in {directory}"
+            )
+        stored_runids, data = runids, data[..., np.searchsorted(stored_runids, runids)]
+    if member_major:
+        data = np.ascontiguousarray(np.moveaxis(data, -1, 0))
+    return stored_runids, data
+
+
+def _fan_trajectories(
+    directory,
+    runids=None,
+    baseline=(1850, 1900),
+    percentiles=(5, 16, 50, 84, 95),
+    cache=None,
+    max_members=200000,
+):
+    """Summarise time series saved by ``_save_trajectories`` for a fan plot.
+
+    Up to ``max_members``, whether these are ``runids`` or all of the members in the
+    store, the members are loaded and summarised exactly by ``_fan``. Beyond that,
+    the store is streamed a file at a time into a ``_FanSketch``.
+
+    Parameters
+    ----------
+    directory : str
+        Location of the store.
+    runids : array_like of int
+        Ensemble members to summarise. If ``None``, all of them.
+    baseline : tuple of int
+        First and last years of the period that temperature is relative to.
+    percentiles : array_like of float
+        Percentiles to calculate.
+    cache : str
+        If given, the summary is saved in this ``.npz`` file, and read from it rather
+        than calculated again if it is for the same members, baseline and
+        percentiles.
+    max_members : int
+        Largest number of members to summarise exactly.
+
+    Returns
+    -------
+    dict of :obj:`numpy.ndarray`
+        As returned by ``_fan``.
+    """
+    # the summary depends on the files in the store, as well as the arguments
+    files = sorted(glob.glob(os.path.join(directory, "*.npz")))
+    if len(files) == 0:
+        raise FileNotFoundError(f"No time series have been saved in {directory}")
+    key = hashlib.sha256(
+        json.dumps(
+            {
+                "files": [[file, os.path.getmtime(file)] for file in files],
+                "baseline": list(baseline),
+                "percentiles": list(percentiles),
+            }
+        ).encode()
+        + (b"" if runids is None else np.sort(runids).astype(np.int64).tobytes())
+    ).hexdigest()
+    if cache is not None and os.path.exists(cache):
+        with np.load(cache) as npz:
+            if str(npz["key"]) == key:
+                return {name: npz[name] for name in npz.files if name != "key"}
+
+    timebounds, weights = _period_weights(baseline)
+    # all of the members are counted first, so that a small store is summarised
+    # exactly too. Only the run IDs are read from each file for this.
+    if runids is None:
+        stored_runids = []
+        for file in files:
+            with np.load(file) as npz:
+                stored_runids.append(npz["runids"])
+        n_members = len(np.unique(np.concatenate(stored_runids)))
+    else:
+        n_members = len(runids)
+    if n_members <= max_members:
+        data = _load_trajectories(directory, runids)[1]
+        fan = _fan(
+            data, np.average(data[timebounds], weights=weights, axis=0), percentiles
+        )
+    else:
+        sketch = None
+        seen = np.array([], dtype=int)
+        for file in files:
+            with np.load(file) as npz:
+                keep = ~np.isin(npz["runids"], seen)
+                if runids is not None:
+                    keep &= np.isin(npz["runids"], runids)
+                seen = np.union1d(seen, npz["runids"])
+                data = npz["data"][:, keep]
+            if sketch is None:
+                sketch = _FanSketch(data.shape[0])
+            sketch.update(data, np.average(data[timebounds], weights=weights, axis=0))
+        fan = sketch.summary(percentiles)
+
+    if cache is not None:
+        os.makedirs(os.path.dirname(cache), exist_ok=True)
+        np.savez(cache, key=key, **fan)
+    return fan
+
+
+def _screen_file(file, func, runids=None):
+    with np.load(file) as npz:
+        if runids is None:
+            return npz["runids"], func(npz["data"])
+        keep = np.isin(npz["runids"], runids)
+        return npz["runids"][keep], func(npz["data"][..., keep])
+
+
+def _screen_trajectories(directory, func, pool=None, runids=None):
+    """Apply a function to the time series saved by ``_save_trajectories``.
+
+    The store is read one batch file at a time, so only the results of ``func`` are
+    held in memory for the whole ensemble.
+
+    Parameters
+    ----------
+    directory : str
+        Location of the store.
+    func : function
+        Called with the time series of the members in each file, with ensemble
+        member as the last dimension. It should return an array with the same last
+        dimension, e.g. a value for each member. This must be picklable if ``pool``
+        is given.
+    pool : :obj:`concurrent.futures.Executor`
+        If given, files are spread across the workers of this pool.
+    runids : array_like of int
+        If given, ``func`` is only applied to these members, and the time series of
+        the others are not kept in memory.
+
+    Returns
+    -------
+    runids : :obj:`numpy.ndarray`
+        Run IDs of the members in the store, in increasing order.
+    values : :obj:`numpy.ndarray`
+        Results of ``func`` for these members, with ensemble member as the last
+        dimension.
+
+    Raises
+    ------
+    FileNotFoundError
+        If the store is empty.
+    """
+    files = sorted(glob.glob(os.path.join(directory, "*.npz")))
+    if len(files) == 0:
+        raise FileNotFoundError(f"No time series have been saved in {directory}")
+    if pool is None:
+        results = [_screen_file(file, func, runids) for file in files]
+    else:
+        results = list(
+            pool.map(_screen_file, files, [func] * len(files), [runids] * len(files))
+        )
+    runids = np.concatenate([result[0] for result in results])
+    values = np.concatenate([result[1] for result in results], axis=-1)
+
+    # a member is saved more than once if, e.g., part of a batch that was split is
+    # complete when an interrupted run is resumed, and the whole batch is run again.
+    # Its time series are the same each time, so keep one of them.
+    runids, index = np.unique(runids, return_index=True)
+    return runids, values[..., index]
+
+
+def _fan(data, baseline=0, percentiles=(5, 16, 50, 84, 95), block_size=16):
+    """Summarise an ensemble of time series for a fan plot.
+
+    The minimum, maximum and percentiles over members are calculated for a few time
+    steps at a time, so ``data`` can be a memory-mapped array of a large ensemble,
+    and only a block of it relative to the baseline is held in memory at once. The
+    results are the same as for the whole array.
+
+    Parameters
+    ----------
+    data : array_like
+        Time series, with time as the first dimension and ensemble member as the
+        last.
+    baseline : array_like
+        Baseline of each member, subtracted from its time series.
+    percentiles : array_like of float
+        Percentiles to calculate.
+    block_size : int
+        Number of time steps in each block.
+
+    Returns
+    -------
+    dict of :obj:`numpy.ndarray`
+        Time series of the ``"min"``, ``"max"``, and each percentile, e.g. ``"p5"``.
+    """
+    n_times = np.shape(data)[0]
+    fan = {"min": np.zeros(n_times), "max": np.zeros(n_times)}
+    fan.update({f"p{percentile:g}": np.zeros(n_times) for percentile in percentiles})
+    for start in range(0, n_times, block_size):
+        block = np.asarray(data[start : start + block_size]) - baseline
+        fan["min"][start : start + block_size] = np.min(block, axis=-1)
+        fan["max"][start : start + block_size] = np.max(block, axis=-1)
+        for percentile, values in zip(
+            percentiles, np.percentile(block, percentiles, axis=-1)
+        ):
+            fan[f"p{percentile:g}"][start : start + block_size] = values
+    return fan
+
+
+class _FanSketch:
+    """Mergeable summary of an ensemble of time series for a fan plot.
+
+    Values at each time step are counted in fixed bins, so summaries of parts of an
+    ensemble, such as the files of a store, can be merged, taking memory independent
+    of the size of the ensemble. Percentiles are accurate to within the width of a
+    bin; the minimum and maximum are exact.
+
+    Parameters
+    ----------
+    n_times : int
+        Number of time steps.
+    lower, upper : float
+        Range of the bins. Values outside it are counted in the bins at its ends.
+    n_bins : int
+        Number of bins.
+    """
+
+    def __init__(self, n_times, lower=-5, upper=15, n_bins=4000):
+        self.lower = lower
+        self.width = (upper - lower) / n_bins
+        self.n_bins = n_bins
+        self.counts = np.zeros((n_times, n_bins), dtype=np.int64)
+        self.min = np.full(n_times, np.inf)
+        self.max = np.full(n_times, -np.inf)
+
+    def update(self, data, baseline=0):
+        """Add members, with time as the first dimension and member as the last."""
+        data = np.asarray(data) - baseline
+        if data.shape[-1] == 0:
+            return
+        bins = np.clip(
+            ((data - self.lower) / self.width).astype(int), 0, self.n_bins - 1
+        )
+        rows = np.arange(data.shape[0])[:, None] * self.n_bins
+        self.counts += np.bincount(
+            (rows + bins).ravel(), minlength=self.counts.size
+        ).reshape(self.counts.shape)
+        self.min = np.minimum(self.min, np.min(data, axis=-1))
+        self.max = np.maximum(self.max, np.max(data, axis=-1))
+
+    def merge(self, other):
+        """Add the members of another sketch with the same bins."""
+        self.counts += other.counts
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+
+    def summary(self, percentiles=(5, 16, 50, 84, 95)):
+        """Summary in the same form as ``_fan``."""
+        n_members = self.counts[0].sum()
+        cumulative = np.cumsum(self.counts, axis=1)
+        rows = np.arange(self.counts.shape[0])
+        fan = {"min": self.min.copy(), "max": self.max.copy()}
+        for percentile in percentiles:
+            # rank of the percentile as numpy.percentile defines it, spread evenly
+            # through the bin it falls in
+            rank = percentile / 100 * (n_members - 1)
+            bins = np.sum(cumulative <= rank, axis=1)
+            before = cumulative[rows, bins] - self.counts[rows, bins]
+            fan[f"p{percentile:g}"] = np.clip(
+                self.lower
+                + self.width * (bins + (rank - before + 0.5) / self.counts[rows, bins]),
+                self.min,
+                self.max,
+            )
+        return fan
+
+
+def _period_weights(period):
+    """Timebounds of a period of years from 1850, and their weights in its mean.
+
+    The timebounds at the start and end of the period are weighted by 0.5.
+    """
+    timebounds = slice(period[0] - 1850, period[1] - 1850 + 2)
+    weights = np.ones(period[1] - period[0] + 2)
+    weights[0] = 0.5
+    weights[-1] = 0.5
+    return timebounds, weights
+
+
+def _temperature_rmse(
+    temperature, obs, baseline=(1850, 1900), period=None, chunk_size=10000
+):
+    """Root-mean-square error of temperature relative to a baseline against obs.
+
+    This is the first constraint, and constraining/01 has the details. Members are
+    processed in blocks, so ``temperature`` can be a memory-mapped array of the whole
+    ensemble.
+
+    Parameters
+    ----------
+    temperature : array_like
+        Temperature on timebounds from 1850, with ensemble member as the last
+        dimension.
+    obs : array_like
+        Observed temperature relative to ``baseline`` for years from 1850, each
+        compared to the timebound at the end of the year.
+    baseline : tuple of int
+        First and last years of the baseline period of temperature.
+    period : tuple of int
+        First and last years of obs to compare. If ``None``, all of obs are compared.
+    chunk_size : int
+        Number of members in each block.
+
+    Returns
+    -------
+    :obj:`numpy.ndarray`
+        RMSE of each member.
+    """
+    baseline_timebounds, weights = _period_weights(baseline)
+    if period is None:
+        period = (1850, 1850 + len(obs) - 1)
+    obs = np.asarray(obs)[period[0] - 1850 : period[1] - 1850 + 1]
+    compared = slice(period[0] - 1850 + 1, period[1] - 1850 + 2)
+
+    n_members = np.shape(temperature)[-1]
+    rmse = np.zeros(n_members)
+    for start in range(0, n_members, chunk_size):
+        # each member's time series is made contiguous, so that its sums are the same
+        # as when it is reduced on its own
+        block = np.ascontiguousarray(
+            np.asarray(temperature[:, start : start + chunk_size]).T
+        )
+        offset = np.average(block[:, baseline_timebounds], weights=weights, axis=-1)
+        anomaly = block[:, compared] - offset[:, None]
+        rmse[start : start + chunk_size] = np.sqrt(
+            np.sum((obs - anomaly) ** 2, axis=-1) / len(obs)
+        )
+    return rmse
+
+
+def _crossing_values(x, y, targets):
+    """Values of one time series where another first reaches some targets.
+
+    For all members at once, this finds the first time step at which ``x`` reaches
+    each target and interpolates ``y`` linearly between it and the time step before,
+    e.g. temperature at given cumulative emissions. Where ``x`` increases, the
+    results are the same as from ``scipy.interpolate.interp1d`` for each member.
+
+    Parameters
+    ----------
+    x : array_like
+        Time series that reaches the targets, with time as the first dimension and
+        ensemble member as the last.
+    y : array_like
+        Time series to interpolate, with the same shape as ``x``.
+    targets : array_like of float
+        Values of ``x`` to find.
+
+    Returns
+    -------
+    :obj:`numpy.ndarray`
+        Values of ``y`` at each target, with target as the first dimension and
+        ensemble member as the last. These are NaN where ``x`` never reaches the
+        target.
+    """
+    x = np.asarray(x)
+    y = np.asarray(y)
+    targets = np.atleast_1d(targets).astype(np.float64)
+
+    reached = x >= targets.reshape((-1,) + (1,) * x.ndim)
+    hi = np.argmax(reached, axis=1).clip(min=1)
+    lo = hi - 1
+    x_lo = np.take_along_axis(x[None], lo[:, None], axis=1)[:, 0]
+    x_hi = np.take_along_axis(x[None], hi[:, None], axis=1)[:, 0]
+    y_lo = np.take_along_axis(y[None], lo[:, None], axis=1)[:, 0]
+    y_hi = np.take_along_axis(y[None], hi[:, None], axis=1)[:, 0]
+
+    # the same arithmetic as interp1d
+    slope = (y_hi - y_lo) / (x_hi - x_lo)
+    values = slope * (targets.reshape((-1,) + (1,) * (x.ndim - 1)) - x_lo) + y_lo
+    return np.where(np.any(reached, axis=1), values, np.nan)
+
+
+def _erfaci(shapes, emissions, beta=1, chunk_size=100000):
+    """Aerosol-cloud forcing in 2005-2014 relative to 1750 for ensemble members.
+
+    This is the logarithmic relationship to SO2, BC and OC emissions that FaIR uses,
+    calibrated in sampling/02. Members are processed in blocks, so that memory is
+    bounded for the whole prior.
+
+    Parameters
+    ----------
+    shapes : array_like
+        Sensitivity of forcing to SO2, BC and OC emissions along the first dimension,
+        with ensemble member as the last dimension.
+    emissions : array_like
+        SO2, BC and OC emissions along the first dimension, for years from 1750.
+    beta : float or array_like
+        Scale factor of forcing, for all or each member.
+    chunk_size : int
+        Number of members in each block.
+
+    Returns
+    -------
+    :obj:`numpy.ndarray`
+        Mean forcing over 2005-2014 relative to 1750 of each member.
+    """
+    shapes = np.asarray(shapes)
+    emissions = np.asarray(emissions)
+    n_members = shapes.shape[-1]
+    erfaci = np.zeros(n_members)
+    for start in range(0, n_members, chunk_size):
+        # members are along the first dimension, so that each member's mean is the
+        # same as when it is reduced on its own
+        so2, bc, oc = shapes[:, start : start + chunk_size, None]
+        erf2010 = np.mean(
+            np.log(
+                1
+                + emissions[0, 255:265] * so2
+                + emissions[1, 255:265] * bc
+                + emissions[2, 255:265] * oc
+            ),
+            axis=-1,
+        )
+        erf1750 = np.log(
+            1 + emissions[0, 0] * so2 + emissions[1, 0] * bc + emissions[2, 0] * oc
+        )[:, 0]
+        erfaci[start : start + chunk_size] = erf2010 - erf1750
+    return beta * erfaci
+
+
+# cumulative CO2 emissions (GtC) at which warming is found in 1pctCO2 runs. 1000 GtC is
+# also written on its own, as the TCRE.
+emissions_targets = (500, 1000, 2000)
+
+# the idealised CO2 experiments that ``_run_idealised`` runs, and their outputs. Values
+# are (filename, shape of the output for one ensemble member).
+idealised_outputs = {
+    "1pctCO2": {
+        "temperature": ("temperature_1pctCO2_y70_y140.npy", (2,)),
+        "airborne_fraction": ("airborne_fraction_1pctCO2_y70_y140.npy", (2,)),
+        "temperature_1000GtC": ("temperature_1pctCO2_1000GtC.npy", ()),
+        "temperature_cumulative_emissions": (
+            f"temperature_1pctCO2_{'-'.join(map(str, emissions_targets))}GtC.npy",
+            (len(emissions_targets),),
+        ),
+    },
+    "abrupt-4xCO2": {
+        "temperature": ("temperature_abrupt-4xCO2_y150.npy", ()),
+    },
+}
+
+
+def _run_idealised(experiment, prior, concentration=None):
+    """Run an idealised, concentration-driven CO2 experiment for a batch of members.
+
+    Only CO2, CH4 and N2O are included, and there is no internal variability. CH4
+    and N2O stay at their 1850 concentrations.
+
+    Parameters
+    ----------
+    experiment : str
+        "1pctCO2", run from 1850 to 1990, or "abrupt-4xCO2", run from 1850 to 2000.
+    prior : dict of array_like
+        Climate response, carbon cycle and forcing scaling parameters of the
+        members, named as in ``prior_columns`` of the parallel modules.
+    concentration : array_like
+        For 1pctCO2, concentrations of CO2, CH4 and N2O on timebounds from 1850 to
+        1990, as made by sampling/08.
+
+    Returns
+    -------
+    dict of :obj:`numpy.ndarray`
+        Outputs named in ``idealised_outputs[experiment]``, with ensemble member as
+        the last dimension.
+    """
+    if experiment not in idealised_outputs:
+        raise ValueError(f"{experiment} is not an idealised experiment")
+
+    f = FAIR()
+    f.define_time(1850, 1990 if experiment == "1pctCO2" else 2000, 1)
+    f.define_scenarios([experiment])
+    species = ["CO2", "CH4", "N2O"]
+    properties = {
+        specie: {
+            "type": specie.lower(),
+            "input_mode": "concentration",
+            "greenhouse_gas": True,
+            "aerosol_chemistry_from_emissions": False,
+            "aerosol_chemistry_from_concentration": False,
+        }
+        for specie in species
+    }
+    f.define_configs(list(range(len(prior["c1"]))))
+    f.define_species(species, properties)
+    f.allocate()
+
+    if experiment == "1pctCO2":
+        f.concentration[:] = np.asarray(concentration)[:, None, None, :]
+    else:
+        f.concentration[:] = np.array([4 * 284.3169988, 808.2490285, 273.021047])
+
+    # climate response
+    fill(
+        f.climate_configs["ocean_heat_capacity"],
+        np.array([prior["c1"], prior["c2"], prior["c3"]]).T,
+    )
+    fill(
+        f.climate_configs["ocean_heat_transfer"],
+        np.array([prior["kappa1"], prior["kappa2"], prior["kappa3"]]).T,
+    )
+    fill(f.climate_configs["deep_ocean_efficacy"], prior["epsilon"])
+    fill(f.climate_configs["gamma_autocorrelation"], prior["gamma"])
+    fill(f.climate_configs["stochastic_run"], False)
+    fill(f.climate_configs["forcing_4co2"], prior["forcing_4co2"])
+
+    # species level
+    f.fill_species_configs()
+
+    # carbon cycle
+    fill(f.species_configs["iirf_0"], prior["iirf_0"], specie="CO2")
+    fill(f.species_configs["iirf_airborne"], prior["iirf_airborne"], specie="CO2")
+    fill(f.species_configs["iirf_uptake"], prior["iirf_uptake"], specie="CO2")
+    fill(f.species_configs["iirf_temperature"], prior["iirf_temperature"], specie="CO2")
+
+    # forcing scaling
+    fill(f.species_configs["forcing_scale"], prior["scaling_CO2"], specie="CO2")
+    fill(f.species_configs["forcing_scale"], prior["scaling_CH4"], specie="CH4")
+    fill(f.species_configs["forcing_scale"], prior["scaling_N2O"], specie="N2O")
+
+    # initial condition of CO2 concentration (but not baseline for forcing calculations)
+    fill(f.species_configs["baseline_concentration"], 284.3169988, specie="CO2")
+    fill(f.species_configs["baseline_concentration"], 808.2490285, specie="CH4")
+    fill(f.species_configs["baseline_concentration"], 273.021047, specie="N2O")
+
+    fill(
+        f.species_configs["forcing_reference_concentration"], 284.3169988, specie="CO2"
+    )
+    fill(
+        f.species_configs["forcing_reference_concentration"], 808.2490285, specie="CH4"
+    )
+    fill(f.species_configs["forcing_reference_concentration"], 273.021047, specie="N2O")
+
+    # initial conditions
+    initialise(f.concentration, f.species_configs["baseline_concentration"])
+    initialise(f.forcing, 0)
+    initialise(f.temperature, 0)
+    initialise(f.cumulative_emissions, 0)
+    initialise(f.airborne_emissions, 0)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        f.run(progress=False)
+
+    temperature = f.temperature[:, 0, :, 0].data
+    if experiment == "abrupt-4xCO2":
+        return {"temperature": temperature[150]}
+
+    # warming at each of the cumulative emissions targets, in GtCO2. This is NaN if a
+    # run does not reach the target.
+    temperature_cumulative_emissions = _crossing_values(
+        f.cumulative_emissions[:, 0, :, 0].data,
+        temperature,
+        np.array(emissions_targets) * 44.009 / 12.011,
+    )
+    return {
+        "temperature": temperature[[70, 140]],
+        "airborne_fraction": f.airborne_fraction[[70, 140], 0, :, 0].data,
+        "temperature_1000GtC": temperature_cumulative_emissions[
+            emissions_targets.index(1000)
+        ],
+        "temperature_cumulative_emissions": temperature_cumulative_emissions,
+    }
+
+
+def _weighted_percentile(values, weights, q):
+    """Percentiles of weighted samples.
+
+    With equal weights, these are the same as ``numpy.percentile`` with its default
+    linear interpolation.
+
+    Parameters
+    ----------
+    values : array_like
+        Samples.
+    weights : array_like
+        Non-negative weight of each sample.
+    q : array_like of float
+        Percentiles to compute, between 0 and 100.
+
+    Returns
+    -------
+    :obj:`numpy.ndarray`
+        The percentiles.
+    """
+    values = np.asarray(values)
+    weights = np.asarray(weights)
+    keep = weights > 0
+    order = np.argsort(values[keep], kind="stable")
+    values = values[keep][order]
+    weights = weights[keep][order]
+    if len(values) == 1:
+        return np.full(np.shape(q), values[0])
+    cumulative = np.cumsum(weights) - weights
+    return np.interp(np.asarray(q) / 100, cumulative / cumulative[-1], values)
+
+
+def _assessed_samples(size=10**5):
+    """Samples of the assessed distributions that the posterior is reweighted to.
+
+    These are the targets of the reweighting in constraining/03. Skew-normal
+    distributions are fitted to the 5th, 50th and 95th percentiles of ECS and of
+    warming over 2003-2022.
+
+    Parameters
+    ----------
+    size : int
+        Number of samples of each distribution.
+
+    Returns
+    -------
+    dict of :obj:`numpy.ndarray`
+        Samples of each constrained quantity, keyed by its name.
+    """
+
+    def opt(x, q05_desired, q50_desired, q95_desired):
+        "x is (a, loc, scale) in that order."
+        q05, q50, q95 = scipy.stats.skewnorm.ppf(
+            (0.05, 0.50, 0.95), x[0], loc=x[1], scale=x[2]
+        )
+        return (q05 - q05_desired, q50 - q50_desired, q95 - q95_desired)
+
+    NINETY_TO_ONESIGMA = scipy.stats.norm.ppf(0.95)
+
+    ecs_params = scipy.optimize.root(opt, [1, 1, 1], args=(2, 3, 5)).x
+    gsat_params = scipy.optimize.root(opt, [1, 1, 1], args=(0.87, 1.03, 1.13)).x
+
+    assessed = {}
+    assessed["ECS"] = scipy.stats.skewnorm.rvs(
+        ecs_params[0],
+        loc=ecs_params[1],
+        scale=ecs_params[2],
+        size=size,
+        random_state=91603,
+    )
+    assessed["TCR"] = scipy.stats.norm.rvs(
+        loc=1.8, scale=0.6 / NINETY_TO_ONESIGMA, size=size, random_state=18196
+    )
+    # note fair produces, and we here report, total earth energy uptake, not just
+    # ocean this value from IGCC 2023. Use new uncertainties for ocean, assume same
+    # uncertainties for land, atmosphere and cryopshere.
+    assessed["OHC"] = scipy.stats.norm.rvs(
+        loc=465.3, scale=108.5 / NINETY_TO_ONESIGMA, size=size, random_state=43178
+    )
+    assessed["temperature 2003-2022"] = scipy.stats.skewnorm.rvs(
+        gsat_params[0],
+        loc=gsat_params[1],
+        scale=gsat_params[2],
+        size=size,
+        random_state=19387,
+    )
+    assessed["ERFari"] = scipy.stats.norm.rvs(
+        loc=-0.3, scale=0.3 / NINETY_TO_ONESIGMA, size=size, random_state=70173
+    )
+    assessed["ERFaci"] = scipy.stats.norm.rvs(
+        loc=-1.0, scale=0.7 / NINETY_TO_ONESIGMA, size=size, random_state=91123
+    )
+    assessed["ERFaer"] = scipy.stats.norm.rvs(
+        loc=-1.3,
+        scale=np.sqrt(0.7**2 + 0.3**2) / NINETY_TO_ONESIGMA,
+        size=size,
+        random_state=3916153,
+    )
+    # IGCC paper: 417.1 +/- 0.4
+    # IGCC dataset: 416.9
+    # my assessment 417.0 +/- 0.5
+    assessed["CO2 concentration"] = scipy.stats.norm.rvs(
+        loc=417.0, scale=0.5, size=size, random_state=81693
+    )
+    return assessed
+
+
+def _binned_kde(dataset, weights=None, gridsize=2**14):
+    """Gaussian kernel density estimate of one variable, binned onto a fine grid.
+
+    The samples are binned linearly onto an evenly spaced grid, which is convolved
+    with the kernel by FFT. This costs O(N) in the number of samples, rather than
+    O(N·M) for M points evaluated by ``scipy.stats.gaussian_kde``. The bandwidth is
+    from Scott's rule, as the default of ``scipy.stats.gaussian_kde``, with the
+    effective number of samples if they are weighted.
+
+    Parameters
+    ----------
+    dataset : array_like
+        Samples.
+    weights : array_like
+        Weight of each sample. If ``None``, samples are weighted equally.
+    gridsize : int
+        Number of points in the grid.
+
+    Returns
+    -------
+    function
+        The density at given points, interpolated from the grid. It is zero more than
+        five bandwidths outside the range of the samples.
+    """
+    dataset = np.asarray(dataset, dtype=float)
+    if weights is None:
+        weights = np.ones(len(dataset))
+    weights = np.asarray(weights, dtype=float) / np.sum(weights)
+    n_effective = 1 / np.sum(weights**2)
+    bandwidth = 0
+    if n_effective > 1:
+        bandwidth = np.sqrt(np.cov(dataset, aweights=weights)) * n_effective ** (-1 / 5)
+    # Scott's rule gives no width if the samples with weight all have the same value,
+    # e.g. a fixed parameter or a single member. The kernel is then one bin wide, on a
+    # grid over the range of the samples, or over their magnitude if they are all equal.
+    if not bandwidth > 0:
+        bandwidth = (np.ptp(dataset) or np.max(np.abs(dataset)) or 1) / gridsize
+
+    grid = np.linspace(
+        dataset.min() - 5 * bandwidth, dataset.max() + 5 * bandwidth, gridsize
+    )
+    delta = grid[1] - grid[0]
+    position = (dataset - grid[0]) / delta
+    left = np.floor(position).astype(int)
+    fraction = position - left
+    binned = np.bincount(left, weights=weights * (1 - fraction), minlength=gridsize)
+    binned += np.bincount(left + 1, weights=weights * fraction, minlength=gridsize)
+
+    # padded with zeros, so that the convolution does not wrap around
+    size = 2 * gridsize
+    offsets = np.fft.fftfreq(size, 1 / size) * delta
+    kernel = np.exp(-0.5 * (offsets / bandwidth) ** 2)
+    kernel = kernel / (bandwidth * np.sqrt(2 * np.pi))
+    density = np.fft.irfft(np.fft.rfft(binned, size) * np.fft.rfft(kernel), size)
+    density = density[:gridsize]
+
+    def evaluate(points):
+        return np.interp(points, grid, density, left=0, right=0)
+
+    return evaluate
+
+
+def _save_posterior_weights(filename, runids, weights):
+    """Save the posterior weight of each ensemble member passing the RMSE constraint.
+
+    Parameters
+    ----------
+    filename : str
+        Location of the CSV file.
+    runids : array_like of int
+        Run IDs of the members.
+    weights : array_like of float
+        Weight of each member.
+    """
+    pd.DataFrame({"weight": weights}, index=pd.Index(runids, name="runid")).to_csv(
+        filename
+    )
+
+
+def _load_posterior_weights(filename):
+    """Load weights saved by ``_save_posterior_weights``.
+
+    Returns
+    -------
+    runids : :obj:`numpy.ndarray`
+        Run IDs of the members.
+    weights : :obj:`numpy.ndarray`
+        Weight of each member.
+    """
+    # read the weights back exactly as they were saved
+    df = pd.read_csv(filename, index_col="runid", float_precision="round_trip")
+    return df.index.values, df["weight"].values
+
+
+def _draw_one(runids, weights, size, random_state):
+    return (
+        pd.Series(runids)
+        .sample(n=size, replace=False, weights=weights, random_state=random_state)
+        .values
+    )
+
+
+def _draw_posterior(runids, weights, size, draws=1, random_state=10099, pool=None):
+    """Draw posterior ensembles from weighted ensemble members without replacement.
+
+    Each draw is made as ``pandas.DataFrame.sample`` does, so the first draw, with the
+    default ``random_state``, is the posterior drawn by constraining/03.
+
+    Parameters
+    ----------
+    runids : array_like of int
+        Run IDs of the members to draw from.
+    weights : array_like of float
+        Weight of each member.
+    size : int
+        Number of members in each draw.
+    draws : int
+        Number of independent draws.
+    random_state : int
+        Seed of the first draw. Draw ``i`` uses ``random_state + i``.
+    pool : :obj:`concurrent.futures.Executor`
+        If given, draws are spread across the workers of this pool.
+
+    Returns
+    -------
+    :obj:`numpy.ndarray`
+        Run IDs of the members in each draw, in the order drawn, with shape
+        ``(draws, size)``.
+    """
+    args = (
+        [runids] * draws,
+        [weights] * draws,
+        [size] * draws,
+        [random_state + i for i in range(draws)],
+    )
+    if pool is None:
+        return np.array(list(map(_draw_one, *args)))
+    return np.array(list(pool.map(_draw_one, *args)))
+
+
+def _max_rss():
+    """Peak resident set size of this process so far, in MiB."""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # reported in bytes on macOS, and KiB elsewhere
+    return max_rss / 2**20 if sys.platform == "darwin" else max_rss / 2**10
+
+
+class _PhaseTimer:
+    """Time the phases of a job, if ``TIMING`` is set.
+
+    Each call to ``lap`` ends a phase, which started at the end of the last one or
+    when the timer was created. The wall time, CPU time and peak memory of the
+    process at the end of each phase are recorded in ``phases``.
+    """
+
+    def __init__(self):
+        self.phases = {}
+        self._start()
+
+    def _start(self):
+        self._time = time.time()
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+
+    def lap(self, name):
+        """End a phase of the job, and start the next."""
+        if not timing:
+            return
+        self.phases[name] = {
+            "start": self._time,
+            "wall": time.perf_counter() - self._wall,
+            "cpu": time.process_time() - self._cpu,
+            "max_rss": _max_rss(),
+        }
+        self._start()
+
+    def result(self, members):
+        """Timings of the job to return to the parent, or ``None`` if not timing."""
+        if not timing:
+            return None
+        return {"pid": os.getpid(), "members": members, "phases": self.phases}
+
+
+def _save_timing_report(filename, jobs, workers, elapsed, parent=None):
+    """Summarise the timings of the jobs of a parallel run in a JSON report.
+
+    Parameters
+    ----------
+    filename : str
+        Location of the report.
+    jobs : list of dict
+        Result of ``_PhaseTimer.result`` for each job.
+    workers : int
+        Number of worker processes.
+    elapsed : float
+        Wall time of the parallel run, from starting the workers to the last job
+        completing, in seconds.
+    parent : dict
+        Phases of the parent process timed by a ``_PhaseTimer``, if any.
+
+    Returns
+    -------
+    dict
+        The report. Along with the timings of every job, this has the throughput in
+        ensemble members per second, the utilisation of the workers, which is the
+        fraction of ``elapsed`` spent running jobs, and the total, mean, 5th, 50th and
+        95th percentiles and maximum wall and CPU time of each phase of the jobs.
+    """
+    busy = {}
+    for job in jobs:
+        busy[job["pid"]] = busy.get(job["pid"], 0) + sum(
+            phase["wall"] for phase in job["phases"].values()
+        )
+
+    phases = {}
+    for name in dict.fromkeys(name for job in jobs for name in job["phases"]):
+        phase = [job["phases"][name] for job in jobs if name in job["phases"]]
+        phases[name] = {"jobs": len(phase), "max_rss": max(p["max_rss"] for p in phase)}
+        for measure in ["wall", "cpu"]:
+            values = np.array([p[measure] for p in phase])
+            phases[name][measure] = {
+                "total": np.sum(values),
+                "mean": np.mean(values),
+                "p5": np.percentile(values, 5),
+                "p50": np.percentile(values, 50),
+                "p95": np.percentile(values, 95),
+                "max": np.max(values),
+            }
+
+    members = sum(job["members"] for job in jobs)
+    report = {
+        "workers": workers,
+        "jobs": len(jobs),
+        "members": members,
+        "elapsed": elapsed,
+        "members_per_second": members / elapsed,
+        "utilisation": sum(busy.values()) / (workers * elapsed),
+        "worker_utilisation": {str(pid): busy[pid] / elapsed for pid in busy},
+        "parent": parent or {},
+        "phases": phases,
+        "job_timings": jobs,
+    }
+    with open(filename, "w") as f:
+        json.dump(report, f, indent=2)
+    return report
@@ -20,8 +20,8 @@ import pandas as pd
 import scipy.linalg
 import scipy.stats
 from dotenv import load_dotenv
-from fair.energy_balance_model import EnergyBalanceModel
 from tqdm import tqdm
+from utils import _kde_ppf, _prior_uniforms, _save_prior, prior_sampling
 
 warnings.simplefilter("error", RuntimeWarning)
 
@@ -128,60 +128,125 @@ if plots:
 
 NINETY_TO_ONESIGMA = scipy.stats.norm.ppf(0.95)
 
-kde = scipy.stats.gaussian_kde(params.T)
-ebm_sample = kde.resample(size=int(samples * 4), seed=2181882)
 
-# remove unphysical combinations
-for col in range(10):
-    ebm_sample[:, ebm_sample[col, :] <= 0] = np.nan
-ebm_sample[:, ebm_sample[0, :] <= 0.5] = np.nan  # gamma
-ebm_sample[:, ebm_sample[1, :] <= 1.8] = np.nan  # C1
-ebm_sample[:, ebm_sample[2, :] <= ebm_sample[1, :]] = np.nan  # C2
-ebm_sample[:, ebm_sample[3, :] <= ebm_sample[2, :]] = np.nan  # C3
-ebm_sample[:, ebm_sample[4, :] <= 0.3] = np.nan  # kappa1 = lambda
+# check that covariance matrix is positive semidefinite and if not, remove param combo.
+# FaIR draws internal variability from the covariance matrix of the discretised noise
+# of each energy balance model, built as in ``EnergyBalanceModel.stochastic_d``, with
+# ``scipy.stats.multivariate_normal.rvs``. This would fail for the samples removed here.
+# The matrices of a chunk of samples are built and checked at once.
+def eb_matrices(ebm_sample):
+    """Energy balance matrices of stochastic 3-layer models, for each sample.
+
+    These are the same as ``EnergyBalanceModel._eb_matrix``, stacked along the first
+    dimension.
+    """
+    gamma, c1, c2, c3, kappa1, kappa2, kappa3, epsilon = ebm_sample[:8]
+    eb_matrix = np.zeros((ebm_sample.shape[1], 4, 4))
+    eb_matrix[:, 0, 0] = -gamma
+    eb_matrix[:, 1, 0] = 1 / c1
+    eb_matrix[:, 1, 1] = -(kappa1 + kappa2) / c1
+    eb_matrix[:, 1, 2] = kappa2 / c1
+    eb_matrix[:, 2, 1] = kappa2 / c2
+    eb_matrix[:, 2, 2] = -(kappa2 + epsilon * kappa3) / c2
+    eb_matrix[:, 2, 3] = epsilon * kappa3 / c2
+    eb_matrix[:, 3, 2] = kappa3 / c3
+    eb_matrix[:, 3, 3] = -kappa3 / c3
+    return eb_matrix
 
-mask = np.all(np.isnan(ebm_sample), axis=0)
-ebm_sample = ebm_sample[:, ~mask]
 
-# check that covariance matrix is positive semidefinite and if not, remove param combo.
-# to do: change away from sparse, once we move away from R
-for isample in tqdm(range(len(ebm_sample.T)), disable=1 - progress):
-    ebm = EnergyBalanceModel(
-        ocean_heat_capacity=ebm_sample[1:4, isample],
-        ocean_heat_transfer=ebm_sample[4:7, isample],
-        deep_ocean_efficacy=ebm_sample[7, isample],
-        gamma_autocorrelation=ebm_sample[0, isample],
-        sigma_xi=ebm_sample[9, isample],
-        sigma_eta=ebm_sample[8, isample],
-        forcing_4co2=ebm_sample[10, isample],
-        stochastic_run=True,
+def noise_covariances(ebm_sample):
+    """Covariance matrices of the discretised noise of each sample.
+
+    The matrix exponentials of Van Loan (1978) are calculated for all samples at once.
+    """
+    eb_matrix = eb_matrices(ebm_sample)
+    h_mat = np.zeros((ebm_sample.shape[1], 8, 8))
+    h_mat[:, :4, :4] = -eb_matrix
+    h_mat[:, 0, 4] = ebm_sample[8] ** 2
+    h_mat[:, 1, 5] = (ebm_sample[9] / ebm_sample[1]) ** 2
+    h_mat[:, 4:, 4:] = np.swapaxes(eb_matrix, 1, 2)
+    g_mat = scipy.linalg.expm(h_mat)
+    return np.swapaxes(g_mat[:, 4:, 4:], 1, 2) @ g_mat[:, :4, 4:]
+
+
+def positive_semidefinite(cov):
+    """Which covariance matrices ``scipy.stats.multivariate_normal.rvs`` accepts.
+
+    These are the tests that it makes, with the same tolerances:
+    - every element is finite;
+    - no eigenvalue, from the lower triangle, is below -1e6 times machine epsilon
+      times the largest eigenvalue in magnitude (``scipy.stats``);
+    - the matrix rebuilt from its singular value decomposition is within 1e-8,
+      relative and absolute, of the matrix, so it is symmetric and positive
+      semidefinite (``numpy.random.multivariate_normal``, whose warning is an error
+      in this script).
+    """
+    finite = np.all(np.isfinite(cov), axis=(1, 2))
+    cov = np.where(finite[:, None, None], cov, 0)
+    eigenvalues = np.linalg.eigvalsh(cov)
+    tolerance = 1e6 * np.finfo(np.float64).eps * np.max(np.abs(eigenvalues), axis=1)
+    _, singular_values, vh = np.linalg.svd(cov)
+    rebuilt = (np.swapaxes(vh, 1, 2) * singular_values[:, None, :]) @ vh
+    return (
+        finite
+        & (np.min(eigenvalues, axis=1) >= -tolerance)
+        & np.all(np.isclose(rebuilt, cov, rtol=1e-8, atol=1e-8), axis=(1, 2))
     )
-    eb_matrix = ebm._eb_matrix()
-    q_mat = np.zeros((4, 4))
-    q_mat[0, 0] = ebm.sigma_eta**2
-    q_mat[1, 1] = (ebm.sigma_xi / ebm.ocean_heat_capacity[0]) ** 2
-    h_mat = np.zeros((8, 8))
-    h_mat[:4, :4] = -eb_matrix
-    h_mat[:4, 4:] = q_mat
-    h_mat[4:, 4:] = eb_matrix.T
-    g_mat = scipy.sparse.linalg.expm(h_mat)
-    q_mat_d = g_mat[4:, 4:].T @ g_mat[:4, 4:]
-    q_mat_d = q_mat_d.astype(np.float64)
-
-    # I can't work out exactly what checks scipy is doing to decide the param
-    # set is a fail. Best to just let it tell me if it likes it or not.
-    try:
-        scipy.stats.multivariate_normal.rvs(size=1, mean=np.zeros(4), cov=q_mat_d)
-    except:  # noqa: E722
-        ebm_sample[:, isample] = np.nan
-
-mask = np.all(np.isnan(ebm_sample), axis=0)
-ebm_sample = ebm_sample[:, ~mask]
-
-print("Total number of retained samples:", len(ebm_sample.T))
+
+
+def screen(ebm_sample):
+    """Samples that are physical, and whose noise covariance is positive semidefinite.
+
+    Samples are along the second dimension.
+    """
+    # remove unphysical combinations
+    valid = np.all(ebm_sample[:10] > 0, axis=0)
+    valid &= ebm_sample[0] > 0.5  # gamma
+    valid &= ebm_sample[1] > 1.8  # C1
+    valid &= ebm_sample[2] > ebm_sample[1]  # C2
+    valid &= ebm_sample[3] > ebm_sample[2]  # C3
+    valid &= ebm_sample[4] > 0.3  # kappa1 = lambda
+    ebm_sample = ebm_sample[:, valid]
+    return ebm_sample[:, positive_semidefinite(noise_covariances(ebm_sample))]
+
+
+kde = scipy.stats.gaussian_kde(params.T)
+
+# draw from the KDE a chunk at a time, keeping the samples that pass the screening,
+# until there are PRIOR_SAMPLES of them. Each chunk has its own seed from the same
+# sequence, so the prior of a smaller ensemble is the start of that of a larger one.
+# With PRIOR_SAMPLING, the chunks are consecutive rows of the design instead, and for
+# "sobol" each chunk is a power of 2 rows so that it keeps the balance of the design.
+# Screening means that member i is not row i, unlike the other priors.
+chunk_size = 2**17 if prior_sampling == "sobol" else 100000
+seed_sequence = np.random.SeedSequence(2181882)
+ebm_sample = []
+n_accepted = 0
+n_passed = 0
+n_drawn = 0
+with tqdm(total=samples, disable=1 - progress) as bar:
+    while n_accepted < samples:
+        if prior_sampling == "random":
+            chunk = kde.resample(
+                size=chunk_size, seed=np.random.default_rng(seed_sequence.spawn(1)[0])
+            )
+        else:
+            chunk = _kde_ppf(
+                kde,
+                _prior_uniforms("climate_response_ebm3", chunk_size, start=n_drawn),
+            )
+        chunk = screen(chunk)
+        n_drawn += chunk_size
+        n_passed += chunk.shape[1]
+        ebm_sample.append(chunk[:, : samples - n_accepted])
+        n_accepted += ebm_sample[-1].shape[1]
+        bar.update(ebm_sample[-1].shape[1])
+        bar.set_postfix(acceptance=f"{n_passed / n_drawn:.1%}")
+ebm_sample = np.concatenate(ebm_sample, axis=1)
+print(f"Acceptance rate: {n_passed / n_drawn:.1%} of {n_drawn} draws")
 
 ebm_sample_df = pd.DataFrame(
-    data=ebm_sample[:, :samples].T,
+    data=ebm_sample.T,
     columns=[
         "gamma",
         "c1",
@@ -197,17 +262,16 @@ ebm_sample_df = pd.DataFrame(
     ],
 )
 
-assert len(ebm_sample_df) >= samples
 
 os.makedirs(
     f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/priors/",
     exist_ok=True,
 )
 
-ebm_sample_df.to_csv(
+_save_prior(
     f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/priors/"
-    "climate_response_ebm3.csv",
-    index=False,
+    "climate_response_ebm3",
+    ebm_sample_df,
 )
 
 # what we do want to do is to scale the variability in 4xCO2 (correlated with the other
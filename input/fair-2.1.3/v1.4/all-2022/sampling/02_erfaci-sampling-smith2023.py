@@ -17,7 +17,7 @@ import pooch
 import scipy.stats
 from dotenv import load_dotenv
 from scipy.optimize import curve_fit
-from tqdm import tqdm
+from utils import _erfaci, _kde_ppf, _prior_uniforms, _save_prior, prior_sampling
 
 load_dotenv()
 
@@ -136,11 +136,6 @@ for model in models:
     )
 
 
-def aci_log_nocorrect(x, beta, n0, n1, n2):
-    aci = beta * np.log(1 + x[0] * n0 + x[1] * n1 + x[2] * n2)
-    return aci
-
-
 if plots:
     colors = {
         "CanESM5": "red",
@@ -231,7 +226,12 @@ n2_samp = df_params["OC"]
 kde = scipy.stats.gaussian_kde(
     [np.log(n0_samp), np.log(n1_samp), np.log(n2_samp)], bw_method=0.1
 )
-aci_sample = kde.resample(size=samples * 1, seed=63648708)
+# four columns of the design for the KDE and one for ERFaci
+if prior_sampling == "random":
+    aci_sample = kde.resample(size=samples * 1, seed=63648708)
+else:
+    uniforms = _prior_uniforms("aerosol_cloud", samples)
+    aci_sample = _kde_ppf(kde, uniforms[:, :4])
 
 # aci_sample[0, aci_sample[0, :] < 0] = np.nan
 # aci_sample[1, aci_sample[1, :] < 0] = np.nan
@@ -240,9 +240,14 @@ aci_sample = kde.resample(size=samples * 1, seed=63648708)
 # aci_sample = aci_sample[:, ~mask]
 
 # trapezoid distribution [-2.2, -1.7, -1.0, -0.3, +0.2]
-erfaci_sample = scipy.stats.trapezoid.rvs(
-    0.25, 0.75, size=samples, loc=-2.2, scale=2.4, random_state=71271
-)
+if prior_sampling == "random":
+    erfaci_sample = scipy.stats.trapezoid.rvs(
+        0.25, 0.75, size=samples, loc=-2.2, scale=2.4, random_state=71271
+    )
+else:
+    erfaci_sample = scipy.stats.trapezoid.ppf(
+        uniforms[:, 4], 0.25, 0.75, loc=-2.2, scale=2.4
+    )
 
 # Sampling with updated emissions.
 df_emis_obs = pd.read_csv(
@@ -256,26 +261,7 @@ so2 = df_emis_obs["SO2"].values
 bc = df_emis_obs["BC"].values
 oc = df_emis_obs["OC"].values
 
-beta = np.zeros(samples)
-# erfaci = np.zeros((273, samples))
-for i in tqdm(range(samples), desc="aci samples", disable=1 - progress):
-    ts2010 = np.mean(
-        aci_log_nocorrect(
-            [so2[255:265], bc[255:265], oc[255:265]],
-            1,
-            np.exp(aci_sample[0, i]),
-            np.exp(aci_sample[1, i]),
-            np.exp(aci_sample[2, i]),
-        )
-    )
-    ts1750 = aci_log_nocorrect(
-        [so2[0], bc[0], oc[0]],
-        1,
-        np.exp(aci_sample[0, i]),
-        np.exp(aci_sample[1, i]),
-        np.exp(aci_sample[2, i]),
-    )
-    beta[i] = erfaci_sample[i] / (ts2010 - ts1750)
+beta = erfaci_sample / _erfaci(np.exp(aci_sample), [so2, bc, oc])
 
 df = pd.DataFrame(
     {
@@ -291,8 +277,8 @@ os.makedirs(
     exist_ok=True,
 )
 
-df.to_csv(
+_save_prior(
     f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/priors/"
-    "aerosol_cloud.csv",
-    index=False,
+    "aerosol_cloud",
+    df,
 )
@@ -21,6 +21,7 @@ import numpy as np
 import pandas as pd
 import scipy.stats
 from dotenv import load_dotenv
+from utils import _prior_uniforms, _save_prior, prior_sampling
 
 load_dotenv()
 
@@ -286,15 +287,20 @@ unc_scale = 0.3 / (
 )
 
 # convert to numpy for efficiency
-erfari_re_samples = pd.DataFrame(
-    scipy.stats.norm.rvs(
+if prior_sampling == "random":
+    erfari_re = scipy.stats.norm.rvs(
         re * best_scale,
         re_std * unc_scale,
         size=(samples, 9),
         random_state=3729329,
-    ),
-    columns=re.index,
-)[
+    )
+else:
+    erfari_re = scipy.stats.norm.ppf(
+        _prior_uniforms("aerosol_radiation", samples),
+        re * best_scale,
+        re_std * unc_scale,
+    )
+erfari_re_samples = pd.DataFrame(erfari_re, columns=re.index)[
     [
         "BC",
         "OC",
@@ -315,8 +321,8 @@ os.makedirs(
     exist_ok=True,
 )
 
-erfari_re_samples.to_csv(
+_save_prior(
     f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/priors/"
-    "aerosol_radiation.csv",
-    index=False,
+    "aerosol_radiation",
+    erfari_re_samples,
 )
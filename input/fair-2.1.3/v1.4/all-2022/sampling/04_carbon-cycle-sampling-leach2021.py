@@ -16,6 +16,7 @@ import scipy.stats
 from dotenv import load_dotenv
 from fair import __version__
 from fair.structure.units import compound_convert
+from utils import _kde_ppf, _prior_uniforms, _save_prior, prior_sampling
 
 load_dotenv()
 
@@ -111,7 +112,10 @@ params = pd.DataFrame(data.T, columns=["r0", "rU", "rT", "rA"], index=models)
 
 
 kde = scipy.stats.gaussian_kde(params.T)
-cc_sample = kde.resample(size=int(samples), seed=2421911)
+if prior_sampling == "random":
+    cc_sample = kde.resample(size=int(samples), seed=2421911)
+else:
+    cc_sample = _kde_ppf(kde, _prior_uniforms("carbon_cycle", samples))
 
 mask = np.all(np.isnan(cc_sample), axis=0)
 cc_sample = cc_sample[:, ~mask]
@@ -124,8 +128,8 @@ os.makedirs(
     exist_ok=True,
 )
 
-cc_sample_df.to_csv(
+_save_prior(
     f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/priors/"
-    "carbon_cycle.csv",
-    index=False,
+    "carbon_cycle",
+    cc_sample_df,
 )
@@ -17,6 +17,7 @@ from dotenv import load_dotenv
 from fair import __version__
 from scipy.interpolate import interp1d
 from scipy.optimize import curve_fit
+from utils import _prior_uniforms, _save_prior, prior_sampling
 
 load_dotenv()
 
@@ -383,9 +384,8 @@ print(p)  # these coefficients we export to the ERF time series
 
 NINETY_TO_ONESIGMA = scipy.stats.norm.ppf(0.95)
 
-scalings = scipy.stats.norm.rvs(
-    loc=np.array(p),
-    scale=np.array(
+ozone_scale = (
+    np.array(
         [
             0.05 / delta_Cch4 / fac_cmip6_skeie,
             0.02 / delta_Cn2o / fac_cmip6_skeie,
@@ -395,11 +395,20 @@ scalings = scipy.stats.norm.rvs(
             0.11 / delta_Enox / fac_cmip6_skeie,
         ]
     )
-    # scale=np.array([0.000062, 0.000471, 0.000113, 0.000131, 0.000328, 0.000983])
-    / NINETY_TO_ONESIGMA,
-    size=(samples, 6),
-    random_state=52,
+    # np.array([0.000062, 0.000471, 0.000113, 0.000131, 0.000328, 0.000983])
+    / NINETY_TO_ONESIGMA
 )
+if prior_sampling == "random":
+    scalings = scipy.stats.norm.rvs(
+        loc=np.array(p),
+        scale=ozone_scale,
+        size=(samples, 6),
+        random_state=52,
+    )
+else:
+    scalings = scipy.stats.norm.ppf(
+        _prior_uniforms("ozone", samples), loc=np.array(p), scale=ozone_scale
+    )
 
 # 90% ranges - for paper
 print(
@@ -431,7 +440,7 @@ os.makedirs(
     f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/priors/",
     exist_ok=True,
 )
-df.to_csv(
-    f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/priors/ozone.csv",
-    index=False,
+_save_prior(
+    f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/priors/ozone",
+    df,
 )
@@ -10,11 +10,13 @@
 
 import os
 
+import numpy as np
 import pandas as pd
 import scipy.stats
 from dotenv import load_dotenv
 from fair import __version__
 from sklearn.preprocessing import QuantileTransformer
+from utils import _open_prior, _prior_uniforms, _save_prior, prior_sampling
 
 load_dotenv()
 
@@ -42,12 +44,24 @@ forcing_u90 = {
     "solar_trend": 0.07,
 }
 
+# one column of the design for each forcer, and the last for LAPSI
+if prior_sampling != "random":
+    uniforms = _prior_uniforms("forcing_scaling", samples)
+
 seedgen = 380133900
 scalings = {}
-for forcer in forcing_u90:
-    scalings[forcer] = scipy.stats.norm.rvs(
-        1, forcing_u90[forcer] / NINETY_TO_ONESIGMA, size=samples, random_state=seedgen
-    )
+for iforcer, forcer in enumerate(forcing_u90):
+    if prior_sampling == "random":
+        scalings[forcer] = scipy.stats.norm.rvs(
+            1,
+            forcing_u90[forcer] / NINETY_TO_ONESIGMA,
+            size=samples,
+            random_state=seedgen,
+        )
+    else:
+        scalings[forcer] = scipy.stats.norm.ppf(
+            uniforms[:, iforcer], 1, forcing_u90[forcer] / NINETY_TO_ONESIGMA
+        )
     seedgen = seedgen + 112
 
 
@@ -63,33 +77,39 @@ def opt(x, q05_desired, q50_desired, q95_desired):
 lapsi_params = scipy.optimize.root(opt, [1, 1, 1], args=(0, 1, 2.25)).x
 contrails_params = scipy.optimize.root(opt, [1, 1, 1], args=(19 / 57, 1, 98 / 57)).x
 
-scalings["Light absorbing particles on snow and ice"] = scipy.stats.skewnorm.rvs(
-    lapsi_params[0],
-    loc=lapsi_params[1],
-    scale=lapsi_params[2],
-    size=samples,
-    random_state=3701584,
-)
+if prior_sampling == "random":
+    scalings["Light absorbing particles on snow and ice"] = scipy.stats.skewnorm.rvs(
+        lapsi_params[0],
+        loc=lapsi_params[1],
+        scale=lapsi_params[2],
+        size=samples,
+        random_state=3701584,
+    )
+else:
+    scalings["Light absorbing particles on snow and ice"] = scipy.stats.skewnorm.ppf(
+        uniforms[:, -1], lapsi_params[0], loc=lapsi_params[1], scale=lapsi_params[2]
+    )
 
 # Solar trend is absolute, not scaled
 scalings["solar_trend"] = scalings["solar_trend"] - 1
 
-# CO2 scaling is quantile mapping from ERF 4xCO2 and +/- 12%
-df_ebm = pd.read_csv(
+# CO2 scaling is quantile mapping from ERF 4xCO2 and +/- 12%, read from the store of
+# the climate response prior written by sampling/01
+ebm = _open_prior(
     f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/priors/"
-    "climate_response_ebm3.csv"
+    "climate_response_ebm3"
 )
 
 qt = QuantileTransformer(output_distribution="normal", random_state=70601701)
-f4xco2 = df_ebm["F_4xCO2"].values.reshape(-1, 1)
+f4xco2 = np.asarray(ebm["F_4xCO2"]).reshape(-1, 1)
 trans = qt.fit(f4xco2).transform(f4xco2)
 trans = 1 + trans * 0.12 / NINETY_TO_ONESIGMA
 scalings["CO2"] = trans.squeeze()
 
 df_out = pd.DataFrame(scalings, columns=scalings.keys())
 
-df_out.to_csv(
+_save_prior(
     f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/priors/"
-    "forcing_scaling.csv",
-    index=False,
+    "forcing_scaling",
+    df_out,
 )
@@ -12,6 +12,7 @@ import pandas as pd
 import scipy.stats
 from dotenv import load_dotenv
 from fair import __version__
+from utils import _prior_uniforms, _save_prior, prior_sampling
 
 load_dotenv()
 
@@ -28,14 +29,21 @@ samples = int(os.getenv("PRIOR_SAMPLES"))
 assert fair_v == __version__
 
 NINETY_TO_ONESIGMA = scipy.stats.norm.ppf(0.95)
-co2_1750_conc = scipy.stats.norm.rvs(
-    size=samples, loc=278.3, scale=2.9 / NINETY_TO_ONESIGMA, random_state=1067061
-)
+if prior_sampling == "random":
+    co2_1750_conc = scipy.stats.norm.rvs(
+        size=samples, loc=278.3, scale=2.9 / NINETY_TO_ONESIGMA, random_state=1067061
+    )
+else:
+    co2_1750_conc = scipy.stats.norm.ppf(
+        _prior_uniforms("co2_concentration_1750", samples)[:, 0],
+        loc=278.3,
+        scale=2.9 / NINETY_TO_ONESIGMA,
+    )
 
 df = pd.DataFrame({"co2_concentration": co2_1750_conc})
 
-df.to_csv(
+_save_prior(
     f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/priors/"
-    "co2_concentration_1750.csv",
-    index=False,
+    "co2_concentration_1750",
+    df,
 )
@@ -15,19 +15,70 @@
 #
 # We have to do this slightly differently to the examples so far. 1.5 million ensemble
 # members is going to take up too much memory, so we run in batches of 1000,
-# initialising a new FaIR instance for each batch, and saving the output as we go.
+# reusing one FaIR instance per worker process, and each batch writes its output
+# straight into memory-mapped files on disk as it goes.
+#
+# Completed batches are recorded in a manifest alongside the output. If the run is
+# interrupted, running this script again only runs the batches that are not complete,
+# provided the priors, other inputs and settings have not changed.
+#
+# Each worker reduces its runs to the observables that the constraints need, such as
+# the RMSE of historical temperature and mean warming over 2003-2022. The full
+# temperature time series is only kept for members with an RMSE below
+# TRAJECTORY_RMSE_CEILING, by default RMSE_CEILING, the first constraint in
+# constraining/01, and every TRAJECTORY_STRIDE-th member as a sample of the prior.
+#
+# With TWO_STAGE set, every member is first run to 2023 only, which is enough for all
+# of the observables. Only the members to keep the time series of are then run to
+# 2101.
+#
+# With IDEALISED_EXPERIMENTS set, e.g. to 1pctCO2,abrupt-4xCO2, each batch also runs
+# these experiments on the same parameters, for every member. Then constraining/02
+# takes its 1pctCO2 results from here rather than running them again.
+#
+# With ABC_SMC set, only the members of the prior that the posterior needs are run,
+# chosen adaptively by sequential Monte Carlo in abc_smc.py.
 
 
 import multiprocessing
 import os
+import sys
+import tempfile
+import time
 from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
-import pandas as pd
+from abc_smc import run_abc_smc
 from dotenv import load_dotenv
 from fair import __version__
-from parallel import run_fair
-from utils import _parallel_process
+from parallel import (
+    allocate_outputs,
+    init_worker,
+    kept_members,
+    manifest_file,
+    output_dir,
+    output_files,
+    outputs,
+    publish_inputs,
+    run_fair,
+    survivors_manifest_file,
+    timing_file,
+    trajectory_rmse_ceiling,
+    trajectory_stride,
+)
+from utils import (
+    _fingerprint,
+    _is_complete,
+    _load_manifest,
+    _parallel_process,
+    _PhaseTimer,
+    _save_manifest,
+    _save_timing_report,
+    _split_batch,
+    abc_smc,
+    idealised_experiments,
+    timing,
+)
 
 if __name__ == "__main__":
     print("Running the priors (could take a while)...")
@@ -39,273 +90,194 @@ if __name__ == "__main__":
     samples = int(os.getenv("PRIOR_SAMPLES"))
     batch_size = int(os.getenv("BATCH_SIZE"))
     WORKERS = int(os.getenv("WORKERS"))
+    two_stage = os.getenv("TWO_STAGE", "False").lower() in ("true", "1", "t")
 
     # number of processors
     WORKERS = min(multiprocessing.cpu_count(), WORKERS)
 
     assert fair_v == __version__
 
-    df_solar = pd.read_csv(
-        "../../../../../data/forcing/solar_erf_timebounds.csv", index_col="year"
-    )
-    df_volcanic = pd.read_csv(
-        "../../../../../data/forcing/volcanic_ERF_1750-2101_timebounds.csv",
-        index_col="timebounds",
-    )
-
-    volcanic_forcing = df_volcanic["erf"].loc[1750:2101].values
-    solar_forcing = df_solar["erf"].loc[1750:2101].values
-
-    df_cc = pd.read_csv(
-        f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/priors/"
-        "carbon_cycle.csv"
-    )
-    df_cr = pd.read_csv(
-        f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/priors/"
-        "climate_response_ebm3.csv"
-    )
-    df_aci = pd.read_csv(
+    # the schema of each prior store includes the hash of each of its columns
+    prior_files = [
         f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/priors/"
-        "aerosol_cloud.csv"
-    )
-    df_ari = pd.read_csv(
-        f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/priors/"
-        "aerosol_radiation.csv"
-    )
-    df_ozone = pd.read_csv(
-        f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/priors/"
-        "ozone.csv"
-    )
-    df_scaling = pd.read_csv(
-        f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/priors/"
-        "forcing_scaling.csv"
-    )
-    df_1750co2 = pd.read_csv(
-        f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/priors/"
-        "co2_concentration_1750.csv"
-    )
-    df_methane = pd.read_csv(
-        f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/calibrations/"
-        "CH4_lifetime.csv",
-        index_col=0,
-    )
-    df_landuse = pd.read_csv(
+        f"{prior}/schema.json"
+        for prior in [
+            "carbon_cycle",
+            "climate_response_ebm3",
+            "aerosol_cloud",
+            "aerosol_radiation",
+            "ozone",
+            "forcing_scaling",
+            "co2_concentration_1750",
+        ]
+    ]
+    calibration_files = [
         f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/calibrations/"
-        "landuse_scale_factor.csv",
-        index_col=0,
+        f"{calibration}.csv"
+        for calibration in [
+            "CH4_lifetime",
+            "landuse_scale_factor",
+            "lapsi_scale_factor",
+        ]
+    ]
+    input_files = (
+        prior_files
+        + calibration_files
+        + [
+            "../../../../../data/forcing/solar_erf_timebounds.csv",
+            "../../../../../data/forcing/volcanic_ERF_1750-2101_timebounds.csv",
+            "../../../../../data/forcing/IGCC_GMST_1850-2022.csv",
+            f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/emissions/"
+            "ssps_harmonized_1750-2499.nc",
+        ]
     )
-    df_lapsi = pd.read_csv(
-        f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/calibrations/"
-        "lapsi_scale_factor.csv",
-        index_col=0,
+    if "1pctCO2" in idealised_experiments:
+        input_files.append(
+            f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/"
+            "concentration/1pctCO2_concentration_1850-1990.nc"
+        )
+
+    # results do not depend on BATCH_SIZE or WORKERS, so these can change on resume
+    fingerprint = _fingerprint(
+        input_files,
+        {
+            "FAIR_VERSION": fair_v,
+            "CALIBRATION_VERSION": cal_v,
+            "CONSTRAINT_SET": constraint_set,
+            "PRIOR_SAMPLES": samples,
+            "TWO_STAGE": two_stage,
+            "TRAJECTORY_RMSE_CEILING": trajectory_rmse_ceiling,
+            "TRAJECTORY_STRIDE": trajectory_stride,
+            "IDEALISED_EXPERIMENTS": idealised_experiments,
+            "ABC_SMC": abc_smc,
+        },
     )
 
-    seedgen = 1355763
-    seedstep = 399
+    if abc_smc:
+        run_abc_smc(fingerprint, samples, batch_size, WORKERS)
+        sys.exit()
 
-    # for all except temperature, the full time series is not important so we can save
-    # a bit of space
-    temp_out = np.ones((252, samples)) * np.nan
-    ohc_out = np.ones((samples)) * np.nan
-    fari_out = np.ones((samples)) * np.nan
-    faci_out = np.ones((samples)) * np.nan
-    co2_out = np.ones((samples)) * np.nan
-    fo3_out = np.ones((samples)) * np.nan
-    ecs = np.ones(samples) * np.nan
-    tcr = np.ones(samples) * np.nan
+    # preallocate the output files; each batch fills in its own slice
+    complete = _load_manifest(manifest_file, fingerprint, output_files())
+    if complete is None:
+        allocate_outputs(samples)
+        complete = []
+        _save_manifest(manifest_file, fingerprint, complete)
+        _save_manifest(survivors_manifest_file, fingerprint, [])
 
-    config = []
-    for ibatch, batch_start in enumerate(range(0, samples, batch_size)):
-        config.append({})
-        batch_end = batch_start + batch_size
-        config[ibatch]["batch_start"] = batch_start
-        config[ibatch]["batch_end"] = batch_start + batch_size
-        config[ibatch]["volcanic_forcing"] = volcanic_forcing
-        config[ibatch]["solar_forcing"] = solar_forcing
-        config[ibatch]["scaling_Volcanic"] = df_scaling.loc[
-            batch_start : batch_end - 1, "Volcanic"
-        ].values.squeeze()
-        config[ibatch]["scaling_solar_trend"] = df_scaling.loc[
-            batch_start : batch_end - 1, "solar_trend"
-        ].values.squeeze()
-        config[ibatch]["scaling_solar_amplitude"] = df_scaling.loc[
-            batch_start : batch_end - 1, "solar_amplitude"
-        ].values.squeeze()
-        config[ibatch]["c1"] = df_cr.loc[batch_start : batch_end - 1, "c1"].values
-        config[ibatch]["c2"] = df_cr.loc[batch_start : batch_end - 1, "c2"].values
-        config[ibatch]["c3"] = df_cr.loc[batch_start : batch_end - 1, "c3"].values
-        config[ibatch]["kappa1"] = df_cr.loc[
-            batch_start : batch_end - 1, "kappa1"
-        ].values
-        config[ibatch]["kappa2"] = df_cr.loc[
-            batch_start : batch_end - 1, "kappa2"
-        ].values
-        config[ibatch]["kappa3"] = df_cr.loc[
-            batch_start : batch_end - 1, "kappa3"
-        ].values
-        config[ibatch]["epsilon"] = df_cr.loc[
-            batch_start : batch_end - 1, "epsilon"
-        ].values
-        config[ibatch]["gamma"] = df_cr.loc[batch_start : batch_end - 1, "gamma"].values
-        config[ibatch]["sigma_eta"] = df_cr.loc[
-            batch_start : batch_end - 1, "sigma_eta"
-        ].values
-        config[ibatch]["sigma_xi"] = df_cr.loc[
-            batch_start : batch_end - 1, "sigma_xi"
-        ].values
-        config[ibatch]["seed"] = np.arange(
-            seedgen + batch_start * seedstep,
-            seedgen + batch_end * seedstep,
-            seedstep,
-            dtype=int,
-        )
-        config[ibatch]["forcing_4co2"] = df_cr.loc[
-            batch_start : batch_end - 1, "F_4xCO2"
-        ]
-        config[ibatch]["iirf_0"] = df_cc.loc[
-            batch_start : batch_end - 1, "r0"
-        ].values.squeeze()
-        config[ibatch]["iirf_airborne"] = df_cc.loc[
-            batch_start : batch_end - 1, "rA"
-        ].values.squeeze()
-        config[ibatch]["iirf_uptake"] = df_cc.loc[
-            batch_start : batch_end - 1, "rU"
-        ].values.squeeze()
-        config[ibatch]["iirf_temperature"] = df_cc.loc[
-            batch_start : batch_end - 1, "rT"
-        ].values.squeeze()
-        config[ibatch]["beta"] = df_aci.loc[
-            batch_start : batch_end - 1, "beta"
-        ].values.squeeze()
-        config[ibatch]["shape_so2"] = df_aci.loc[
-            batch_start : batch_end - 1, "shape_so2"
-        ].values.squeeze()
-        config[ibatch]["shape_bc"] = df_aci.loc[
-            batch_start : batch_end - 1, "shape_bc"
-        ].values.squeeze()
-        config[ibatch]["shape_oc"] = df_aci.loc[
-            batch_start : batch_end - 1, "shape_oc"
-        ].values.squeeze()
-        config[ibatch]["scaling_CO2"] = df_scaling.loc[
-            batch_start : batch_end - 1, "CO2"
-        ].values.squeeze()
-        config[ibatch]["scaling_CH4"] = df_scaling.loc[
-            batch_start : batch_end - 1, "CH4"
-        ].values.squeeze()
-        config[ibatch]["scaling_N2O"] = df_scaling.loc[
-            batch_start : batch_end - 1, "N2O"
-        ].values.squeeze()
-        config[ibatch]["scaling_minorGHG"] = df_scaling.loc[
-            batch_start : batch_end - 1, "minorGHG"
-        ].values.squeeze()
-        config[ibatch]["scaling_stwv"] = df_scaling.loc[
-            batch_start : batch_end - 1, "Stratospheric water vapour"
-        ].values.squeeze()
-        config[ibatch]["scaling_lapsi"] = df_scaling.loc[
-            batch_start : batch_end - 1, "Light absorbing particles on snow and ice"
-        ].values.squeeze()
-        config[ibatch]["scaling_landuse"] = df_scaling.loc[
-            batch_start : batch_end - 1, "Land use"
-        ].values.squeeze()
-        config[ibatch]["ari_BC"] = df_ari.loc[batch_start : batch_end - 1, "BC"]
-        config[ibatch]["ari_CH4"] = df_ari.loc[batch_start : batch_end - 1, "CH4"]
-        config[ibatch]["ari_N2O"] = df_ari.loc[batch_start : batch_end - 1, "N2O"]
-        config[ibatch]["ari_NH3"] = df_ari.loc[batch_start : batch_end - 1, "NH3"]
-        config[ibatch]["ari_NOx"] = df_ari.loc[batch_start : batch_end - 1, "NOx"]
-        config[ibatch]["ari_OC"] = df_ari.loc[batch_start : batch_end - 1, "OC"]
-        config[ibatch]["ari_Sulfur"] = df_ari.loc[batch_start : batch_end - 1, "Sulfur"]
-        config[ibatch]["ari_VOC"] = df_ari.loc[batch_start : batch_end - 1, "VOC"]
-        config[ibatch]["ari_EESC"] = df_ari.loc[
-            batch_start : batch_end - 1, "Equivalent effective stratospheric chlorine"
-        ]
-        config[ibatch]["ozone_CH4"] = df_ozone.loc[batch_start : batch_end - 1, "CH4"]
-        config[ibatch]["ozone_N2O"] = df_ozone.loc[batch_start : batch_end - 1, "N2O"]
-        config[ibatch]["ozone_NOx"] = df_ozone.loc[batch_start : batch_end - 1, "NOx"]
-        config[ibatch]["ozone_VOC"] = df_ozone.loc[batch_start : batch_end - 1, "VOC"]
-        config[ibatch]["ozone_CO"] = df_ozone.loc[batch_start : batch_end - 1, "CO"]
-        config[ibatch]["ozone_EESC"] = df_ozone.loc[
-            batch_start : batch_end - 1, "Equivalent effective stratospheric chlorine"
-        ]
-        config[ibatch]["CO2_1750"] = df_1750co2.loc[
-            batch_start : batch_end - 1, "co2_concentration"
-        ].values.squeeze()
-        config[ibatch]["ch4_base"] = df_methane.loc["historical_best", "base"]
-        config[ibatch]["ch4_CH4"] = df_methane.loc["historical_best", "CH4"]
-        config[ibatch]["ch4_NOx"] = df_methane.loc["historical_best", "NOx"]
-        config[ibatch]["ch4_VOC"] = df_methane.loc["historical_best", "VOC"]
-        config[ibatch]["ch4_EESC"] = df_methane.loc["historical_best", "HC"]
-        config[ibatch]["ch4_N2O"] = df_methane.loc["historical_best", "N2O"]
-        config[ibatch]["ch4_temp"] = df_methane.loc["historical_best", "temp"]
-        config[ibatch]["landuse_factor"] = df_landuse.loc[
-            "historical_best", "CO2_AFOLU"
-        ]
-        config[ibatch]["lapsi_factor"] = df_lapsi.loc["historical_best", "BC"]
+    # each batch only needs to know which ensemble members to run: workers read the
+    # prior parameters for these straight from the parameter store. In two-stage mode,
+    # the first stage runs each ensemble member over the historical period only.
+    config = [
+        {
+            "batch_start": batch_start,
+            "batch_end": min(batch_start + batch_size, samples),
+            "historical": two_stage,
+        }
+        for batch_start in range(0, samples, batch_size)
+    ]
+
+    n_batches = len(config)
+    config = [cfg for cfg in config if not _is_complete(cfg, complete)]
+    if len(config) < n_batches:
+        print(f"Resuming: {n_batches - len(config)} of {n_batches} batches done")
 
+    # if TIMING is set, each batch returns how long its phases took
+    timings = []
+
+    def record_batch(cfg, result):
+        complete.append([cfg["batch_start"], cfg["batch_end"]])
+        _save_manifest(manifest_file, fingerprint, complete)
+        if result is not None:
+            timings.append(result)
+
+    # batches are submitted to the pool a few at a time, and their results are only
+    # recorded in the manifest. Batches that are left at the end are split between
+    # any idle workers.
     parallel_process_kwargs = dict(
         func=run_fair,
         configuration=config,
         config_are_kwargs=False,
+        callback=record_batch,
+        split=_split_batch,
+        keep_results=False,
     )
 
-    with ProcessPoolExecutor(WORKERS) as pool:
-        res = _parallel_process(
-            **parallel_process_kwargs,
-            pool=pool,
-        )
+    # the prior parameters, emissions and forcing are published once for workers to
+    # share rather than being loaded or pickled for each batch. Each worker sets up
+    # FaIR once and reuses it for all the batches that it runs.
+    timer = _PhaseTimer()
+    with tempfile.TemporaryDirectory() as shared_dir:
+        publish_inputs(shared_dir, samples)
+        timer.lap("publish_inputs")
+        start = time.perf_counter()
+        with ProcessPoolExecutor(
+            WORKERS,
+            initializer=init_worker,
+            initargs=(batch_size, shared_dir, 2023 if two_stage else 2101),
+        ) as pool:
+            _parallel_process(
+                **parallel_process_kwargs,
+                pool=pool,
+            )
+            timer.lap("ensemble")
 
-    for ibatch, batch_start in enumerate(range(0, samples, batch_size)):
-        batch_end = batch_start + batch_size
-        temp_out[:, batch_start:batch_end] = res[ibatch][0]
-        ohc_out[batch_start:batch_end] = res[ibatch][1]
-        co2_out[batch_start:batch_end] = res[ibatch][2]
-        fari_out[batch_start:batch_end] = res[ibatch][3]
-        faci_out[batch_start:batch_end] = res[ibatch][4]
-        ecs[batch_start:batch_end] = res[ibatch][5]
-        tcr[batch_start:batch_end] = res[ibatch][6]
+            if two_stage:
+                # second stage: only members that will pass the RMSE constraint in
+                # constraining/01, and the sample of the prior, are run to 2101. FaIR
+                # draws internal variability afresh from the seed on each run, so these
+                # are rerun from 1750 rather than restarted in 2023, giving the same
+                # results as running them to 2101 in the first place.
+                temperature_rmse = np.load(
+                    os.path.join(output_dir, outputs["temperature_rmse"][0])
+                )
+                survivors = np.flatnonzero(
+                    kept_members(np.arange(samples), temperature_rmse)
+                )
+                print(f"Running {len(survivors)} of {samples} members to 2101...")
 
-    os.makedirs(
-        f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/prior_runs/",
-        exist_ok=True,
-    )
-    np.save(
-        f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/prior_runs/"
-        "temperature_1850-2101.npy",
-        temp_out,
-        allow_pickle=True,
-    )
-    np.save(
-        f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/prior_runs/"
-        "ocean_heat_content_2020_minus_1971.npy",
-        ohc_out,
-        allow_pickle=True,
-    )
-    np.save(
-        f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/prior_runs/"
-        "concentration_co2_2022.npy",
-        co2_out,
-        allow_pickle=True,
-    )
-    np.save(
-        f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/prior_runs/"
-        "forcing_ari_2005-2014_mean.npy",
-        fari_out,
-        allow_pickle=True,
-    )
-    np.save(
-        f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/prior_runs/"
-        "forcing_aci_2005-2014_mean.npy",
-        faci_out,
-        allow_pickle=True,
-    )
-    np.save(
-        f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/prior_runs/"
-        "ecs.npy",
-        ecs,
-        allow_pickle=True,
-    )
-    np.save(
-        f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/prior_runs/"
-        "tcr.npy",
-        tcr,
-        allow_pickle=True,
-    )
+                # batches are positions in the list of survivors
+                complete_survivors = (
+                    _load_manifest(survivors_manifest_file, fingerprint, output_files())
+                    or []
+                )
+                config = [
+                    {
+                        "batch_start": batch_start,
+                        "batch_end": min(batch_start + batch_size, len(survivors)),
+                        "runids": survivors[batch_start : batch_start + batch_size],
+                    }
+                    for batch_start in range(0, len(survivors), batch_size)
+                ]
+                config = [
+                    cfg for cfg in config if not _is_complete(cfg, complete_survivors)
+                ]
+
+                def record_survivor_batch(cfg, result):
+                    complete_survivors.append([cfg["batch_start"], cfg["batch_end"]])
+                    _save_manifest(
+                        survivors_manifest_file, fingerprint, complete_survivors
+                    )
+                    if result is not None:
+                        timings.append(result)
+
+                _parallel_process(
+                    func=run_fair,
+                    configuration=config,
+                    config_are_kwargs=False,
+                    callback=record_survivor_batch,
+                    split=_split_batch,
+                    keep_results=False,
+                    pool=pool,
+                )
+                timer.lap("survivors")
+            elapsed = time.perf_counter() - start
+
+    if timing:
+        report = _save_timing_report(
+            timing_file, timings, WORKERS, elapsed, parent=timer.phases
+        )
+        print(
+            f"{report['members_per_second']:.1f} members/s with {WORKERS} workers, "
+            f"{report['utilisation']:.0%} utilised; see {timing_file}"
+        )
@@ -0,0 +1,337 @@
+# Adaptive calibration by sequential Monte Carlo (ABC-SMC), used by sampling/09 when
+# ABC_SMC is set.
+#
+# Rather than running every member of the prior, this runs the members of the prior
+# store from sampling/01-07 that the posterior needs, in generations. The first
+# generation is every TRAJECTORY_STRIDE-th member, the sample of the prior that the
+# plots use. Each later generation draws members of the store close to those whose
+# temperature RMSE is below a tolerance, which shrinks each generation until it is
+# RMSE_CEILING, the first constraint in constraining/01. Members near those that also
+# match the assessed distributions of constraining/03 are favoured.
+#
+# The store is the prior, so each member that is run gets an importance weight: its
+# share of the prior, divided by how likely the generations so far were to draw it.
+# With these weights, the members that are run stand for the whole prior, and
+# constraining/03 starts its reweighting from them. This stops once the members that
+# pass the RMSE constraint, weighted to the assessed distributions, are worth
+# effective_factor times POSTERIOR_SAMPLES equally weighted members.
+#
+# Members are run by ``parallel.run_fair`` as in sampling/09, and their outputs are
+# written to the same files, so constraining/01 onwards runs as usual. Members that are
+# not run have NaN outputs. Members already run are recorded in a manifest, so an
+# interrupted calibration picks up where it left off. Everything is run to 2101, so
+# TWO_STAGE has no effect.
+
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import scipy.linalg
+from dotenv import load_dotenv
+from parallel import (
+    allocate_outputs,
+    cal_v,
+    constraint_set,
+    fair_v,
+    init_worker,
+    output_dir,
+    output_files,
+    outputs,
+    prior_columns,
+    publish_inputs,
+    rmse_ceiling,
+    run_fair,
+    trajectory_stride,
+)
+from utils import (
+    _assessed_samples,
+    _binned_kde,
+    _load_manifest,
+    _load_members,
+    _merge_ranges,
+    _open_prior_columns,
+    _parallel_process,
+    _save_manifest,
+    _split_batch,
+    _weighted_percentile,
+)
+
+load_dotenv()
+
+# members of the store drawn in each generation after the first. Members drawn again
+# are not run again.
+population = 20000
+# kernel moves are centred on this many of the members accepted by the last
+# generation, resampled by their weights
+n_centres = 2000
+# the tolerance on the RMSE of each generation is this quantile of the RMSE of the
+# members accepted by the last, until it reaches RMSE_CEILING
+tolerance_quantile = 0.5
+# share of each generation drawn from the prior itself, so that any member can be
+# drawn and importance weights are bounded
+defensive = 0.1
+# stop once the members that pass are worth this many times POSTERIOR_SAMPLES
+effective_factor = 4
+max_generations = 20
+seed = 3871146
+# members of the store in each block of the kernel sums
+chunk_size = 10000
+
+manifest_file = os.path.join(output_dir, "abc_smc_manifest.json")
+# importance weight of every member of the store, zero for those not run
+importance_weights_file = os.path.join(output_dir, "importance_weights.npy")
+# tolerance, members run and effective members of each generation
+generations_file = os.path.join(output_dir, "abc_smc_generations.csv")
+
+
+def observables(members):
+    """Outputs of members that the assessed distributions of constraining/03 are for."""
+    out = {
+        name: _load_members(os.path.join(output_dir, outputs[name][0]), members)
+        for name in [
+            "ecs",
+            "tcr",
+            "ocean_heat_content",
+            "temperature_2003_2022",
+            "forcing_ari",
+            "forcing_aci",
+            "concentration_co2",
+        ]
+    }
+    return {
+        "ECS": out["ecs"],
+        "TCR": out["tcr"],
+        "OHC": out["ocean_heat_content"] / 1e21,
+        "temperature 2003-2022": out["temperature_2003_2022"],
+        "ERFari": out["forcing_ari"],
+        "ERFaci": out["forcing_aci"],
+        "ERFaer": out["forcing_ari"] + out["forcing_aci"],
+        "CO2 concentration": out["concentration_co2"],
+    }
+
+
+def target_tilt(assessed, values, weights):
+    """Density of the assessed distributions relative to that of weighted members."""
+    tilt = np.ones(len(weights))
+    for name, density in assessed.items():
+        population_density = _binned_kde(values[name], weights)(values[name])
+        tilt *= np.divide(
+            density(values[name]),
+            population_density,
+            out=np.zeros(len(weights)),
+            where=population_density > 0,
+        )
+    return tilt
+
+
+def effective_members(weights):
+    """Number of equally weighted members that weighted members are worth."""
+    if np.sum(weights) == 0:
+        return 0
+    return np.sum(weights) ** 2 / np.sum(weights**2)
+
+
+def proposal(parameters, samples, centres, covariance):
+    """Probability of drawing each member of the store in the next generation.
+
+    This is a mixture of Gaussian kernels centred on ``centres`` with ``covariance``,
+    restricted to the members of the store, and the prior itself.
+    """
+    chol = np.linalg.cholesky(covariance)
+    centres = scipy.linalg.solve_triangular(chol, centres.T, lower=True).T
+    kernel = np.zeros(samples)
+    for start in range(0, samples, chunk_size):
+        block = scipy.linalg.solve_triangular(
+            chol,
+            parameters(slice(start, min(start + chunk_size, samples))).T,
+            lower=True,
+        ).T
+        distance = (
+            np.sum(block**2, axis=1)[:, None]
+            + np.sum(centres**2, axis=1)
+            - 2 * block @ centres.T
+        )
+        kernel[start : start + chunk_size] = np.mean(
+            np.exp(-0.5 * np.maximum(distance, 0)), axis=1
+        )
+    return (1 - defensive) * kernel / np.sum(kernel) + defensive / samples
+
+
+def run_abc_smc(fingerprint, samples, batch_size, workers):
+    """Run the members of the prior that the posterior needs, generation by generation.
+
+    Parameters
+    ----------
+    fingerprint : dict
+        Output of ``utils._fingerprint`` for the inputs and settings of the run.
+    samples : int
+        Number of members in the prior store.
+    batch_size : int
+        Most members in a batch.
+    workers : int
+        Number of worker processes.
+    """
+    posterior_samples = int(os.getenv("POSTERIOR_SAMPLES"))
+    prior = _open_prior_columns(
+        f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/priors/",
+        prior_columns,
+    )
+
+    def parameters(members):
+        return np.column_stack([prior[name][members] for name in prior_columns])
+
+    assessed = {
+        name: _binned_kde(values) for name, values in _assessed_samples().items()
+    }
+
+    complete = _load_manifest(manifest_file, fingerprint, output_files())
+    if complete is None:
+        allocate_outputs(samples)
+        complete = []
+        _save_manifest(manifest_file, fingerprint, complete)
+    run = np.zeros(samples, dtype=bool)
+    for start, end in complete:
+        run[start:end] = True
+
+    def record_batch(cfg, result):
+        runids = np.asarray(cfg["runids"])
+        complete[:] = _merge_ranges(complete + [[r, r + 1] for r in runids.tolist()])
+        run[runids] = True
+        _save_manifest(manifest_file, fingerprint, complete)
+
+    # how many times each member has been drawn, and the sum over generations of the
+    # number of draws times the probability of drawing it. Members of the store are
+    # independent, so every TRAJECTORY_STRIDE-th member is drawn from the prior like
+    # any other.
+    counts = np.zeros(samples)
+    mixture = np.zeros(samples)
+    draws = np.arange(0, samples, trajectory_stride)
+    mixture += len(draws) / samples
+
+    # the kernels are wider than the accepted members by a small share of the spread of
+    # the prior in every direction, so that their covariance is never singular
+    ridge = 1e-6 * np.diag(np.var(parameters(draws), axis=0))
+
+    tolerance = np.inf
+    generations = []
+    with tempfile.TemporaryDirectory() as shared_dir:
+        publish_inputs(shared_dir, samples)
+        with ProcessPoolExecutor(
+            workers, initializer=init_worker, initargs=(batch_size, shared_dir)
+        ) as pool:
+            for generation in range(max_generations):
+                np.add.at(counts, draws, 1)
+                new = np.unique(draws[~run[draws]])
+                config = [
+                    {
+                        "batch_start": batch_start,
+                        "batch_end": min(batch_start + batch_size, len(new)),
+                        "runids": new[batch_start : batch_start + batch_size],
+                        "idealised": True,
+                    }
+                    for batch_start in range(0, len(new), batch_size)
+                ]
+                _parallel_process(
+                    func=run_fair,
+                    configuration=config,
+                    config_are_kwargs=False,
+                    callback=record_batch,
+                    split=_split_batch,
+                    keep_results=False,
+                    pool=pool,
+                )
+
+                members = np.flatnonzero(counts)
+                weights = counts[members] / (samples * mixture[members])
+                rmse = _load_members(
+                    os.path.join(output_dir, outputs["temperature_rmse"][0]), members
+                )
+                values = observables(members)
+
+                accepted = rmse < tolerance
+                tolerance = max(
+                    rmse_ceiling,
+                    _weighted_percentile(
+                        rmse[accepted], weights[accepted], 100 * tolerance_quantile
+                    ),
+                )
+                accepted = rmse < tolerance
+                passing = rmse < rmse_ceiling
+                effective = 0
+                if np.sum(passing) > 1:
+                    effective = effective_members(
+                        weights[passing]
+                        * target_tilt(
+                            assessed,
+                            {name: value[passing] for name, value in values.items()},
+                            weights[passing],
+                        )
+                    )
+                generations.append(
+                    {
+                        "generation": generation,
+                        "tolerance": tolerance,
+                        "members_run": np.sum(run),
+                        "members_passing": np.sum(passing),
+                        "effective_members": effective,
+                    }
+                )
+                print(
+                    f"Generation {generation}: tolerance {tolerance:.3f} K, "
+                    f"{len(new)} members run ({np.sum(run)} in all), "
+                    f"{np.sum(passing)} passing, worth {effective:.0f}"
+                )
+                if (
+                    tolerance == rmse_ceiling
+                    and effective >= effective_factor * posterior_samples
+                ) or generation == max_generations - 1:
+                    break
+
+                # kernel moves around the accepted members, favouring those that
+                # match the assessed distributions. The kernel covariance is twice
+                # that of the accepted members (Beaumont et al., 2009).
+                if not np.any(accepted):
+                    raise ValueError(
+                        f"No members are below the tolerance of generation {generation}"
+                    )
+                rng = np.random.default_rng([seed, generation])
+                centre_weights = weights[accepted] * target_tilt(
+                    assessed,
+                    {name: value[accepted] for name, value in values.items()},
+                    weights[accepted],
+                )
+                # until at least two accepted members are in range of every assessed
+                # distribution, they are favoured by their weights alone
+                if np.count_nonzero(centre_weights) < 2:
+                    centre_weights = weights[accepted]
+                centre_weights = centre_weights / np.sum(centre_weights)
+                centres = parameters(members[accepted])
+                # a single accepted member has no spread, so its kernel is the ridge
+                covariance = ridge
+                if len(centres) > 1:
+                    covariance = (
+                        2 * np.cov(centres, rowvar=False, aweights=centre_weights)
+                        + ridge
+                    )
+                if not np.all(np.isfinite(covariance)):
+                    raise ValueError(
+                        f"The kernel covariance of generation {generation} is not "
+                        "finite"
+                    )
+                positions = (rng.random() + np.arange(n_centres)) / n_centres
+                centres = centres[
+                    np.searchsorted(np.cumsum(centre_weights), positions).clip(
+                        max=len(centres) - 1
+                    )
+                ]
+                probability = proposal(parameters, samples, centres, covariance)
+                draws = rng.choice(samples, size=population, p=probability)
+                mixture += population * probability
+
+    importance_weights = np.zeros(samples)
+    members = np.flatnonzero(counts)
+    importance_weights[members] = counts[members] / (samples * mixture[members])
+    np.save(importance_weights_file, importance_weights)
+    pd.DataFrame(generations).to_csv(generations_file, index=False)
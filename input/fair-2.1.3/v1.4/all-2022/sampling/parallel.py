@@ -1,173 +1,522 @@
 # put imports outside: we don't have a lot of overhead here, and it looks nicer.
+import glob
 import os
+import shutil
 import warnings
 
 import numpy as np
+import pandas as pd
 import xarray as xr
 from dotenv import load_dotenv
 from fair import FAIR
 from fair.interface import fill, initialise
 from fair.io import read_properties
+from utils import (
+    _attach_arrays,
+    _open_prior_columns,
+    _PhaseTimer,
+    _run_idealised,
+    _save_trajectories,
+    _share_arrays,
+    _temperature_rmse,
+    idealised_experiments,
+    idealised_outputs,
+)
 
 load_dotenv()
 
 cal_v = os.getenv("CALIBRATION_VERSION")
 fair_v = os.getenv("FAIR_VERSION")
 constraint_set = os.getenv("CONSTRAINT_SET")
+rmse_ceiling = float(os.getenv("RMSE_CEILING", 0.17))
+trajectory_rmse_ceiling = float(os.getenv("TRAJECTORY_RMSE_CEILING", rmse_ceiling))
+trajectory_stride = int(os.getenv("TRAJECTORY_STRIDE", 100))
 
+# every member that can pass the RMSE constraint must keep its time series
+assert trajectory_rmse_ceiling >= rmse_ceiling
+# and only a sample of the others
+assert trajectory_stride >= 1
 
-def run_fair(cfg):
-    scenarios = ["ssp245"]
-    batch_start = cfg["batch_start"]
-    batch_end = cfg["batch_end"]
-    batch_size = batch_end - batch_start
+output_dir = (
+    f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/prior_runs/"
+)
 
-    species, properties = read_properties()
-    species.remove("Halon-1202")
-    species.remove("NOx aviation")
-    species.remove("Contrails")
+# each batch writes its slice of these straight to disk, so the parent never holds the
+# ensemble in memory. Values are (filename, shape of the output for one ensemble
+# member); ensemble member is the last dimension of each file. These are the
+# observables that the constraints are applied to, for every ensemble member.
+outputs = {
+    "temperature_rmse": ("temperature_rmse_1850-2022.npy", ()),
+    "temperature_2003_2022": ("temperature_2003-2022_rel_1850-1900.npy", ()),
+    "temperature_1995_2014": ("temperature_1995-2014_rel_1850-1900.npy", ()),
+    "ocean_heat_content": ("ocean_heat_content_2020_minus_1971.npy", ()),
+    "concentration_co2": ("concentration_co2_2022.npy", ()),
+    "forcing_ari": ("forcing_ari_2005-2014_mean.npy", ()),
+    "forcing_aci": ("forcing_aci_2005-2014_mean.npy", ()),
+    "ecs": ("ecs.npy", ()),
+    "tcr": ("tcr.npy", ()),
+}
+
+# if IDEALISED_EXPERIMENTS is set, each batch also runs these experiments, such as
+# 1pctCO2, with the same parameters, and writes their outputs for every ensemble member
+# to the idealised directory. They are named by experiment and output.
+for experiment in idealised_experiments:
+    for name, (filename, member_shape) in idealised_outputs[experiment].items():
+        outputs[f"{experiment} {name}"] = (
+            os.path.join("idealised", filename),
+            member_shape,
+        )
+
+# the full temperature time series, 1850-2101, is only kept for ensemble members with
+# a temperature RMSE below TRAJECTORY_RMSE_CEILING, which include all of the ones that
+# can pass the constraints, and every TRAJECTORY_STRIDE-th member, as a sample of the
+# prior. These are written by ``utils._save_trajectories``.
+trajectory_dir = os.path.join(output_dir, "temperature_1850-2101")
+
+manifest_file = os.path.join(output_dir, "prior_ensemble_manifest.json")
+# in two-stage mode, the second stage runs to 2101 only the members that pass the RMSE
+# screen in the first, and records its progress separately
+survivors_manifest_file = os.path.join(
+    output_dir, "prior_ensemble_survivors_manifest.json"
+)
+# if TIMING is set, how long each batch took, and a summary
+timing_file = os.path.join(output_dir, "prior_ensemble_timing.json")
+
+
+def output_files():
+    return [os.path.join(output_dir, filename) for filename, _ in outputs.values()]
+
+
+def allocate_outputs(samples):
+    """Create the NaN-filled, memory-mapped output files for the prior ensemble.
+
+    Any time series kept from an earlier run, and the manifests of earlier runs, are
+    removed, since these would no longer match the outputs.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    shutil.rmtree(trajectory_dir, ignore_errors=True)
+    for filename in glob.glob(os.path.join(output_dir, "*manifest.json")):
+        os.remove(filename)
+    for filename, member_shape in outputs.values():
+        shape = member_shape + (samples,)
+        os.makedirs(os.path.dirname(os.path.join(output_dir, filename)), exist_ok=True)
+        out = np.lib.format.open_memmap(
+            os.path.join(output_dir, filename), mode="w+", dtype=np.float64, shape=shape
+        )
+        out[:] = np.nan
+        out.flush()
+        del out
+
+
+def write_outputs(members, **results):
+    """Write one batch's results into the columns of its ensemble members.
+
+    ``members`` is a slice or an array of run IDs.
+    """
+    for name, data in results.items():
+        out = np.load(os.path.join(output_dir, outputs[name][0]), mmap_mode="r+")
+        out[..., members] = data
+        out.flush()
+        del out
+
+
+# read-only inputs and prior parameters, memory-mapped by each worker in
+# ``init_worker``.
+_inputs = {}
+
+# where ``publish_inputs`` last published the inputs, for batches run in the process
+# that published them, such as the FRONT_SERIAL ones, to attach to
+_published = {}
+
+# FaIR instances set up with everything that is the same for all ensemble members, keyed
+# by number of ensemble members. Each worker process builds these once and then reuses
+# them for every batch it runs, so that a batch only pays for filling in and running its
+# own ensemble members.
+_templates = {}
+
+# if TIMING is set, how long this worker took to start, which is reported with the
+# first batch that it runs
+_init_timings = {}
+
+
+# columns of the prior parameter store: the name used for each parameter in a batch,
+# and the prior and column in its store that it is read from.
+prior_columns = {
+    "c1": ("climate_response_ebm3", "c1"),
+    "c2": ("climate_response_ebm3", "c2"),
+    "c3": ("climate_response_ebm3", "c3"),
+    "kappa1": ("climate_response_ebm3", "kappa1"),
+    "kappa2": ("climate_response_ebm3", "kappa2"),
+    "kappa3": ("climate_response_ebm3", "kappa3"),
+    "epsilon": ("climate_response_ebm3", "epsilon"),
+    "gamma": ("climate_response_ebm3", "gamma"),
+    "sigma_eta": ("climate_response_ebm3", "sigma_eta"),
+    "sigma_xi": ("climate_response_ebm3", "sigma_xi"),
+    "forcing_4co2": ("climate_response_ebm3", "F_4xCO2"),
+    "iirf_0": ("carbon_cycle", "r0"),
+    "iirf_airborne": ("carbon_cycle", "rA"),
+    "iirf_uptake": ("carbon_cycle", "rU"),
+    "iirf_temperature": ("carbon_cycle", "rT"),
+    "beta": ("aerosol_cloud", "beta"),
+    "shape_so2": ("aerosol_cloud", "shape_so2"),
+    "shape_bc": ("aerosol_cloud", "shape_bc"),
+    "shape_oc": ("aerosol_cloud", "shape_oc"),
+    "ari_BC": ("aerosol_radiation", "BC"),
+    "ari_CH4": ("aerosol_radiation", "CH4"),
+    "ari_N2O": ("aerosol_radiation", "N2O"),
+    "ari_NH3": ("aerosol_radiation", "NH3"),
+    "ari_NOx": ("aerosol_radiation", "NOx"),
+    "ari_OC": ("aerosol_radiation", "OC"),
+    "ari_Sulfur": ("aerosol_radiation", "Sulfur"),
+    "ari_VOC": ("aerosol_radiation", "VOC"),
+    "ari_EESC": (
+        "aerosol_radiation",
+        "Equivalent effective stratospheric chlorine",
+    ),
+    "ozone_CH4": ("ozone", "CH4"),
+    "ozone_N2O": ("ozone", "N2O"),
+    "ozone_NOx": ("ozone", "NOx"),
+    "ozone_VOC": ("ozone", "VOC"),
+    "ozone_CO": ("ozone", "CO"),
+    "ozone_EESC": ("ozone", "Equivalent effective stratospheric chlorine"),
+    "scaling_CO2": ("forcing_scaling", "CO2"),
+    "scaling_CH4": ("forcing_scaling", "CH4"),
+    "scaling_N2O": ("forcing_scaling", "N2O"),
+    "scaling_minorGHG": ("forcing_scaling", "minorGHG"),
+    "scaling_stwv": ("forcing_scaling", "Stratospheric water vapour"),
+    "scaling_lapsi": (
+        "forcing_scaling",
+        "Light absorbing particles on snow and ice",
+    ),
+    "scaling_landuse": ("forcing_scaling", "Land use"),
+    "scaling_Volcanic": ("forcing_scaling", "Volcanic"),
+    "scaling_solar_trend": ("forcing_scaling", "solar_trend"),
+    "scaling_solar_amplitude": ("forcing_scaling", "solar_amplitude"),
+    "CO2_1750": ("co2_concentration_1750", "co2_concentration"),
+}
 
+seedgen = 1355763
+seedstep = 399
+
+
+def publish_inputs(directory, samples):
+    """Publish the seeds and the inputs common to all batches for workers to share.
+
+    Along with the prior parameter store, which workers open themselves, this means
+    that a batch only needs to be told which ensemble members to run.
+    """
+    _published["directory"] = directory
+    df_solar = pd.read_csv(
+        "../../../../../data/forcing/solar_erf_timebounds.csv", index_col="year"
+    )
+    df_volcanic = pd.read_csv(
+        "../../../../../data/forcing/volcanic_ERF_1750-2101_timebounds.csv",
+        index_col="timebounds",
+    )
+    df_gmst = pd.read_csv("../../../../../data/forcing/IGCC_GMST_1850-2022.csv")
     da_emissions = xr.load_dataarray(
         f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/emissions/"
         "ssps_harmonized_1750-2499.nc"
     )
-
-    f = FAIR(ch4_method="Thornhill2021")
-    f.define_time(1750, 2101, 1)
-    f.define_scenarios(scenarios)
-    f.define_configs(list(range(batch_start, batch_end)))
-    f.define_species(species, properties)
-    f.allocate()
-
-    trend_shape = np.ones(352)
-    trend_shape[:271] = np.linspace(0, 1, 271)
-
     da = da_emissions.loc[dict(config="unspecified", scenario="ssp245")][:351, ...]
-    fe = da.expand_dims(dim=["scenario", "config"], axis=(1, 2))
-    f.emissions = fe.drop("config") * np.ones((1, 1, batch_size, 1))
+    if "1pctCO2" in idealised_experiments:
+        da_concentration = xr.load_dataarray(
+            f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/"
+            "concentration/1pctCO2_concentration_1850-1990.nc"
+        )
+        _share_arrays(
+            directory,
+            concentration_1pctCO2=da_concentration.loc[
+                dict(config="unspecified", scenario="1pctCO2")
+            ].values,
+        )
+    _share_arrays(
+        directory,
+        emissions=da.values,
+        volcanic_forcing=df_volcanic["erf"].loc[1750:2101].values,
+        solar_forcing=df_solar["erf"].loc[1750:2101].values,
+        gmst=df_gmst["gmst"].values,
+        seed=seedgen + np.arange(samples) * seedstep,
+    )
 
-    # solar and volcanic forcing
-    fill(
-        f.forcing,
-        cfg["volcanic_forcing"][:, None, None] * cfg["scaling_Volcanic"],
-        specie="Volcanic",
+    # calibrated, so the same for all ensemble members
+    df_methane = pd.read_csv(
+        f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/calibrations/"
+        "CH4_lifetime.csv",
+        index_col=0,
     )
-    fill(
-        f.forcing,
-        cfg["solar_forcing"][:, None, None] * cfg["scaling_solar_amplitude"]
-        + trend_shape[:, None, None] * cfg["scaling_solar_trend"],
-        specie="Solar",
+    df_landuse = pd.read_csv(
+        f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/calibrations/"
+        "landuse_scale_factor.csv",
+        index_col=0,
     )
-
-    # climate response
-    fill(
-        f.climate_configs["ocean_heat_capacity"],
-        np.array([cfg["c1"], cfg["c2"], cfg["c3"]]).T,
+    df_lapsi = pd.read_csv(
+        f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/calibrations/"
+        "lapsi_scale_factor.csv",
+        index_col=0,
     )
-    fill(
-        f.climate_configs["ocean_heat_transfer"],
-        np.array([cfg["kappa1"], cfg["kappa2"], cfg["kappa3"]]).T,
+    _share_arrays(
+        directory,
+        ch4_base=df_methane.loc["historical_best", "base"],
+        ch4_CH4=df_methane.loc["historical_best", "CH4"],
+        ch4_NOx=df_methane.loc["historical_best", "NOx"],
+        ch4_VOC=df_methane.loc["historical_best", "VOC"],
+        ch4_EESC=df_methane.loc["historical_best", "HC"],
+        ch4_N2O=df_methane.loc["historical_best", "N2O"],
+        ch4_temp=df_methane.loc["historical_best", "temp"],
+        landuse_factor=df_landuse.loc["historical_best", "CO2_AFOLU"],
+        lapsi_factor=df_lapsi.loc["historical_best", "BC"],
     )
-    fill(f.climate_configs["deep_ocean_efficacy"], cfg["epsilon"])
-    fill(f.climate_configs["gamma_autocorrelation"], cfg["gamma"])
-    fill(f.climate_configs["sigma_eta"], cfg["sigma_eta"])
-    fill(f.climate_configs["sigma_xi"], cfg["sigma_xi"])
-    fill(f.climate_configs["seed"], cfg["seed"])
+
+
+def _build_template(batch_size, end_year):
+    """Set up a FaIR instance with all member-independent inputs for one batch."""
+    species, properties = read_properties()
+    species.remove("Halon-1202")
+    species.remove("NOx aviation")
+    species.remove("Contrails")
+
+    f = FAIR(ch4_method="Thornhill2021")
+    f.define_time(1750, end_year, 1)
+    f.define_scenarios(["ssp245"])
+    f.define_configs(list(range(batch_size)))
+    f.define_species(species, properties)
+    f.allocate()
+
+    f.emissions[:] = _inputs["emissions"][: end_year - 1750, None, None, :]
+
     fill(f.climate_configs["stochastic_run"], True)
     fill(f.climate_configs["use_seed"], True)
-    fill(f.climate_configs["forcing_4co2"], cfg["forcing_4co2"])
 
     # species level
     f.fill_species_configs()
 
-    # carbon cycle
-    fill(f.species_configs["iirf_0"], cfg["iirf_0"], specie="CO2")
-    fill(f.species_configs["iirf_airborne"], cfg["iirf_airborne"], specie="CO2")
-    fill(f.species_configs["iirf_uptake"], cfg["iirf_uptake"], specie="CO2")
-    fill(f.species_configs["iirf_temperature"], cfg["iirf_temperature"], specie="CO2")
+    # Reconstructed emissions adjustments for all species to match first timepoint
+    fill(f.species_configs["baseline_emissions"], 38.246272, specie="CH4")
+    fill(f.species_configs["baseline_emissions"], 0.92661989, specie="N2O")
+    fill(f.species_configs["baseline_emissions"], 19.41683292, specie="NOx")
+    fill(f.species_configs["baseline_emissions"], 2.293964929, specie="Sulfur")
+    fill(f.species_configs["baseline_emissions"], 348.4549732, specie="CO")
+    fill(f.species_configs["baseline_emissions"], 60.62284009, specie="VOC")
+    fill(f.species_configs["baseline_emissions"], 2.096765609, specie="BC")
+    fill(f.species_configs["baseline_emissions"], 15.44571911, specie="OC")
+    fill(f.species_configs["baseline_emissions"], 6.656462698, specie="NH3")
+    fill(f.species_configs["baseline_emissions"], 0.92661989, specie="N2O")
+    fill(f.species_configs["baseline_emissions"], 0.02129917, specie="CCl4")
+    fill(f.species_configs["baseline_emissions"], 202.7251231, specie="CHCl3")
+    fill(f.species_configs["baseline_emissions"], 211.0095537, specie="CH2Cl2")
+    fill(f.species_configs["baseline_emissions"], 4544.519056, specie="CH3Cl")
+    fill(f.species_configs["baseline_emissions"], 111.4920237, specie="CH3Br")
+    fill(f.species_configs["baseline_emissions"], 0.008146006, specie="Halon-1211")
+    fill(f.species_configs["baseline_emissions"], 0.000010554155, specie="SO2F2")
+    fill(f.species_configs["baseline_emissions"], 0, specie="CF4")
+
+    # tune down volcanic efficacy
+    fill(f.species_configs["forcing_efficacy"], 0.6, specie="Volcanic")
 
     # methane lifetime baseline and sensitivity
-    fill(f.species_configs["unperturbed_lifetime"], cfg["ch4_base"], specie="CH4")
+    fill(f.species_configs["unperturbed_lifetime"], _inputs["ch4_base"], specie="CH4")
     fill(
         f.species_configs["ch4_lifetime_chemical_sensitivity"],
-        cfg["ch4_CH4"],
+        _inputs["ch4_CH4"],
         specie="CH4",
     )
     fill(
         f.species_configs["ch4_lifetime_chemical_sensitivity"],
-        cfg["ch4_N2O"],
+        _inputs["ch4_N2O"],
         specie="N2O",
     )
     fill(
         f.species_configs["ch4_lifetime_chemical_sensitivity"],
-        cfg["ch4_VOC"],
+        _inputs["ch4_VOC"],
         specie="VOC",
     )
     fill(
         f.species_configs["ch4_lifetime_chemical_sensitivity"],
-        cfg["ch4_NOx"],
+        _inputs["ch4_NOx"],
         specie="NOx",
     )
     fill(
         f.species_configs["ch4_lifetime_chemical_sensitivity"],
-        cfg["ch4_EESC"],
+        _inputs["ch4_EESC"],
         specie="Equivalent effective stratospheric chlorine",
     )
-    fill(f.species_configs["lifetime_temperature_sensitivity"], cfg["ch4_temp"])
+    fill(f.species_configs["lifetime_temperature_sensitivity"], _inputs["ch4_temp"])
 
     # correct land use  and LAPSI scale factor terms
     fill(
         f.species_configs["land_use_cumulative_emissions_to_forcing"],
-        cfg["landuse_factor"],
+        _inputs["landuse_factor"],
         specie="CO2 AFOLU",
     )
     fill(
         f.species_configs["lapsi_radiative_efficiency"],
-        cfg["lapsi_factor"],
+        _inputs["lapsi_factor"],
         specie="BC",
     )
 
-    # Reconstructed emissions adjustments for all species to match first timepoint
-    fill(f.species_configs["baseline_emissions"], 38.246272, specie="CH4")
-    fill(f.species_configs["baseline_emissions"], 0.92661989, specie="N2O")
-    fill(f.species_configs["baseline_emissions"], 19.41683292, specie="NOx")
-    fill(f.species_configs["baseline_emissions"], 2.293964929, specie="Sulfur")
-    fill(f.species_configs["baseline_emissions"], 348.4549732, specie="CO")
-    fill(f.species_configs["baseline_emissions"], 60.62284009, specie="VOC")
-    fill(f.species_configs["baseline_emissions"], 2.096765609, specie="BC")
-    fill(f.species_configs["baseline_emissions"], 15.44571911, specie="OC")
-    fill(f.species_configs["baseline_emissions"], 6.656462698, specie="NH3")
-    fill(f.species_configs["baseline_emissions"], 0.92661989, specie="N2O")
-    fill(f.species_configs["baseline_emissions"], 0.02129917, specie="CCl4")
-    fill(f.species_configs["baseline_emissions"], 202.7251231, specie="CHCl3")
-    fill(f.species_configs["baseline_emissions"], 211.0095537, specie="CH2Cl2")
-    fill(f.species_configs["baseline_emissions"], 4544.519056, specie="CH3Cl")
-    fill(f.species_configs["baseline_emissions"], 111.4920237, specie="CH3Br")
-    fill(f.species_configs["baseline_emissions"], 0.008146006, specie="Halon-1211")
-    fill(f.species_configs["baseline_emissions"], 0.000010554155, specie="SO2F2")
-    fill(f.species_configs["baseline_emissions"], 0, specie="CF4")
+    return f
+
+
+def init_worker(batch_size, shared_dir, end_year=2101):
+    """Set up a worker process to run batches of the prior ensemble.
+
+    This attaches to the inputs published by ``publish_inputs`` in ``shared_dir`` and
+    to the prior parameter store, and builds the FaIR template for a full batch
+    running to ``end_year`` once. Batches run outside a worker call it themselves,
+    with the inputs last published in that process.
+    """
+    timer = _PhaseTimer()
+    _inputs.update(_attach_arrays(shared_dir))
+    _inputs.update(
+        _open_prior_columns(
+            f"../../../../../output/fair-{fair_v}/v{cal_v}/{constraint_set}/priors/",
+            prior_columns,
+        )
+    )
+    _templates[batch_size, end_year] = _build_template(batch_size, end_year)
+    timer.lap("init")
+    _init_timings.update(timer.phases)
+
+
+def _get_template(batch_size, end_year):
+    """Get this process's FaIR template, reset ready for a new batch.
+
+    The last batch may be smaller than the rest, and runs of the historical period
+    only are shorter, so these may need templates of their own.
+    """
+    if (batch_size, end_year) not in _templates:
+        _templates[batch_size, end_year] = _build_template(batch_size, end_year)
+    f = _templates[batch_size, end_year]
+
+    # put the state back to how FaIR allocates it. FaIR reads some values before it
+    # has calculated them for the current timestep (e.g. EESC in aerosol forcing), so
+    # anything left over from the last batch run with this template would change the
+    # results.
+    for var in [
+        "concentration",
+        "forcing",
+        "temperature",
+        "alpha_lifetime",
+        "cumulative_emissions",
+        "airborne_fraction",
+        "toa_imbalance",
+        "stochastic_forcing",
+        "forcing_sum",
+    ]:
+        getattr(f, var)[:] = np.nan
+    for var in ["airborne_emissions", "ocean_heat_content_change", "gas_partitions"]:
+        getattr(f, var)[:] = 0
+    if hasattr(f, "ghg_forcing_offset"):
+        del f.ghg_forcing_offset
+    return f
+
+
+def kept_members(runids, temperature_rmse):
+    """Which ensemble members to keep the full temperature time series of."""
+    return (temperature_rmse < trajectory_rmse_ceiling) | (
+        runids % trajectory_stride == 0
+    )
+
+
+def run_fair(cfg):
+    """Run a batch of the prior ensemble and write its outputs.
+
+    ``cfg`` is a dict of ``batch_start`` and ``batch_end``, giving the ensemble members
+    to run. Optionally, it contains ``runids``: then the batch runs these ensemble
+    members, and the batch bounds are positions in the full ``runids`` list. If
+    ``historical`` is true, the batch only runs to 2023, which is enough to calculate
+    all of the outputs, but no temperature time series are kept. Idealised experiments
+    are run for batches without ``runids``, or if ``idealised`` is true.
+
+    If ``TIMING`` is set, this returns the time taken by each phase of the batch, to
+    be collected by ``utils._save_timing_report``.
+    """
+    members = cfg.get("runids", slice(cfg["batch_start"], cfg["batch_end"]))
+    runids = np.arange(cfg["batch_start"], cfg["batch_end"])
+    if "runids" in cfg:
+        runids = np.asarray(cfg["runids"])
+    batch_size = cfg["batch_end"] - cfg["batch_start"]
+    end_year = 2023 if cfg.get("historical", False) else 2101
+    n_timebounds = end_year - 1750 + 1
+
+    if not _inputs:
+        init_worker(batch_size, _published["directory"], end_year)
+    timer = _PhaseTimer()
+    timer.phases.update(_init_timings)
+    _init_timings.clear()
+
+    f = _get_template(batch_size, end_year)
+    timer.lap("template")
+
+    # this batch's ensemble members from the prior parameter store
+    prior = {name: _inputs[name][members] for name in [*prior_columns, "seed"]}
+    timer.lap("prior")
+
+    trend_shape = np.ones(352)
+    trend_shape[:271] = np.linspace(0, 1, 271)
+    trend_shape = trend_shape[:n_timebounds]
+
+    # solar and volcanic forcing
+    fill(
+        f.forcing,
+        _inputs["volcanic_forcing"][:n_timebounds, None, None]
+        * prior["scaling_Volcanic"],
+        specie="Volcanic",
+    )
+    fill(
+        f.forcing,
+        _inputs["solar_forcing"][:n_timebounds, None, None]
+        * prior["scaling_solar_amplitude"]
+        + trend_shape[:, None, None] * prior["scaling_solar_trend"],
+        specie="Solar",
+    )
+
+    # climate response
+    fill(
+        f.climate_configs["ocean_heat_capacity"],
+        np.array([prior["c1"], prior["c2"], prior["c3"]]).T,
+    )
+    fill(
+        f.climate_configs["ocean_heat_transfer"],
+        np.array([prior["kappa1"], prior["kappa2"], prior["kappa3"]]).T,
+    )
+    fill(f.climate_configs["deep_ocean_efficacy"], prior["epsilon"])
+    fill(f.climate_configs["gamma_autocorrelation"], prior["gamma"])
+    fill(f.climate_configs["sigma_eta"], prior["sigma_eta"])
+    fill(f.climate_configs["sigma_xi"], prior["sigma_xi"])
+    fill(f.climate_configs["seed"], prior["seed"])
+    fill(f.climate_configs["forcing_4co2"], prior["forcing_4co2"])
+
+    # carbon cycle
+    fill(f.species_configs["iirf_0"], prior["iirf_0"], specie="CO2")
+    fill(f.species_configs["iirf_airborne"], prior["iirf_airborne"], specie="CO2")
+    fill(f.species_configs["iirf_uptake"], prior["iirf_uptake"], specie="CO2")
+    fill(f.species_configs["iirf_temperature"], prior["iirf_temperature"], specie="CO2")
 
     # aerosol indirect
-    fill(f.species_configs["aci_scale"], cfg["beta"])
-    fill(f.species_configs["aci_shape"], cfg["shape_so2"], specie="Sulfur")
-    fill(f.species_configs["aci_shape"], cfg["shape_bc"], specie="BC")
-    fill(f.species_configs["aci_shape"], cfg["shape_oc"], specie="OC")
+    fill(f.species_configs["aci_scale"], prior["beta"])
+    fill(f.species_configs["aci_shape"], prior["shape_so2"], specie="Sulfur")
+    fill(f.species_configs["aci_shape"], prior["shape_bc"], specie="BC")
+    fill(f.species_configs["aci_shape"], prior["shape_oc"], specie="OC")
 
     # forcing scaling
-    fill(f.species_configs["forcing_scale"], cfg["scaling_CO2"], specie="CO2")
-    fill(f.species_configs["forcing_scale"], cfg["scaling_CH4"], specie="CH4")
-    fill(f.species_configs["forcing_scale"], cfg["scaling_N2O"], specie="N2O")
+    fill(f.species_configs["forcing_scale"], prior["scaling_CO2"], specie="CO2")
+    fill(f.species_configs["forcing_scale"], prior["scaling_CH4"], specie="CH4")
+    fill(f.species_configs["forcing_scale"], prior["scaling_N2O"], specie="N2O")
     fill(
         f.species_configs["forcing_scale"],
-        cfg["scaling_stwv"],
+        prior["scaling_stwv"],
         specie="Stratospheric water vapour",
     )
     fill(
         f.species_configs["forcing_scale"],
-        cfg["scaling_lapsi"],
+        prior["scaling_lapsi"],
         specie="Light absorbing particles on snow and ice",
     )
-    fill(f.species_configs["forcing_scale"], cfg["scaling_landuse"], specie="Land use")
+    fill(
+        f.species_configs["forcing_scale"], prior["scaling_landuse"], specie="Land use"
+    )
 
     for specie in [
         "CFC-11",
@@ -211,52 +560,71 @@ def run_fair(cfg):
         "HFC-365mfc",
         "HFC-4310mee",
     ]:
-        fill(f.species_configs["forcing_scale"], cfg["scaling_minorGHG"], specie=specie)
+        fill(
+            f.species_configs["forcing_scale"], prior["scaling_minorGHG"], specie=specie
+        )
 
     # aerosol radiation interactions
-    fill(f.species_configs["erfari_radiative_efficiency"], cfg["ari_BC"], specie="BC")
-    fill(f.species_configs["erfari_radiative_efficiency"], cfg["ari_CH4"], specie="CH4")
-    fill(f.species_configs["erfari_radiative_efficiency"], cfg["ari_N2O"], specie="N2O")
-    fill(f.species_configs["erfari_radiative_efficiency"], cfg["ari_NH3"], specie="NH3")
-    fill(f.species_configs["erfari_radiative_efficiency"], cfg["ari_NOx"], specie="NOx")
-    fill(f.species_configs["erfari_radiative_efficiency"], cfg["ari_OC"], specie="OC")
+    fill(f.species_configs["erfari_radiative_efficiency"], prior["ari_BC"], specie="BC")
+    fill(
+        f.species_configs["erfari_radiative_efficiency"], prior["ari_CH4"], specie="CH4"
+    )
+    fill(
+        f.species_configs["erfari_radiative_efficiency"], prior["ari_N2O"], specie="N2O"
+    )
+    fill(
+        f.species_configs["erfari_radiative_efficiency"], prior["ari_NH3"], specie="NH3"
+    )
+    fill(
+        f.species_configs["erfari_radiative_efficiency"], prior["ari_NOx"], specie="NOx"
+    )
+    fill(f.species_configs["erfari_radiative_efficiency"], prior["ari_OC"], specie="OC")
     fill(
         f.species_configs["erfari_radiative_efficiency"],
-        cfg["ari_Sulfur"],
+        prior["ari_Sulfur"],
         specie="Sulfur",
     )
-    fill(f.species_configs["erfari_radiative_efficiency"], cfg["ari_VOC"], specie="VOC")
+    fill(
+        f.species_configs["erfari_radiative_efficiency"], prior["ari_VOC"], specie="VOC"
+    )
     fill(
         f.species_configs["erfari_radiative_efficiency"],
-        cfg["ari_EESC"],
+        prior["ari_EESC"],
         specie="Equivalent effective stratospheric chlorine",
     )
 
     # Ozone
     fill(
-        f.species_configs["ozone_radiative_efficiency"], cfg["ozone_CH4"], specie="CH4"
+        f.species_configs["ozone_radiative_efficiency"],
+        prior["ozone_CH4"],
+        specie="CH4",
     )
     fill(
-        f.species_configs["ozone_radiative_efficiency"], cfg["ozone_N2O"], specie="N2O"
+        f.species_configs["ozone_radiative_efficiency"],
+        prior["ozone_N2O"],
+        specie="N2O",
+    )
+    fill(
+        f.species_configs["ozone_radiative_efficiency"], prior["ozone_CO"], specie="CO"
     )
-    fill(f.species_configs["ozone_radiative_efficiency"], cfg["ozone_CO"], specie="CO")
     fill(
-        f.species_configs["ozone_radiative_efficiency"], cfg["ozone_VOC"], specie="VOC"
+        f.species_configs["ozone_radiative_efficiency"],
+        prior["ozone_VOC"],
+        specie="VOC",
     )
     fill(
-        f.species_configs["ozone_radiative_efficiency"], cfg["ozone_NOx"], specie="NOx"
+        f.species_configs["ozone_radiative_efficiency"],
+        prior["ozone_NOx"],
+        specie="NOx",
     )
     fill(
         f.species_configs["ozone_radiative_efficiency"],
-        cfg["ozone_EESC"],
+        prior["ozone_EESC"],
         specie="Equivalent effective stratospheric chlorine",
     )
 
-    # tune down volcanic efficacy
-    fill(f.species_configs["forcing_efficacy"], 0.6, specie="Volcanic")
-
     # CO2 in 1750
-    fill(f.species_configs["baseline_concentration"], cfg["CO2_1750"], specie="CO2")
+    fill(f.species_configs["baseline_concentration"], prior["CO2_1750"], specie="CO2")
 
     # initial conditions
     initialise(f.concentration, f.species_configs["baseline_concentration"])
@@ -264,26 +632,74 @@ def run_fair(cfg):
     initialise(f.temperature, 0)
     initialise(f.cumulative_emissions, 0)
     initialise(f.airborne_emissions, 0)
+    timer.lap("fill")
 
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
         f.run(progress=False)
+    timer.lap("run")
+
+    temperature = f.temperature[100:, 0, :, 0].data
+    weights_51yr = np.ones(52)
+    weights_51yr[0] = 0.5
+    weights_51yr[-1] = 0.5
 
-    return (
-        f.temperature[100:, 0, :, 0],
-        f.ocean_heat_content_change[270:272, 0, :].mean(axis=0)
+    # RMSE of temperature relative to 1850-1900 against observations, 1850-2022
+    temperature_rmse = _temperature_rmse(temperature, _inputs["gmst"][:173])
+
+    # mean warming over 20-year periods relative to 1850-1900, with the bounding
+    # timebounds weighted by 0.5. This averages along the first axis, as
+    # constraining/03 did, so the baseline is calculated again in the same way.
+    weights_20yr = np.ones(21)
+    weights_20yr[0] = 0.5
+    weights_20yr[-1] = 0.5
+    baseline = np.average(temperature[:52], weights=weights_51yr, axis=0)
+
+    write_outputs(
+        members,
+        temperature_rmse=temperature_rmse,
+        temperature_2003_2022=np.average(
+            temperature[153:174], weights=weights_20yr, axis=0
+        )
+        - baseline,
+        temperature_1995_2014=np.average(
+            temperature[145:166], weights=weights_20yr, axis=0
+        )
+        - baseline,
+        ocean_heat_content=f.ocean_heat_content_change[270:272, 0, :].mean(axis=0)
         - f.ocean_heat_content_change[221:223, 0, :].mean(axis=0),
-        f.concentration[272:274, 0, :, 2].mean(axis=0),
-        np.average(
+        concentration_co2=f.concentration[272:274, 0, :, 2].mean(axis=0),
+        forcing_ari=np.average(
             f.forcing[255:266, 0, :, 54],
             weights=np.array([0.5, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0.5]),
             axis=0,
         ),
-        np.average(
+        forcing_aci=np.average(
             f.forcing[255:266, 0, :, 55],
             weights=np.array([0.5, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0.5]),
             axis=0,
         ),
-        f.ebms.ecs,
-        f.ebms.tcr,
+        ecs=f.ebms.ecs,
+        tcr=f.ebms.tcr,
     )
+
+    # in two-stage runs, the members to keep are run to 2101 in the second stage
+    if end_year == 2101:
+        keep = kept_members(runids, temperature_rmse)
+        _save_trajectories(trajectory_dir, runids[keep], temperature[:, keep])
+    timer.lap("outputs")
+
+    # idealised experiments use the parameters of the batch that are already loaded.
+    # In two-stage runs, these are run in the first stage.
+    if cfg.get("idealised", "runids" not in cfg):
+        for experiment in idealised_experiments:
+            results = _run_idealised(
+                experiment, prior, _inputs.get(f"concentration_{experiment}")
+            )
+            write_outputs(
+                members,
+                **{f"{experiment} {name}": data for name, data in results.items()},
+            )
+        timer.lap("idealised")
+
+    return timer.result(batch_size)